@@ -1,67 +1,274 @@
-
+from collections import OrderedDict
+import bisect
+import itertools
 import os
 import sys
 
-import gevent
-from gevent.event import AsyncResult
-
 from ekimbot.botplugin import ClientPlugin
 from ekimbot.commands import CommandHandler
 
+import wordstore
+from wordstore import OutOfTime, Pauser, prefix_range, sort_key
+
+
+class LRUCache(object):
+	"""Holds up to size items, evicting the least recently used"""
+	def __init__(self, size):
+		self.size = size
+		self.items = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key):
+		"""Returns the cached value for key, or None"""
+		try:
+			value = self.items.pop(key)
+		except KeyError:
+			self.misses += 1
+			return None
+		# re-insert to mark as most recently used
+		self.items[key] = value
+		self.hits += 1
+		return value
 
-words = AsyncResult()
-loader = None
+	def set(self, key, value):
+		self.items.pop(key, None)
+		self.items[key] = value
+		while len(self.items) > self.size:
+			self.items.popitem(last=False)
 
-def load_dict():
-	global words
-	_words = {}
-	path = '/usr/share/dict'
-	for name in os.listdir(path):
-		filepath = os.path.join(path, name)
-		with open(filepath) as f:
-			lines = f.read()
-		for n, line in enumerate(lines.strip().split('\n')):
-			key = "".join(sorted(line.lower()))
-			matches = _words.get(key, ())
-			if line not in matches:
-				_words[key] = matches + (line,)
-			if n % 10000 == 0:
-				gevent.sleep(0.01) # let other greenlets act
-	words.set(_words)
+	def clear(self):
+		self.items.clear()
 
 
 class AnagramsCommand(ClientPlugin):
 	name = 'anagrams'
 
+	defaults = {
+		'index_path': wordstore.INDEX_PATH,
+		'max_stall': 0.01, # how long the loader or a search may hog the cpu before yielding, in seconds
+		'max_words': 3, # max number of words in a multi-word anagram
+		'result_limit': 10, # max number of results to give for multianagrams and subanagrams
+		'time_limit': 2, # max cpu time a multianagrams or subanagrams search may take, in seconds
+		'cache_size': 1000, # how many replies to remember
+	}
+
 	def init(self):
-		global loader
-		if not (loader or words.ready()):
-			loader = gevent.spawn(load_dict)
+		self.words = wordstore.load(
+			index_path=self.config.index_path,
+			max_stall=self.config.max_stall,
+			logger=self.logger,
+		)
+		self.cache = LRUCache(self.config.cache_size)
+		# the store our cached replies were calculated from
+		self.cache_store = None
+
+	def cached(self, key, get_reply):
+		"""Returns a cached reply for key, or calls get_reply() to get one.
+		get_reply should return (reply, complete). Replies that aren't complete
+		(eg. because we're still loading) aren't cached."""
+		if self.cache_store is not self.words.store:
+			# the dictionary has been (re)loaded since we cached these
+			self.cache.clear()
+			self.cache_store = self.words.store
+		reply = self.cache.get(key)
+		if reply is None:
+			reply, complete = get_reply()
+			if complete:
+				self.cache.set(key, reply)
+		return reply
 
 	@CommandHandler('anagrams', 1)
 	def anagrams(self, msg, *args):
-		word = ' '.join(args)
-		matches = find_anagrams(word)
-		if matches:
-			self.reply(msg, "Anagrams of {}: {}".format(word, ', '.join(matches)))
-		else:
-			self.reply(msg, "No anagrams of {}".format(word))
+		word = normalize(' '.join(args))
+		self.reply(msg, self.cached(('anagrams', word), lambda: self.get_anagrams(word)))
+
+	def get_anagrams(self, word):
+		# check this first, so we don't claim a complete answer if it finishes loading while we look
+		partial = not self.words.ready.is_set()
+		return anagrams_reply(word, self.words.store, partial), not partial
+
+	@CommandHandler('multianagrams', 1)
+	def multianagrams(self, msg, *args):
+		"""Find phrases of up to a few words using all the given letters, eg. dormitory -> dirty room"""
+		phrase = normalize(' '.join(args))
+		self.reply(msg, self.cached(('multianagrams', phrase), lambda: self.get_multianagrams(phrase)))
+
+	def get_multianagrams(self, phrase):
+		partial = not self.words.ready.is_set()
+		pause = Pauser(self.config.max_stall, self.config.time_limit)
+		results = []
+		out_of_time = False
+		try:
+			for result in find_multi_anagrams(self.words.store, phrase, self.config.max_words, pause):
+				results.append(' '.join(result))
+				if len(results) >= self.config.result_limit:
+					break
+		except OutOfTime:
+			out_of_time = True
+		reply = self.format_search("Multi-word anagrams of", phrase, results, partial, out_of_time)
+		return reply, not (partial or out_of_time)
+
+	@CommandHandler('subanagrams', 1)
+	def subanagrams(self, msg, *args):
+		"""List the longest words that can be made from some of the given letters"""
+		letters = normalize(''.join(args))
+		self.reply(msg, self.cached(('subanagrams', letters), lambda: self.get_subanagrams(letters)))
+
+	def get_subanagrams(self, letters):
+		partial = not self.words.ready.is_set()
+		pause = Pauser(self.config.max_stall, self.config.time_limit)
+		out_of_time = False
+		results = []
+		try:
+			for matches in find_subanagrams(self.words.store, letters, pause):
+				results += [match for match in matches if match.lower() != letters]
+		except OutOfTime:
+			out_of_time = True
+		results.sort(key=lambda word: (-len(word), word))
+		more = len(results) - self.config.result_limit
+		results = results[:self.config.result_limit]
+		if more > 0:
+			results.append("and {} more".format(more))
+		reply = self.format_search("Words in", letters, results, partial, out_of_time)
+		return reply, not (partial or out_of_time)
+
+	def format_search(self, prefix, query, results, partial, out_of_time):
+		caveats = []
+		if partial:
+			caveats.append("still loading the dictionary")
+		if out_of_time:
+			caveats.append("ran out of time")
+		caveat_str = " ({}, so this may be incomplete)".format(' and '.join(caveats)) if caveats else ""
+		if not results:
+			return "Found nothing for {}{}".format(query, caveat_str)
+		return "{} {}{}: {}".format(prefix, query, caveat_str, ', '.join(results))
+
+	@CommandHandler('anagramstats', 0)
+	def anagramstats(self, msg, *args):
+		"""Show progress of loading the dictionary, and how well the reply cache is doing"""
+		self.reply(msg, self.words.status())
+		self.reply(msg, "Reply cache: {} of {} entries, {} hits, {} misses".format(
+			len(self.cache.items), self.cache.size, self.cache.hits, self.cache.misses,
+		))
 
 	@CommandHandler('anagram', 1)
 	def anagram(self, msg, *args):
 		return self.anagrams(msg, *args)
 
 
-def find_anagrams(word):
-	key = "".join(sorted(word.lower()))
-	matches = filter(lambda w: w.lower() != word.lower(), words.get().get(key, ()))
+def normalize(query):
+	"""Normalize a query for caching purposes. Lookups are case-insensitive."""
+	return ' '.join(query.lower().split())
+
+
+def anagrams_reply(word, store, partial=False):
+	matches = find_anagrams(word, store)
+	partial_str = " (still loading the dictionary, so this may be incomplete)" if partial else ""
+	if matches:
+		return "Anagrams of {}{}: {}".format(word, partial_str, ', '.join(matches))
+	return "No anagrams of {}{}".format(word, partial_str)
+
+
+def find_anagrams(word, store=None):
+	if store is None:
+		store = wordstore.loader.store
+	matches = filter(lambda w: w.lower() != word.lower(), store.get(sort_key(word), ()))
 	return matches
 
 
+def subanagram_keys(store, letters, pause):
+	"""Yields every key in the store that can be made from some of the given letters.
+
+	Since keys are themselves sorted letters, store.sorted_keys acts as a trie: all keys that
+	start with a given prefix are in a contiguous range. We extend the prefix one available letter
+	at a time (in sorted order, so each key is only reachable one way) and narrow the range with a
+	binary search, so we only ever visit prefixes that some key actually starts with.
+	pause is called regularly and may raise to abort the search.
+	"""
+	keys = store.sorted_keys
+	counts = {}
+	for letter in letters:
+		counts[letter] = counts.get(letter, 0) + 1
+	available = sorted(counts)
+
+	def search(prefix, lo, hi, start):
+		if lo < hi and keys[lo] == prefix:
+			yield prefix
+			lo += 1
+		for i in range(start, len(available)):
+			letter = available[i]
+			if not counts[letter]:
+				continue
+			new_prefix = prefix + letter
+			new_lo, new_hi = prefix_range(keys, new_prefix, lo, hi)
+			if new_lo == new_hi:
+				continue
+			counts[letter] -= 1
+			for key in search(new_prefix, new_lo, new_hi, i):
+				yield key
+			counts[letter] += 1
+			pause()
+
+	return search('', 0, len(keys), 0)
+
+
+def find_subanagrams(store, letters, pause):
+	"""Yields tuples of words that can be made from some of the given letters"""
+	for key in subanagram_keys(store, sort_key(letters), pause):
+		yield store.get(key, ())
+
+
+def find_multi_anagrams(store, phrase, max_words, pause):
+	"""Yields lists of up to max_words words which together use exactly the letters in phrase
+	(ignoring whitespace). Does not include the phrase itself.
+	pause is called regularly and may raise to abort the search.
+	"""
+	phrase_words = sorted(phrase.lower().split())
+	letters = ''.join(sorted(''.join(phrase_words)))
+	# We represent a set of letters as a vector of counts of each letter in the phrase
+	alphabet = sorted(set(letters))
+	def to_counts(key):
+		return tuple(key.count(letter) for letter in alphabet)
+
+	# Candidates are every key that fits in the phrase, longest first.
+	candidates = [(key, to_counts(key)) for key in subanagram_keys(store, letters, pause)]
+	candidates.sort(key=lambda candidate: -len(candidate[0]))
+
+	def search(remaining, remaining_len, start, chosen):
+		if not remaining_len:
+			yield list(chosen)
+			return
+		words_left = max_words - len(chosen)
+		if not words_left:
+			return
+		# we only consider candidates from start onwards, so each combination is only found one way
+		for i in range(start, len(candidates)):
+			key, counts = candidates[i]
+			# Candidates are longest-first, so if words this long can't use up the remaining letters,
+			# no later ones can either.
+			if len(key) * words_left < remaining_len:
+				break
+			if len(key) > remaining_len or any(count > left for count, left in zip(counts, remaining)):
+				continue
+			chosen.append(key)
+			new_remaining = tuple(left - count for left, count in zip(remaining, counts))
+			for result in search(new_remaining, remaining_len - len(key), i, chosen):
+				yield result
+			chosen.pop()
+			pause()
+
+	for keys in search(to_counts(letters), len(letters), 0, []):
+		for words in itertools.product(*[store.get(key, ()) for key in keys]):
+			if sorted(word.lower() for word in words) != phrase_words:
+				yield words
+
+
 if __name__ == '__main__':
 
 	if sys.argv[1:]:
-		load_dict()
+		wordstore.loader = wordstore.DictLoader()
+		wordstore.loader.run()
 		for word in sys.argv[1:]:
 			print "{}: {}".format(word, ", ".join(find_anagrams(word)))
 		sys.exit()
@@ -73,19 +280,78 @@ if __name__ == '__main__':
 			rss = int(values[23]) * 4
 			return rss
 
+	def in_child(fn):
+		# Each benchmark runs in a fresh fork so that memory used by one doesn't count against another
+		pid = os.fork()
+		if pid:
+			os.waitpid(pid, 0)
+			return
+		try:
+			fn()
+		finally:
+			os._exit(0)
+
 	test_words = sys.stdin.read().strip().split('\n')
 
-	info = []
-	info.append(("start", monotonic(), get_mem()))
-	load_dict()
-	info.append(("loaded", monotonic(), get_mem()))
-	for word in test_words:
-		find_anagrams(word)
-	info.append(("look up {}x".format(len(test_words)), monotonic(), get_mem()))
-
-	_, prev_t, prev_mem = info[0]
-	FORMAT = "{}: {:+.2f}s, {:+f}MB"
-	for name, t, mem in info[1:]:
-		print FORMAT.format(name, t - prev_t, (mem - prev_mem) / 1024.0)
-		prev_t, prev_mem = t, mem
-	print "{}: {:.2f}s, {:f}MB".format("final", prev_t, prev_mem / 1024.0)
+	def benchmark(name, load):
+		wordstore.loader = wordstore.DictLoader()
+		info = []
+		info.append(("start", monotonic(), get_mem()))
+		load()
+		info.append(("loaded", monotonic(), get_mem()))
+		for word in test_words:
+			find_anagrams(word)
+		info.append(("look up {}x".format(len(test_words)), monotonic(), get_mem()))
+
+		print "{} backend:".format(name)
+		_, prev_t, prev_mem = info[0]
+		FORMAT = "  {}: {:+.2f}s, {:+f}MB"
+		for step, t, mem in info[1:]:
+			print FORMAT.format(step, t - prev_t, (mem - prev_mem) / 1024.0)
+			prev_t, prev_mem = t, mem
+		print "  {}: {:.2f}s, {:f}MB".format("final", prev_t, prev_mem / 1024.0)
+		sys.stdout.flush()
+
+	def replay_benchmark(count=100000, zipf_s=1.1, cache_size=1000):
+		# Replay a query log where popular words are asked for far more often than others,
+		# as they are in a busy channel: the nth most popular word is asked for with weight 1/n^s.
+		import random
+		cumulative = []
+		total = 0
+		for rank in range(1, len(test_words) + 1):
+			total += 1. / rank ** zipf_s
+			cumulative.append(total)
+		queries = [
+			normalize(test_words[bisect.bisect_left(cumulative, random.random() * total)])
+			for _ in range(count)
+		]
+
+		wordstore.loader = wordstore.DictLoader()
+		wordstore.loader.run()
+		store = wordstore.loader.store
+
+		start = monotonic()
+		for word in queries:
+			anagrams_reply(word, store)
+		uncached = monotonic() - start
+
+		cache = LRUCache(cache_size)
+		start = monotonic()
+		for word in queries:
+			if cache.get(word) is None:
+				cache.set(word, anagrams_reply(word, store))
+		cached = monotonic() - start
+
+		print "Zipf replay of {} queries over {} words (s={}):".format(count, len(test_words), zipf_s)
+		print "  uncached: {:.0f} lookups/sec".format(count / uncached)
+		print "  cached ({} entries): {:.0f} lookups/sec, {:.1f}% hit rate".format(
+			cache_size, count / cached, 100. * cache.hits / count,
+		)
+		sys.stdout.flush()
+
+	# Make sure the index is built first, so we measure opening an existing index,
+	# which is what every process but the first one on a host will do.
+	in_child(lambda: wordstore.DictLoader().run())
+	in_child(lambda: benchmark("dict", lambda: wordstore.loader.read(wordstore.dict_signature(), Pauser(0.01))))
+	in_child(lambda: benchmark("index", lambda: wordstore.loader.run()))
+	in_child(replay_benchmark)
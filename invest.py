@@ -2,11 +2,253 @@
 import math
 import random
 import time
+from bisect import bisect_left, insort
+
+import gevent
+import numpy as np
 
 from ekimbot.botplugin import ClientPlugin
 from ekimbot.commands import CommandHandler
 
 
+def advance(amounts, periods, held, rates, risks, incomes):
+	"""The model behind the whole game: what happens to money left in funds for a while.
+	amounts, periods (in seconds) and held (whether there's money in the fund at all) are arrays of shape
+	(players, funds). rates, risks and incomes are per second, with one for each fund.
+	Returns (new amounts, which funds went bust, how many seconds before the end of the period they went bust)
+	as arrays of the same shape. Where a fund didn't go bust, the last is meaningless.
+	This is used to settle players (see Ledger.settle()) and to simulate them (see Ledger.simulate()).
+	"""
+	# Interest is compounded infinitely fast (comes out to exponential, (1+r/n)^tn -> e^tr as n -> inf)
+	# Risk is also infinitely divided (similarly, (1-p/n)^tn -> e^-tp as n -> inf).
+	# So for example, the actual risk and return after a day (t=1) for return 10%/day at 1% risk/day is:
+	#   return: e^0.1 ~= 1.105, 1.105 - 1 = 10.5% increase
+	#   risk: e^-0.01 ~= 0.99005, 1 - 0.99005 = 0.00995% risk
+
+	# We choose a time of bust by "working backwards" from the random value we rolled.
+	# Suppose we picked a uniform random value X, deciding that a bust occurred if X > e^(-tp)
+	# (ie. that 1-X < 1 - e^(-tp), which is the risk as above)
+	# Then let's ask, for what value of t would we have _just_ gotten a bust? Call it B. Then:
+	#     X = e^(-Bp)
+	#     -Bp = ln X
+	#     B = -(ln X)/p
+	# This gives us how long in the past the bust occurred. Note we can prove B < t.
+	# For an extreme example, suppose risk was 60%/day (p=0.6) and we're looking at 1 day (t=1).
+	# From above, success chance = e^-.6 ~= 0.54. We roll x in [0,1) and get 0.9 - this means we've gone bust.
+	# Using the above formula, B = -(ln 0.9)/0.6 ~= 0.175, or 4.2 hours.
+	# As a nice side effect, checking if B < period is exactly the same as the initial check
+	# that X > success chance, so we can just calculate everything at once.
+
+	# Final complication is base income. It arrives steadily and we need to account for it
+	# in our compound interest.
+	# By considering interest at infinitely thin time slices and with I = income rate,
+	# total = integral 0 to t of I e^(t-x)r dx = I e^rt (integral 0 to t of e^-rx dx)
+	# = I e^rt (1 - e^-rt) / r.
+	# So for example $100/day for 1 day at 10%/day gives 100 * e^(1*0.1) * (1 - e^-(1*0.1)) / 0.1 ~= $105.17
+
+	with np.errstate(divide='ignore', invalid='ignore'):
+		# A roll of 0 gives a bust infinitely long ago, as does no risk. Neither is a bust.
+		since_bust = - np.log(np.random.random_sample(periods.shape)) / risks
+		busted = held & (since_bust < periods)
+		periods = np.where(busted, since_bust, periods) # only calculate new amounts (eg. for income) since bust
+		amounts = np.where(busted, 0, amounts)
+		growth = np.exp(periods * rates)
+		amounts *= growth # add interest
+		# add income + income's interest. Funds without income have nothing to add, even with no interest to divide by.
+		amounts += np.where(incomes, incomes * growth * (1 - np.exp(-periods * rates)) / rates, 0)
+	return amounts, busted, since_bust
+
+
+class Ledger(object):
+	"""Every player's money, as numpy arrays with a row per player and a column per fund,
+	so that we can settle any number of players at once (see settle()).
+
+	Money in funds that no longer exist isn't touched by anything, so it's kept to one side as it was.
+	"""
+	def __init__(self, funds, base_fund, base_income):
+		self.shorts = [short for name, short, rate, risk in funds]
+		self.columns = {short: column for column, short in enumerate(self.shorts)}
+		self.base_column = self.columns[base_fund]
+		# per second
+		self.rates = np.array([rate for name, short, rate, risk in funds]) / 86400.
+		self.risks = np.array([risk for name, short, rate, risk in funds]) / 86400.
+		self.incomes = np.zeros(len(funds))
+		self.incomes[self.base_column] = base_income / 86400.
+		self.names = []
+		self.rows = {} # {name: row}
+		# Arrays are allocated with room to grow, only the first len(self.names) rows are real
+		self.updated = np.zeros(0)
+		self.amounts = np.zeros((0, len(funds)))
+		self.last_busts = np.zeros((0, len(funds))) # NaN for never
+		self.held = np.zeros((0, len(funds)), dtype=bool) # whether they have money in the fund at all
+		self.defunct = {} # {name: {short name: (amount, last bust)}}
+
+	def __len__(self):
+		return len(self.names)
+
+	def __contains__(self, name):
+		return name in self.rows
+
+	def load(self, data):
+		"""Load what dump() returned, which may have been for a different list of funds"""
+		for name, updated in zip(data['names'], data['updated']):
+			self.add(name, updated)
+		rows = slice(0, len(data['names']))
+		for column, short in enumerate(data['funds']):
+			amounts = np.array(data['amounts'][column], dtype=float)
+			last_busts = np.array(data['last_busts'][column], dtype=float)
+			held = np.array(data['held'][column], dtype=bool)
+			last_busts[last_busts == 0] = np.nan
+			if short in self.columns:
+				self.amounts[rows, self.columns[short]] = amounts
+				self.last_busts[rows, self.columns[short]] = last_busts
+				self.held[rows, self.columns[short]] = held
+				continue
+			for row in np.flatnonzero(held):
+				self.defunct.setdefault(self.names[row], {})[short] = (
+					float(amounts[row]), None if np.isnan(last_busts[row]) else float(last_busts[row]),
+				)
+		for name, funds in data.get('defunct', {}).items():
+			self.defunct.setdefault(name, {}).update((short, tuple(value)) for short, value in funds.items())
+
+	def load_players(self, players):
+		"""Load players as they were stored before we had a ledger,
+		{player name: [last updated, {fund short name: [amount in fund, time of last bust or None]}]}"""
+		for name, (updated, funds) in players.items():
+			self.add(name, updated)
+			for short, (amount, last_bust) in funds.items():
+				if short in self.columns:
+					self.set(name, short, amount, last_bust)
+				else:
+					self.defunct.setdefault(name, {})[short] = amount, last_bust
+
+	def dump(self):
+		"""Returns everything as plain lists and dicts, for saving in the store.
+		amounts, last_busts and held are a list per fund (in the order of funds), of a value per player
+		(in the order of names). Times of last busts are 0 for never.
+		Nothing returned is shared with the ledger, so it won't change as the ledger does."""
+		size = len(self.names)
+		return {
+			'funds': list(self.shorts),
+			'names': list(self.names),
+			'updated': self.updated[:size].tolist(),
+			'amounts': self.amounts[:size].T.tolist(),
+			'last_busts': np.where(np.isnan(self.last_busts[:size]), 0, self.last_busts[:size]).T.tolist(),
+			'held': self.held[:size].T.tolist(),
+			'defunct': {name: dict(funds) for name, funds in self.defunct.items()},
+		}
+
+	def add(self, name, updated):
+		"""Add a player with no money, returning their row"""
+		row = len(self.names)
+		if row == len(self.updated):
+			size = max(16, row * 2)
+			self.updated = np.resize(self.updated, size)
+			self.amounts = np.resize(self.amounts, (size, len(self.shorts)))
+			self.last_busts = np.resize(self.last_busts, (size, len(self.shorts)))
+			self.held = np.resize(self.held, (size, len(self.shorts)))
+		self.names.append(name)
+		self.rows[name] = row
+		self.updated[row] = updated
+		self.amounts[row] = 0
+		self.last_busts[row] = np.nan
+		self.held[row] = False
+		return row
+
+	def funds(self, name):
+		"""Returns {short name: (amount, time of last bust or None)} for the funds name has money in,
+		including defunct ones"""
+		row = self.rows[name]
+		funds = dict(self.defunct.get(name, {}))
+		for column in np.flatnonzero(self.held[row]):
+			last_bust = self.last_busts[row, column]
+			funds[self.shorts[column]] = float(self.amounts[row, column]), None if np.isnan(last_bust) else float(last_bust)
+		return funds
+
+	def set(self, name, short, amount, last_bust=None):
+		"""Set how much name has in a fund. An amount of None means they no longer have any money in it."""
+		row = self.rows[name]
+		column = self.columns[short]
+		self.held[row, column] = amount is not None
+		self.amounts[row, column] = amount or 0
+		self.last_busts[row, column] = np.nan if last_bust is None else last_bust
+
+	def total(self, name):
+		"""Returns name's total money, including defunct funds"""
+		return float(self.amounts[self.rows[name]].sum()) + sum(
+			amount for amount, last_bust in self.defunct.get(name, {}).values()
+		)
+
+	def totals(self):
+		"""Returns an array of each player's total money, by row"""
+		totals = self.amounts[:len(self.names)].sum(axis=1)
+		for name, funds in self.defunct.items():
+			totals[self.rows[name]] += sum(amount for amount, last_bust in funds.values())
+		return totals
+
+	def settle(self, rows, now):
+		"""Bring the given rows (a slice) up to date as of now. See advance() for how.
+		Everyone gets income into the base fund, whether they had money in it or not.
+		Returns how many funds went bust."""
+		held = self.held[rows]
+		held[:, self.base_column] = True
+		periods = (now - self.updated[rows])[:, np.newaxis] * np.ones(len(self.shorts))
+		amounts, busted, since_bust = advance(self.amounts[rows], periods, held, self.rates, self.risks, self.incomes)
+		self.amounts[rows] = amounts
+		self.last_busts[rows] = np.where(busted, now - since_bust, self.last_busts[rows])
+		self.held[rows] = held
+		self.updated[rows] = now
+		return int(busted.sum())
+
+	def simulate(self, amounts, period, trials):
+		"""Run trials independent trials of leaving amounts (an amount for each fund) alone for period seconds,
+		with income into the base fund. Returns an array of the total money at the end of each trial."""
+		amounts = np.tile(np.asarray(amounts, dtype=float), (trials, 1))
+		held = amounts > 0
+		held[:, self.base_column] = True
+		periods = np.empty(amounts.shape)
+		periods.fill(period)
+		amounts, _, _ = advance(amounts, periods, held, self.rates, self.risks, self.incomes)
+		return amounts.sum(axis=1)
+
+
+class Leaderboard(object):
+	"""Players ranked by their total money as of when they were last settled.
+	Kept as a sorted list of (-total, name) so the richest come first, and ties go alphabetically.
+	Finding a player's rank is a bisect, and so is finding where they move to when their total changes.
+	"""
+	def __init__(self):
+		self.entries = []
+		self.keys = {} # {name: their entry}
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __contains__(self, name):
+		return name in self.keys
+
+	def rebuild(self, names, totals):
+		"""Replace the whole ranking with the given players and totals"""
+		self.entries = sorted(zip((-totals).tolist(), names))
+		self.keys = {entry[1]: entry for entry in self.entries}
+
+	def update(self, name, total):
+		"""Move name to where their new total puts them"""
+		key = self.keys.get(name)
+		if key is not None:
+			del self.entries[bisect_left(self.entries, key)]
+		key = self.keys[name] = (-total, name)
+		insort(self.entries, key)
+
+	def top(self, count):
+		"""Returns [(name, total)] for the count richest players"""
+		return [(name, -total) for total, name in self.entries[:count]]
+
+	def rank(self, name):
+		"""Returns name's rank, starting from 1 for the richest"""
+		return bisect_left(self.entries, self.keys[name]) + 1
+
+
 class InvestGame(ClientPlugin):
 	"""A very simple idle game based around 'investing money'"""
 
@@ -27,8 +269,105 @@ class InvestGame(ClientPlugin):
 	BASE_FUND = "savings"
 	BASE_INCOME = 100
 
-	# Store schema: players: {player name: [last updated, {fund short name: [amount in fund, time of last bust or None]}]}
+	# Store schema: ledger: what Ledger.dump() returns, a list of players with a list of amounts in each fund.
 	# timestamps in epoch float.
+	# Older stores have instead players: {player name: [last updated, {fund short name: [amount in fund, time of last bust or None]}]}
+
+	# Most players to show in `invest top`
+	MAX_TOP = 10
+
+	# Longest horizon `invest simulate` will look at. Much past this, the riskier funds' growth overflows a float.
+	MAX_SIMULATE_DAYS = 365
+
+	defaults = {
+		# Saves are put off until nothing has changed for save_delay seconds,
+		# or it's been max_save_delay seconds since the first unsaved change, so a burst of changes is one write.
+		'save_delay': 5,
+		'max_save_delay': 60,
+		# `invest simulate` runs up to simulate_trials trials, simulate_chunk at a time, yielding to other greenlets
+		# between chunks. It stops early, with however many it's done, after simulate_time_budget seconds.
+		'simulate_trials': 100000,
+		'simulate_chunk': 10000,
+		'simulate_time_budget': 1,
+		# Players are re-ranked as they're updated, but we also settle and re-rank everyone every
+		# leaderboard_interval seconds, so those who aren't playing right now still move.
+		'leaderboard_interval': 300,
+	}
+
+	# greenlet waiting to save, if one is pending
+	saver = None
+	refresher = None
+
+	def init(self):
+		self.ledger = Ledger(self.FUNDS, self.BASE_FUND, self.BASE_INCOME)
+		if 'ledger' in self.store:
+			self.ledger.load(self.store['ledger'])
+		elif 'players' in self.store:
+			self.ledger.load_players(self.store['players'])
+		# whether the ledger has changed since it was last saved
+		self.dirty = False
+		self.last_change = None
+		self.saves_requested = 0
+		self.saves_performed = 0
+		# Until the first refresh, rank everyone as of when they were last settled
+		self.leaderboard = Leaderboard()
+		self.leaderboard.rebuild(self.ledger.names, self.ledger.totals())
+		self.leaderboard_refreshed = None
+		self.refresher = gevent.spawn(self.refresh_loop)
+
+	def cleanup(self):
+		if self.refresher:
+			self.refresher.kill()
+		if self.saver:
+			self.saver.kill()
+		self.save()
+
+	def refresh_loop(self):
+		while True:
+			gevent.sleep(self.config.leaderboard_interval)
+			try:
+				self.refresh_leaderboard()
+			except Exception:
+				self.logger.exception("Failed to refresh invest leaderboard")
+
+	def refresh_leaderboard(self):
+		"""Settle everyone and rank them all again from scratch"""
+		self.settle_all()
+		self.leaderboard.rebuild(self.ledger.names, self.ledger.totals())
+		self.leaderboard_refreshed = time.time()
+
+	def request_save(self):
+		"""Note that something has changed that needs saving, and save it soon"""
+		self.dirty = True
+		self.saves_requested += 1
+		self.last_change = time.time()
+		if not self.saver:
+			self.saver = gevent.spawn(self.save_later, self.last_change + self.config.max_save_delay)
+
+	def save_later(self, deadline):
+		while True:
+			wait_until = min(self.last_change + self.config.save_delay, deadline)
+			now = time.time()
+			if now >= wait_until:
+				break
+			gevent.sleep(wait_until - now)
+		self.saver = None
+		try:
+			self.save()
+		except Exception:
+			# we're still dirty, so we'll try again on the next change
+			self.logger.exception("Failed to save invest store")
+
+	def save(self):
+		"""Save the ledger to the store now, if it's changed"""
+		if not self.dirty:
+			return
+		self.store['ledger'] = self.ledger.dump()
+		# the old format, we've migrated from it now
+		self.store.pop('players', None)
+		self.save_store()
+		self.dirty = False
+		self.saves_performed += 1
 
 	@CommandHandler("invest help", 0)
 	def help(self, msg, *args):
@@ -38,7 +377,8 @@ class InvestGame(ClientPlugin):
 			"over time, but you always run the risk of losing everything! You'll always get ${}/day "
 			"coming into your savings account. Move funds with `invest move FROM TO AMOUNT`. "
 			"See available funds with `invest funds`. Check your or others' net worth with "
-			"`invest check` or `invest check NAME`."
+			"`invest check` or `invest check NAME`, or see who's richest with `invest top` and `invest rank`. "
+			"Try out a strategy with `invest simulate DAYS [FUND AMOUNT]...`."
 		).format(self.BASE_INCOME))
 		self.reply(msg,
 			"Important: Right now some technical limitations mean each instance of "
@@ -65,7 +405,7 @@ class InvestGame(ClientPlugin):
 		"""
 		target = args[0] if args else msg.sender
 		self.update(target)
-		_, funds = self.store['players'][target]
+		funds = self.ledger.funds(target)
 		for name, short, rate, risk in self.FUNDS:
 			if short not in funds:
 				continue
@@ -87,6 +427,44 @@ class InvestGame(ClientPlugin):
 		))
 
 
+	@CommandHandler("invest top", 0)
+	def top(self, msg, *args):
+		"""Show the richest players. Optionally give how many to show.
+
+		Players are ranked by their money as of when they last played, or the last time
+		everyone was updated (every few minutes), whichever is later.
+		"""
+		try:
+			count = int(args[0]) if args else 5
+		except ValueError:
+			self.reply(msg, "Number of players to show must be a number, not {!r}".format(args[0]))
+			return
+		count = max(1, min(self.MAX_TOP, count))
+		if not self.leaderboard:
+			self.reply(msg, "No-one is playing yet")
+			return
+		self.reply(msg, ", ".join(
+			"{}. {} (${:.2f})".format(rank, name, total)
+			for rank, (name, total) in enumerate(self.leaderboard.top(count), 1)
+		))
+
+	@CommandHandler("invest rank", 0)
+	def rank(self, msg, *args):
+		"""Show where you or someone else ranks among all players
+
+		You can either pass a target user, or no-one to check yourself.
+		Other players are ranked as in `invest top`.
+		"""
+		target = args[0] if args else msg.sender
+		if target not in self.ledger:
+			self.reply(msg, "{} isn't playing".format(target))
+			return
+		self.update(target)
+		self.reply(msg, "{} is ranked {} of {} with ${:.2f}".format(
+			target, self.leaderboard.rank(target), len(self.leaderboard), self.ledger.total(target),
+		))
+
+
 	@CommandHandler("invest move", 3)
 	def move(self, msg, src, dest, amount):
 		"""Move money from one fund to another. Args are FROM, TO, AMOUNT. AMOUNT can be "all".
@@ -122,7 +500,7 @@ class InvestGame(ClientPlugin):
 
 		target = msg.sender
 		self.update(target)
-		_, funds = self.store['players'][target]
+		funds = self.ledger.funds(target)
 
 		src_amount, _ = funds.get(src, (0, None))
 		dest_amount, _ = funds.get(dest, (0, None))
@@ -136,80 +514,210 @@ class InvestGame(ClientPlugin):
 		src_amount -= amount
 		dest_amount += amount
 
-		if src_amount > 0:
-			funds[src] = src_amount, None
-		else:
-			funds.pop(src, None)
-		funds[dest] = dest_amount, None
-		self.save_store()
+		self.ledger.set(target, src, src_amount if src_amount > 0 else None)
+		self.ledger.set(target, dest, dest_amount)
+		self.request_save()
 
 		self.reply(msg, "{}: Moved ${} from {} to {}".format(target, amount, src, dest))
 
 
-	def update(self, target):
-		"""Update target's money in the store"""
-		# Interest is compounded infinitely fast (comes out to exponential, (1+r/n)^tn -> e^tr as n -> inf)
-		# Risk is also infinitely divided (similarly, (1-p/n)^tn -> e^-tp as n -> inf).
-		# So for example, the actual risk and return after a day (t=1) for return 10%/day at 1% risk/day is:
-		#   return: e^0.1 ~= 1.105, 1.105 - 1 = 10.5% increase
-		#   risk: e^-0.01 ~= 0.99005, 1 - 0.99005 = 0.00995% risk
-
-		# We choose a time of bust by "working backwards" from the random value we rolled.
-		# Suppose we picked a uniform random value X, deciding that a bust occurred if X > e^(-tp)
-		# (ie. that 1-X < 1 - e^(-tp), which is the risk as above)
-		# Then let's ask, for what value of t would we have _just_ gotten a bust? Call it B. Then:
-		#     X = e^(-Bp)
-		#     -Bp = ln X
-		#     B = -(ln X)/p
-		# This gives us how long in the past the bust occurred. Note we can prove B < t.
-		# For an extreme example, suppose risk was 60%/day (p=0.6) and we're looking at 1 day (t=1).
-		# From above, success chance = e^-.6 ~= 0.54. We roll x in [0,1) and get 0.9 - this means we've gone bust.
-		# Using the above formula, B = -(ln 0.9)/0.6 ~= 0.175, or 4.2 hours.
-		# As a nice side effect, checking if B < period is exactly the same as the initial check
-		# that X > success chance, so we can just calculate everything at once.
-
-		# Final complication is base income. It arrives steadily and we need to account for it
-		# in our compound interest.
-		# By considering interest at infinitely thin time slices and with I = income rate,
-		# total = integral 0 to t of I e^(t-x)r dx = I e^rt (integral 0 to t of e^-rx dx)
-		# = I e^rt (1 - e^-rt) / r.
-		# So for example $100/day for 1 day at 10%/day gives 100 * e^(1*0.1) * (1 - e^-(1*0.1)) / 0.1 ~= $105.17
+	@CommandHandler("invest simulate", 1)
+	def simulate(self, msg, days, *args):
+		"""Simulate how investments might turn out. Args are DAYS, then any number of FUND AMOUNT pairs.
 
-		now = time.time()
+		Runs many trials of leaving money in funds for DAYS days (with your daily income), and shows the range of outcomes.
+		Give the amount to put in each fund using the short names given under `invest funds`,
+		or nothing to simulate your current investments.
+		"""
+		try:
+			_days = float(days)
+			if math.isnan(_days) or not 0 < _days <= self.MAX_SIMULATE_DAYS:
+				raise ValueError
+		except ValueError:
+			self.reply(msg, "Days must be a positive number up to {}, not {!r}".format(self.MAX_SIMULATE_DAYS, days))
+			return
+		days = _days
 
-		if target not in self.store.setdefault('players', {}):
-			self.store['players'][target] = now, {self.BASE_FUND: (self.BASE_INCOME, None)}
+		if len(args) % 2:
+			self.reply(msg, "Give funds to simulate as pairs of FUND AMOUNT")
 			return
+		amounts = np.zeros(len(self.ledger.shorts))
+		if args:
+			for short, amount in zip(args[::2], args[1::2]):
+				short = short.lower()
+				if short not in self.ledger.columns:
+					self.reply(msg, "{!r} is not a fund name. You need to use the short name as it appears in `invest funds`.".format(short))
+					return
+				try:
+					_amount = float(amount)
+					if math.isnan(_amount) or math.isinf(_amount) or _amount <= 0:
+						raise ValueError
+				except ValueError:
+					self.reply(msg, "Amount must be a positive number, not {!r}".format(amount))
+					return
+				amounts[self.ledger.columns[short]] += _amount
+		else:
+			# Money in defunct funds doesn't do anything, so we leave it out.
+			self.update(msg.sender)
+			for short, (amount, last_bust) in self.ledger.funds(msg.sender).items():
+				if short in self.ledger.columns:
+					amounts[self.ledger.columns[short]] = amount
+
+		# Busts are just as likely in any period of the same length, so one step over the whole horizon
+		# gives exactly the same outcomes as stepping through it a day at a time would.
+		period = days * 24 * 60 * 60
+		deadline = time.time() + self.config.simulate_time_budget
+		results = []
+		trials = 0
+		while trials < self.config.simulate_trials and (not results or time.time() < deadline):
+			chunk = min(self.config.simulate_chunk, self.config.simulate_trials - trials)
+			results.append(self.ledger.simulate(amounts, period, chunk))
+			trials += chunk
+			gevent.idle()
+		outcomes = np.concatenate(results)
+
+		start = amounts.sum()
+		p10, p25, median, p75, p90 = np.percentile(outcomes, [10, 25, 50, 75, 90])
+		self.reply(msg, (
+			"${start:.2f} after {days:g} days: mean ${mean:.2f}, median ${median:.2f}. "
+			"10%: ${p10:.2f}, 25%: ${p25:.2f}, 75%: ${p75:.2f}, 90%: ${p90:.2f}. "
+			"{loss:.1%} chance of ending up with less than you started. ({trials} trials{early})"
+		).format(
+			start=start, days=days, mean=outcomes.mean(), median=median,
+			p10=p10, p25=p25, p75=p75, p90=p90,
+			loss=(outcomes < start).mean(), trials=trials,
+			early=", ran out of time" if trials < self.config.simulate_trials else "",
+		))
 
-		oldtime, funds = self.store['players'][target]
-		period = now - oldtime
 
-		for name, short, rate, risk in self.FUNDS:
+	def update(self, target):
+		"""Update target's money, see Ledger.settle()"""
+		now = time.time()
+		if target not in self.ledger:
+			self.ledger.add(target, now)
+			self.ledger.set(target, self.BASE_FUND, self.BASE_INCOME)
+			self.request_save()
+		else:
+			row = self.ledger.rows[target]
+			self.settled(self.ledger.settle(slice(row, row + 1), now))
+		self.leaderboard.update(target, self.ledger.total(target))
+
+	def settle_all(self):
+		"""Update every player's money at once. Doing the maths for all of them in one go
+		is far faster than calling update() for each. Doesn't re-rank them, see refresh_leaderboard()."""
+		self.settled(self.ledger.settle(slice(0, len(self.ledger)), time.time()))
+
+	def settled(self, busts):
+		"""Having settled players, with the given number of funds going bust, make sure it gets saved.
+		A bust must be saved, as it's been decided and we may be about to tell someone about it.
+		But if there weren't any, all we've done is add interest - and since busts are just as likely in
+		any period of the same length, if we lost that, settling again later would give the same results
+		as if we never had. So we don't make reads write just for that, we let it go with the next save."""
+		if busts:
+			self.request_save()
+		else:
+			self.dirty = True
+
+	@CommandHandler("invest stats", 0)
+	def stats(self, msg, *args):
+		"""Show how often the invest game is saving"""
+		self.reply(msg, "{} players. {} saves requested, {} performed. {} Leaderboard last refreshed: {}".format(
+			len(self.ledger), self.saves_requested, self.saves_performed,
+			"Saving soon." if self.saver else "Unsaved changes." if self.dirty else "Everything is saved.",
+			time.strftime('%F %T UTC', time.gmtime(self.leaderboard_refreshed)) if self.leaderboard_refreshed else "never",
+		))
+
+if __name__ == '__main__':
+	# Benchmark settling many players one at a time, against all at once as settle_all() does,
+	# and check they give the same distribution of results as the original per-player, per-fund maths.
+	# Args are: number of players (default 100000), max days since they were last updated (default 7)
+	import copy
+	import sys
+
+	from monotonic import monotonic
+
+	class BenchGame(InvestGame):
+		store = None
+		def __init__(self, store):
+			self.store = store
+		def save_store(self):
+			pass
+
+	def original_update(players, target, now):
+		"""How update() used to work, for comparison"""
+		oldtime, funds = players[target]
+		period = now - oldtime
+		for name, short, rate, risk in InvestGame.FUNDS:
 			this_period = period
 			rate_sec = rate / 86400.
 			risk_sec = risk / 86400.
-			income_sec = self.BASE_INCOME / 86400.
-
+			income_sec = InvestGame.BASE_INCOME / 86400.
 			if short in funds:
 				amount, last_bust = funds[short]
-			elif short == self.BASE_FUND:
+			elif short == InvestGame.BASE_FUND:
 				amount, last_bust = 0, None
 			else:
 				continue
-
 			if risk_sec:
 				since_bust = - math.log(random.random()) / risk_sec
 				if since_bust < period:
 					last_bust = now - since_bust
-					this_period = since_bust # only calculate new amounts (eg. for income) since bust
+					this_period = since_bust
 					amount = 0
-
-			amount *= math.exp(this_period * rate_sec) # add interest
-			if short == self.BASE_FUND:
-				# add income + income's interest
+			amount *= math.exp(this_period * rate_sec)
+			if short == InvestGame.BASE_FUND:
 				amount += income_sec * math.exp(this_period*rate_sec) * (1 - math.exp(-this_period*rate_sec)) / rate_sec
-
 			funds[short] = amount, last_bust
-
-		self.store['players'][target] = now, funds
-		self.save_store()
+		players[target] = now, funds
+
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	days = float(sys.argv[2]) if len(sys.argv) > 2 else 7
+	now = time.time()
+	shorts = [short for name, short, rate, risk in InvestGame.FUNDS]
+	players = {}
+	for i in xrange(count):
+		funds = {short: (random.uniform(0, 10000), None) for short in random.sample(shorts, random.randint(1, len(shorts)))}
+		players['player{}'.format(i)] = now - random.uniform(0, days * 86400), funds
+
+	results = {}
+	for name in ('original', 'per-player', 'batch'):
+		game = BenchGame({'players': copy.deepcopy(players)})
+		game.init()
+		ledger = game.ledger
+		start = monotonic()
+		if name == 'original':
+			for player in game.store['players'].keys():
+				original_update(game.store['players'], player, time.time())
+		elif name == 'per-player':
+			# as update() does
+			for row in xrange(len(ledger)):
+				ledger.settle(slice(row, row + 1), time.time())
+		else:
+			ledger.settle(slice(0, len(ledger)), time.time())
+		elapsed = monotonic() - start
+		results[name] = elapsed
+		print "{}: {:.3f}s, {:.0f} players/sec".format(name, elapsed, count / elapsed)
+		if name == 'original':
+			ledger = Ledger(InvestGame.FUNDS, InvestGame.BASE_FUND, InvestGame.BASE_INCOME)
+			ledger.load_players(game.store['players'])
+		for column, short in enumerate(ledger.shorts):
+			held = ledger.held[:len(ledger), column]
+			amounts = ledger.amounts[:len(ledger), column][held]
+			busts = (~np.isnan(ledger.last_busts[:len(ledger), column][held])).sum()
+			print "  {}: mean ${:.2f}, std ${:.2f}, {:.2%} went bust".format(
+				short, amounts.mean(), amounts.std(), busts / float(held.sum()),
+			)
+	print "speedup of batch over original: {:.1f}x".format(results['original'] / results['batch'])
+	start = monotonic()
+	game.dirty = True
+	game.save()
+	print "saving the ledger to the store: {:.3f}s".format(monotonic() - start)
+	start = monotonic()
+	game.leaderboard.rebuild(ledger.names, ledger.totals())
+	print "ranking everyone from scratch: {:.3f}s".format(monotonic() - start)
+	names = random.sample(ledger.names, 1000)
+	start = monotonic()
+	for name in names:
+		game.leaderboard.update(name, ledger.total(name) * random.uniform(0.5, 2))
+		game.leaderboard.rank(name)
+	print "re-ranking a player and looking up their rank: {:.0f}/sec".format(len(names) / (monotonic() - start))
@@ -1,13 +1,26 @@
+from array import array
+from bisect import bisect_left, insort
+import cPickle
 import json
+import os
+import re
+import signal
+import sqlite3
 import time
+import traceback
 
 import gevent
+import gevent.os
+import gevent.pool
 
 from girc import message
 
 from ekimbot.botplugin import ClientPlugin
 from ekimbot.commands import CommandHandler, EkimbotHandler
 
+import recordfile
+from recordfile import RECORD_KEYS, file_identity, parse_record
+
 
 def recursive_to_str(x, encoding):
 	if isinstance(x, unicode):
@@ -20,87 +33,686 @@ def recursive_to_str(x, encoding):
 	return x
 
 
+def split_file(f, start, end, count):
+	"""Split the byte range [start, end) of file f into up to count ranges of roughly equal size,
+	with every range beginning at the start of a line. Returns a list of (start, end)."""
+	bounds = [start]
+	for i in range(1, count):
+		f.seek(start + (end - start) * i / count)
+		f.readline() # skip to the start of the next line
+		bound = f.tell()
+		if bounds[-1] < bound < end:
+			bounds.append(bound)
+	bounds.append(end)
+	return zip(bounds[:-1], bounds[1:])
+
+
+def index_chunk(filepath, file_id, start, end, hostname, quoted_hostname):
+	"""Index the lines in filepath that start in the byte range [start, end),
+	ignoring any partial line at the end. Intended to be run in a worker process.
+
+	Returns (channels, offset, errors), where channels maps target to a ChannelIndex,
+	offset is the end of the last complete line we read and errors is a count of lines we had to drop.
+	"""
+	channels = {}
+	errors = 0
+	offset = start
+	with open(filepath) as f:
+		if file_identity(f) != file_id:
+			raise Exception("Message record file {} was replaced while indexing".format(filepath))
+		f.seek(start)
+		for line in f:
+			if offset >= end or not line.endswith('\n'):
+				break
+			offset += len(line)
+			try:
+				msg = parse_record(line, hostname, quoted_hostname)
+			except Exception:
+				errors += 1
+				continue
+			if msg is None:
+				continue
+			if any(key not in msg for key in RECORD_KEYS):
+				errors += 1
+				continue
+			if msg['target'] not in channels:
+				channels[msg['target']] = ChannelIndex()
+			channels[msg['target']].update(msg['sender'].lower(), msg['received_at'], msg['payload'])
+	return channels, offset, errors
+
+
+def run_in_child(fn, *args):
+	"""Run fn(*args) in a forked child process and return the result.
+	Only the calling greenlet waits on the child, the rest of the process continues as normal.
+	If the calling greenlet is killed, so is the child.
+	The result must be picklable."""
+	read_fd, write_fd = os.pipe()
+	# gevent's fork watches for the child exiting, so that gevent.os.waitpid() only blocks this greenlet
+	pid = gevent.os.fork()
+	if not pid:
+		# child. we must never return from here, or we'll end up running a copy of the bot.
+		try:
+			os.close(read_fd)
+			try:
+				result = True, fn(*args)
+			except BaseException:
+				result = False, traceback.format_exc()
+			data = cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+			while data:
+				data = data[os.write(write_fd, data):]
+		finally:
+			os._exit(0)
+	os.close(write_fd)
+	try:
+		gevent.os.make_nonblocking(read_fd)
+		parts = []
+		while True:
+			part = gevent.os.nb_read(read_fd, 65536)
+			if not part:
+				break
+			parts.append(part)
+	except BaseException:
+		# We've been killed, or couldn't read the result. Either way nothing will want it, so stop the child now
+		# rather than waiting for it to finish, which could take minutes.
+		os.kill(pid, signal.SIGKILL)
+		raise
+	finally:
+		os.close(read_fd)
+		gevent.os.waitpid(pid, 0)
+	if not parts:
+		raise Exception("Child process died without returning a result")
+	success, result = cPickle.loads(''.join(parts))
+	if not success:
+		raise Exception("Error in child process:\n{}".format(result))
+	return result
+
+
+def day_number(timestamp):
+	"""Days since the epoch (UTC) for a timestamp"""
+	return int(timestamp // 86400)
+
+
+def glob_prefix(pattern):
+	"""The literal part of a glob pattern before any wildcard"""
+	for i, c in enumerate(pattern):
+		if c in '*?':
+			return pattern[:i]
+	return pattern
+
+
+def compile_glob(pattern):
+	"""Compile a glob pattern to a regex. We only support * and ?, since [] are common in nicks."""
+	return re.compile(''.join(
+		'.*' if c == '*' else '.' if c == '?' else re.escape(c)
+		for c in pattern
+	) + r'\Z')
+
+
+def prefix_successor(prefix):
+	"""The smallest string greater than every string starting with prefix, or None if there isn't one"""
+	prefix = prefix.rstrip('\xff')
+	if not prefix:
+		return None
+	return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class ChannelIndex(object):
+	"""The first and last messages seen from each nick in a channel,
+	along with how many messages they've sent and on which days.
+
+	Rather than a dict of tuples per nick, this holds parallel arrays indexed by a slot per nick.
+	Nicks are interned, and when a nick's first and last messages are the same message
+	we only hold the text once. We also keep the nicks in a sorted list, for prefix searches.
+	"""
+	# Rough bytes used per nick, not counting the nick and text strings or the days themselves
+	NICK_OVERHEAD = 200
+
+	def __init__(self):
+		self.slots = {}
+		self.sorted_nicks = []
+		self.first_times = array('d')
+		self.last_times = array('d')
+		self.first_texts = []
+		self.last_texts = []
+		self.counts = array('L')
+		# for each slot, a sorted array of day_number()s they were active on
+		self.days = []
+		# rough memory use in bytes
+		self.size = 0
+		# for picking least recently used channels, see SeenIndex
+		self.last_used = 0
+
+	def __len__(self):
+		return len(self.slots)
+
+	def __contains__(self, nick):
+		return nick in self.slots
+
+	def _text_size(self, slot):
+		first, last = self.first_texts[slot], self.last_texts[slot]
+		return len(first) + (0 if last is first else len(last))
+
+	def update(self, nick, timestamp, text, count=1):
+		"""Record a message from nick. count is how much to add to their message count,
+		which should be 0 if this message may have been counted already."""
+		slot = self.slots.get(nick)
+		if slot is None:
+			nick = intern(nick)
+			slot = self.slots[nick] = len(self.first_texts)
+			insort(self.sorted_nicks, nick)
+			self.first_times.append(timestamp)
+			self.last_times.append(timestamp)
+			self.first_texts.append(text)
+			self.last_texts.append(text)
+			self.counts.append(0)
+			self.days.append(array('H'))
+			self.size += self.NICK_OVERHEAD + len(nick) + len(text)
+		else:
+			old_size = self._text_size(slot)
+			# update first unless timestamp is newer
+			if not self.first_times[slot] < timestamp:
+				self.first_times[slot] = timestamp
+				self.first_texts[slot] = text
+			# update last unless timestamp is older
+			if not self.last_times[slot] > timestamp:
+				self.last_times[slot] = timestamp
+				self.last_texts[slot] = text
+			self.size += self._text_size(slot) - old_size
+		self.counts[slot] += count
+		self._add_day(slot, day_number(timestamp))
+
+	def _add_day(self, slot, day):
+		days = self.days[slot]
+		i = bisect_left(days, day)
+		if i == len(days) or days[i] != day:
+			days.insert(i, day)
+			self.size += days.itemsize
+
+	def merge(self, nick, first, last, count, days):
+		"""Merge in an entry for nick, as returned by get()"""
+		self.update(nick, first[0], first[1], count=0)
+		self.update(nick, last[0], last[1], count=count)
+		slot = self.slots[nick]
+		for day in days:
+			self._add_day(slot, day)
+
+	def get(self, nick):
+		"""Returns ((first timestamp, first text), (last timestamp, last text), message count, active days)
+		for nick, or None"""
+		slot = self.slots.get(nick)
+		if slot is None:
+			return None
+		return (
+			(self.first_times[slot], self.first_texts[slot]),
+			(self.last_times[slot], self.last_texts[slot]),
+			self.counts[slot],
+			self.days[slot],
+		)
+
+	def items(self):
+		"""Yields (nick, entry) for each nick, where entry is as per get()"""
+		for nick in self.slots:
+			yield nick, self.get(nick)
+
+	def find(self, pattern):
+		"""Yields (nick, entry) for each nick matching glob pattern, as per items()"""
+		prefix = glob_prefix(pattern)
+		regex = compile_glob(pattern)
+		for i in xrange(bisect_left(self.sorted_nicks, prefix), len(self.sorted_nicks)):
+			nick = self.sorted_nicks[i]
+			if not nick.startswith(prefix):
+				break
+			if regex.match(nick):
+				yield nick, self.get(nick)
+
+
+class SeenIndex(object):
+	"""Maps {channel: ChannelIndex}.
+
+	If memory_limit (in bytes) is given, then whenever enforce_limit() is called and we're over it,
+	the least recently updated channels are moved out of memory into an sqlite database at spill_path.
+	They're still available for lookups from there, and are moved back into memory if they're updated.
+	Stored texts are truncated to max_text_length bytes, if given.
+
+	Changes to the database are only committed by commit(), which should be done alongside
+	saving everything in memory, so the two always match. Since message counts aren't safe to apply twice,
+	a mismatched pair (eg. after a crash between the two) must be discarded.
+	"""
+	# Bump this when changing the database schema. Older databases are discarded.
+	SCHEMA_VERSION = 2
+
+	def __init__(self, max_text_length=None, memory_limit=None, spill_path=None):
+		self.max_text_length = max_text_length
+		self.memory_limit = memory_limit
+		self.spill_path = spill_path
+		self.channels = {}
+		self.spilled = set()
+		self.db = None
+		# incremented on every commit, so we can tell if the database matches what was saved alongside it
+		self.generation = None
+		# incremented on every update, for tracking least recently used
+		self.clock = 0
+		# Even without a limit, open an existing database so we don't lose what was previously spilled
+		if self.memory_limit is not None or os.path.exists(self.spill_path):
+			self.open_db()
+
+	def open_db(self):
+		self.db = sqlite3.connect(self.spill_path)
+		self.db.text_factory = str # our strings are bytes in whatever encoding, don't decode them
+		with self.db:
+			version, = self.db.execute("PRAGMA user_version").fetchone()
+			if version != self.SCHEMA_VERSION:
+				self.db.execute("DROP TABLE IF EXISTS seen")
+			self.db.execute("""
+				CREATE TABLE IF NOT EXISTS seen (
+					channel TEXT, nick TEXT,
+					first_time REAL, first_text TEXT,
+					last_time REAL, last_text TEXT,
+					count INTEGER, days BLOB,
+					PRIMARY KEY (channel, nick)
+				)
+			""")
+			self.db.execute("CREATE TABLE IF NOT EXISTS generation (generation INTEGER)")
+			if not self.db.execute("SELECT * FROM generation").fetchall():
+				self.db.execute("INSERT INTO generation VALUES (0)")
+			self.db.execute("PRAGMA user_version = {:d}".format(self.SCHEMA_VERSION))
+		self.generation, = self.db.execute("SELECT generation FROM generation").fetchone()
+		self.spilled = set(channel for channel, in self.db.execute("SELECT DISTINCT channel FROM seen"))
+
+	def commit(self):
+		"""Commit changes to the database, returning the new generation"""
+		if self.db is None:
+			return None
+		self.generation += 1
+		self.db.execute("UPDATE generation SET generation = ?", (self.generation,))
+		self.db.commit()
+		return self.generation
+
+	def clear_spilled(self):
+		"""Discard everything that was spilled to disk"""
+		if self.db is None:
+			return
+		self.db.execute("DELETE FROM seen")
+		self.spilled = set()
+
+	def __contains__(self, channel):
+		return channel in self.channels or channel in self.spilled
+
+	def __iter__(self):
+		"""Iterates over all channel names, in memory or not"""
+		return iter(set(self.channels) | self.spilled)
+
+	@property
+	def size(self):
+		return sum(index.size for index in self.channels.values())
+
+	def _channel(self, channel):
+		"""Get the in-memory index for channel, creating it or bringing it back from disk if needed,
+		and mark it as recently used"""
+		index = self.channels.get(channel)
+		if index is None:
+			index = self.unspill(channel) if channel in self.spilled else ChannelIndex()
+			self.channels[channel] = index
+		self.clock += 1
+		index.last_used = self.clock
+		return index
+
+	def _truncate(self, text):
+		if self.max_text_length is None:
+			return text
+		return text[:self.max_text_length]
+
+	def update(self, channel, nick, timestamp, text, count=1):
+		self._channel(channel).update(nick, timestamp, self._truncate(text), count)
+
+	def merge(self, channel, nick, entry):
+		"""Merge in an entry for nick in channel, as returned by get()"""
+		(first_time, first_text), (last_time, last_text), count, days = entry
+		self._channel(channel).merge(
+			nick, (first_time, self._truncate(first_text)), (last_time, self._truncate(last_text)), count, days,
+		)
+
+	def get(self, channel, nick):
+		"""As ChannelIndex.get()"""
+		if channel in self.channels:
+			return self.channels[channel].get(nick)
+		if channel in self.spilled:
+			for row in self.db.execute(
+				"SELECT first_time, first_text, last_time, last_text, count, days FROM seen WHERE channel = ? AND nick = ?",
+				(channel, nick),
+			):
+				return self._row_entry(row)
+		return None
+
+	def find(self, pattern, channels):
+		"""Yields (channel, nick, entry) for every nick matching glob pattern in the given channels,
+		with entry as per get()"""
+		for channel in channels:
+			if channel in self.channels:
+				for nick, entry in self.channels[channel].find(pattern):
+					yield channel, nick, entry
+			elif channel in self.spilled:
+				# use the primary key to only look at nicks with the right prefix, then filter the rest in python
+				prefix = glob_prefix(pattern)
+				successor = prefix_successor(prefix)
+				regex = compile_glob(pattern)
+				query = "SELECT nick, first_time, first_text, last_time, last_text, count, days FROM seen WHERE channel = ? AND nick >= ?"
+				params = (channel, prefix)
+				if successor is not None:
+					query += " AND nick < ?"
+					params += (successor,)
+				for row in self.db.execute(query, params):
+					if regex.match(row[0]):
+						yield channel, row[0], self._row_entry(row[1:])
+
+	def _row_entry(self, row):
+		first_time, first_text, last_time, last_text, count, days = row
+		return (first_time, first_text), (last_time, last_text), count, array('H', str(days))
+
+	def enforce_limit(self):
+		"""If we're over memory_limit, spill least recently used channels until we aren't"""
+		if self.memory_limit is None:
+			return
+		size = self.size
+		for channel, index in sorted(self.channels.items(), key=lambda item: item[1].last_used):
+			if size <= self.memory_limit:
+				break
+			size -= index.size
+			self.spill(channel)
+
+	def spill(self, channel):
+		index = self.channels.pop(channel)
+		self.db.executemany(
+			"INSERT INTO seen VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+			(
+				(channel, nick) + first + last + (count, buffer(days.tostring()))
+				for nick, (first, last, count, days) in index.items()
+			),
+		)
+		self.spilled.add(channel)
+
+	def unspill(self, channel):
+		"""Remove channel from the database and return it as a ChannelIndex"""
+		index = ChannelIndex()
+		for row in self.db.execute(
+			"SELECT nick, first_time, first_text, last_time, last_text, count, days FROM seen WHERE channel = ?", (channel,),
+		):
+			index.merge(row[0], *self._row_entry(row[1:]))
+		self.db.execute("DELETE FROM seen WHERE channel = ?", (channel,))
+		self.spilled.discard(channel)
+		return index
+
+	def usage(self):
+		"""Returns {channel: (number of nicks, rough bytes used in memory or None if spilled)}"""
+		usage = {channel: (len(index), index.size) for channel, index in self.channels.items()}
+		if self.spilled:
+			for channel, count in self.db.execute("SELECT channel, COUNT(*) FROM seen GROUP BY channel"):
+				usage[channel] = count, None
+		return usage
+
+
+def format_time(timestamp, format='%Y-%m-%d %H:%M:%SZ'):
+	return time.strftime(format, time.gmtime(timestamp))
+
+
+def summarize_nick(nick, entries):
+	"""Describe a nick's activity, given a list of (channel, entry) for each channel they've been seen in,
+	with entry as per ChannelIndex.get()"""
+	first_channel, first_entry = min(entries, key=lambda item: item[1][0][0])
+	last_channel, last_entry = max(entries, key=lambda item: item[1][1][0])
+	first_time, _ = first_entry[0]
+	last_time, last_text = last_entry[1]
+	count = sum(entry[2] for channel, entry in entries)
+	days = set()
+	for channel, entry in entries:
+		days.update(entry[3])
+	return "{nick} was last seen in {last_channel} at [{last_time}] <{nick}> {last_text} | First seen in {first_channel} at [{first_time}] | {count} messages on {days} different days in {channels} channels".format(
+		nick=nick,
+		last_channel=last_channel, last_time=format_time(last_time), last_text=last_text,
+		first_channel=first_channel, first_time=format_time(first_time),
+		count=count, days=len(days), channels=len(entries),
+	)
+
+
 class NickSeen(ClientPlugin):
 	"""Maintains an index of when a nick was first or last seen based on logs.
 	Matches on client hostname and channel it was requested in.
 	"""
 	name = 'nickseen'
 
-	# maps {channel: {nick: (timestamp, text)}}
-	first_index = None
-	last_index = None
+	# a SeenIndex of the first and last message of each nick in each channel
+	seen = None
 
 	# indexer is either a greenlet if we're still indexing, or None if we've finished indexing.
 	indexer = None
+	# the pool of greenlets waiting on worker processes, while index_parallel() is running
+	index_pool = None
+	checkpointer = None
+	# follower is a greenlet reading new lines from the record file as they're written, see follow()
+	follower = None
+
+	# Reads the record file and the segments rotated out of it, and tracks how far we've got. See recordfile.RecordReader.
+	reader = None
+	# Set while we're merging chunks indexed in parallel, which have been counted but aren't
+	# covered by the reader's offset yet. A checkpoint taken then would count them again on restart, so we don't take one.
+	merging = False
+
+	CHECKPOINT_VERSION = 4
 
 	# config defaults
 	defaults = {
 		'batch_size': 1000, # how many lines for indexer to process before yielding
-		'partial_line_poll': 0.1, # weird, see code for details
+		# Once indexed, keep reading new lines from the record file as they're written. This picks up
+		# messages recorded by other processes sharing the file, not just our own client's.
+		'follow': True,
+		# With follow, how often to check the file when we can't be notified of changes.
+		# We start at the min interval and back off to the max while nothing's happening.
+		# Even when we can be notified, we check every max interval just in case.
+		'follow_min_interval': 0.1,
+		'follow_max_interval': 10,
+		'checkpoint_file': None, # None means FILENAME.nickseen.HOSTNAME
+		'checkpoint_interval': 300, # how often to save a checkpoint, in seconds
+		# number of processes to split initial indexing between. 0 to index in this process.
+		# Only used if the record file is in the json format.
+		'index_workers': 0,
+		# don't bother splitting up initial indexing into chunks smaller than this many bytes
+		'min_chunk_size': 16 * 1024 * 1024,
+		'max_text_length': None, # if set, only store this many bytes of each message
+		# if set, keep index memory use under this many bytes (roughly)
+		# by moving the least active channels to a database on disk
+		'memory_limit': None,
+		'spill_file': None, # None means CHECKPOINT_FILE.spill
+		'max_seen_results': 5, # how many nicks to list when a seen search matches more than one
 	}
 
+	@property
+	def checkpoint_path(self):
+		if self.config.checkpoint_file is not None:
+			return self.config.checkpoint_file
+		return '{}.nickseen.{}'.format(self.config.filename, self.client.hostname)
+
 	def init(self):
-		self.first_index = {}
-		self.last_index = {}
+		self.seen = SeenIndex(
+			max_text_length=self.config.max_text_length,
+			memory_limit=self.config.memory_limit,
+			spill_path=(
+				self.config.spill_file if self.config.spill_file is not None
+				else '{}.spill'.format(self.checkpoint_path)
+			),
+		)
+		self.reader = recordfile.RecordReader(
+			self.config.filename, self.client.hostname, self.logger,
+			batch_size=self.config.batch_size, on_batch=self.seen.enforce_limit,
+		)
 		self.indexer = gevent.spawn(self.index, self.config.filename)
+		self.checkpointer = gevent.spawn(self.checkpoint_loop)
 
 	def cleanup(self):
+		if self.checkpointer:
+			self.checkpointer.kill()
 		if self.indexer:
 			self.indexer.kill()
+		if self.index_pool:
+			self.index_pool.kill() # which kills their worker processes too, see run_in_child()
+		if self.follower:
+			self.follower.kill()
+		try:
+			self.save_checkpoint()
+		except Exception:
+			self.logger.warning("Failed to save checkpoint", exc_info=True)
+		self.reader.close()
 
 	def index(self, filepath):
 		"""We read all the historic logs, then mark the indexing process as complete.
 		Note that new messages may interject in that time, so we are careful to compare
 		timestamps on messages. This also prevents repeated messages (that are both written
 		to the log and processed by this module upon receipt) from messing with things since
-		it makes the indexes CRDTs."""
-		stop = False
-		with open(filepath) as f:
-			for i, line in enumerate(f):
-				if stop:
-					# Under a weird edge case, we should stop because we know we caught up at least once
-					break
-				# Every so often, let other things run, as this is cpu-intensive.
-				if i % self.config.batch_size == 0:
-					gevent.idle()
-				# Parse
-				if not line.endswith('\n'):
-					# partial line at end of file. we wait to see it completed with a dumb poll,
-					# too much of an edge case for anything smarter.
-					# We then set stop so we don't keep reading since we know we're up to date as of now,
-					# but there might be more waiting by the time we check again.
-					stop = True
-					while '\n' not in line:
-						gevent.sleep(self.config.partial_line_poll)
-						line += f.read(1024)
-					line, _ = line.split('\n', 1) # discard anything additional
-				try:
-					msg = json.loads(line)
-				except Exception:
-					self.logger.info('Failed to parse line {} from message record file {}, dropping'.format(i, filepath), exc_info=True)
-					continue
-				encoding = msg.get('_encoding', 'utf-8')
-				msg = recursive_to_str(msg, encoding)
-				# filter for privmsgs from this hostname only
-				if msg['command'] not in ('PRIVMSG', 'NOTICE') or msg['hostname'] != self.client.hostname:
-					continue
-				# check it has the expected keys, if not then log and ignore
-				good = True
-				for key in ('target', 'sender', 'payload', 'received_at'):
-					if key not in msg:
-						self.logger.info("Missing required key {} in line {} from message record file {}, dropping".format(key, i, filepath))
-						good = False
-						break
-				if not good:
-					continue
-				# update the indices for the channel
-				self.update_indices(msg['target'], msg['sender'], msg['received_at'], msg['payload'])
+		it makes the indexes CRDTs.
+		The same property means it's safe to start from a checkpoint of the indexes and only
+		read the file from where the checkpoint left off."""
+		checkpoint = recordfile.load_checkpoint(self.checkpoint_path, self.CHECKPOINT_VERSION, self.logger)
+		if checkpoint is not None and checkpoint['spill_generation'] != self.seen.generation:
+			self.logger.info("Spilled index at {} doesn't match checkpoint, indexing from scratch".format(self.seen.spill_path))
+			checkpoint = None
+		if self.reader.open(checkpoint and checkpoint['position']):
+			# Messages may have arrived already, so merge rather than replace.
+			# Merging yields, and until it's done our indexes are behind the reader, so hold off checkpoints.
+			self.merging = True
+			self.merge_channels(checkpoint['channels'])
+			self.merging = False
+		else:
+			# Anything spilled to disk was counted in message counts that we're about to count again
+			self.seen.clear_spilled()
+			# Older records may have been rotated out of the file, so start with them
+			for msg in self.reader.read_segments():
+				self.index_message(msg)
+		# The workers split the file at line boundaries, so this only works for JSON files
+		if self.config.index_workers and self.reader.format == 'json':
+			self.index_parallel(filepath)
+		# any partial line at the end will be picked up by the follower
+		for msg in self.reader.read():
+			self.index_message(msg)
 		# We're done, clear self.indexer to indicate this
 		if self.indexer != gevent.getcurrent():
 			self.logger.warning("Indexer finished, but self.indexer is not us? Us: {!r}, Them: {!r}".format(gevent.getcurrent(), self.indexer))
 		else:
 			self.logger.info("Indexer finished")
 			self.indexer = None
+		self.seen.enforce_limit()
+		self.log_usage()
+		if self.config.follow:
+			self.follower = gevent.spawn(self.follow)
+
+	def index_parallel(self, filepath):
+		"""Index the record file from the reader's offset up to its current size by splitting it into chunks
+		and indexing them in worker processes, then merging the results.
+		Moves the reader on to how far we got."""
+		f = self.reader.file
+		start_offset = self.reader.offset
+		end = os.fstat(f.fileno()).st_size
+		chunk_count = min(
+			# more chunks than workers, so one slow chunk doesn't hold everything up
+			self.config.index_workers * 4,
+			(end - start_offset) / self.config.min_chunk_size,
+		)
+		if chunk_count < 2:
+			return # not worth it
+		chunks = split_file(f, start_offset, end, chunk_count)
+		self.logger.info("Indexing {} bytes of {} in {} chunks with {} workers".format(
+			end - start_offset, filepath, len(chunks), self.config.index_workers,
+		))
+		file_id = self.reader.file_id
+		quoted_hostname = json.dumps(self.client.hostname)
+		def run_chunk(chunk):
+			start, end = chunk
+			return start, run_in_child(
+				index_chunk, filepath, file_id, start, end, self.client.hostname, quoted_hostname,
+			)
+
+		# We spawn the chunks ourselves rather than with imap, so nothing else is left spawning them if we're killed.
+		# If we are, or a chunk fails, we kill the rest rather than leave their processes running.
+		pool = self.index_pool = gevent.pool.Pool(self.config.index_workers)
+		try:
+			greenlets = [pool.spawn(run_chunk, chunk) for chunk in chunks]
+			results = dict(greenlet.get() for greenlet in greenlets)
+		finally:
+			pool.kill()
+			self.index_pool = None
+		errors = sum(chunk_errors for channels, offset, chunk_errors in results.values())
+		if errors:
+			self.logger.info("Dropped {} unparseable or incomplete lines from message record file {}".format(errors, filepath))
+		# Merging yields, so checkpoints must wait until the reader's offset is updated to match.
+		# If we're killed part way through, merging stays set so cleanup() doesn't save a checkpoint either.
+		self.merging = True
+		for channels, offset, chunk_errors in results.values():
+			self.merge_channels(channels)
+		# Only the last chunk can stop early, on a partial line. Pick up from there.
+		self.reader.offset = results[chunks[-1][0]][1]
+		self.merging = False
+
+	def merge_channels(self, channels):
+		"""Merge a {channel: ChannelIndex} into our index. Since first/last take the min/max
+		and the rest are counts and sets, this is safe to do in any order."""
+		i = 0
+		for channel, index in channels.items():
+			channel = self.client.normalize_channel(channel)
+			for nick, entry in index.items():
+				if i % self.config.batch_size == 0:
+					gevent.idle()
+					self.seen.enforce_limit()
+				i += 1
+				self.seen.merge(channel, nick, entry)
+
+	def index_message(self, msg):
+		self.update_indices(msg['target'], msg['sender'], msg['received_at'], msg['payload'])
+
+	def catch_up(self):
+		"""Index anything that has been written to the record file since we last read it"""
+		for msg in self.reader.read():
+			self.index_message(msg)
+
+	def follow(self):
+		"""Index new lines from the record file as they're written, following it if it's replaced"""
+		try:
+			for msg in self.reader.follow(self.config.follow_min_interval, self.config.follow_max_interval):
+				self.index_message(msg)
+		except Exception:
+			self.logger.exception("Failed to follow message record file {}, falling back to reading it every checkpoint".format(self.config.filename))
+			self.follower = None
+
+	def checkpoint_loop(self):
+		while True:
+			gevent.sleep(self.config.checkpoint_interval)
+			try:
+				# Once we've finished indexing, if we aren't following the file then new messages
+				# only reach us via on_message. So that the checkpoint's offset keeps up,
+				# we need to read them from the file too.
+				if not self.indexer and not self.follower:
+					self.catch_up()
+				self.seen.enforce_limit()
+				self.save_checkpoint()
+			except Exception:
+				self.logger.warning("Failed to save checkpoint", exc_info=True)
+
+	def save_checkpoint(self):
+		"""Save our indexes and how far into the file they cover, so we can resume from there on restart"""
+		if self.merging:
+			return # our indexes are ahead of or behind the reader, see index() and index_parallel()
+		position = self.reader.position()
+		if position is None:
+			return # nowhere to resume from yet, see RecordReader.position()
+		checkpoint = {
+			'version': self.CHECKPOINT_VERSION,
+			'position': position,
+			# spilled channels are saved to disk by this commit, so we only need the in-memory ones
+			'spill_generation': self.seen.commit(),
+			'channels': self.seen.channels,
+		}
+		# Pickling a big index takes seconds, and holds the GIL so a thread wouldn't help.
+		# A child process gets its own copy-on-write snapshot of everything as of now to pickle,
+		# while we carry on and only wait for it to finish.
+		run_in_child(recordfile.save_checkpoint, self.checkpoint_path, checkpoint)
+		self.logger.debug("Saved checkpoint at offset {} of {}".format(position['offset'], self.config.filename))
 
 	@EkimbotHandler(
 		no_ignore=True, master=None, # always run, even on ignored nicks or if not master
@@ -108,19 +720,42 @@ class NickSeen(ClientPlugin):
 		target=lambda c, v: not c.matches_nick(v), # exclude PMs
 	)
 	def on_message(self, client, msg):
-		self.update_indices(msg.target, msg.sender, msg.received_at, msg.payload)
-
-	def update_indices(self, channel, nick, timestamp, text):
-		channel = self.client.normalize_channel(channel)
-		nick = nick.lower()
-		first = self.first_index.setdefault(channel, {})
-		last = self.last_index.setdefault(channel, {})
-		# update first unless nick is already present and timestamp is older
-		if not (nick in first and first[nick][0] < timestamp):
-			first[nick] = timestamp, text
-		# update last unless nick is already present and timestamp is newer
-		if not (nick in last and last[nick][0] > timestamp):
-			last[nick] = timestamp, text
+		# We'll also read this message from the record file later, so only count it then
+		self.update_indices(msg.target, msg.sender, msg.received_at, msg.payload, count=0)
+
+	def update_indices(self, channel, nick, timestamp, text, count=1):
+		self.seen.update(self.client.normalize_channel(channel), nick.lower(), timestamp, text, count)
+
+	def log_usage(self):
+		usage = self.seen.usage()
+		in_memory = [(size, channel) for channel, (count, size) in usage.items() if size is not None]
+		self.logger.info("Seen index is using ~{:.1f}MB for {} channels, with {} more spilled to disk. Largest: {}".format(
+			sum(size for size, channel in in_memory) / 1024. / 1024, len(in_memory), len(usage) - len(in_memory),
+			', '.join("{} (~{}KB)".format(channel, size / 1024) for size, channel in sorted(in_memory, reverse=True)[:5]),
+		))
+
+	@CommandHandler("seenstats", 0)
+	def seenstats(self, msg, *args):
+		"""Show how much memory the seen index is using
+
+		Give a channel to see just that channel, otherwise shows the total.
+		"""
+		usage = self.seen.usage()
+		if args:
+			channel = self.client.normalize_channel(args[0])
+			if channel not in usage:
+				self.reply(msg, "I don't know of any channel called {!r}".format(channel))
+				return
+			count, size = usage[channel]
+			self.reply(msg, "{}: {} nicks, {}".format(
+				channel, count, "spilled to disk" if size is None else "~{}KB in memory".format(size / 1024),
+			))
+			return
+		in_memory = [size for count, size in usage.values() if size is not None]
+		self.reply(msg, "{} nicks in {} channels. ~{:.1f}MB in memory for {} channels, {} spilled to disk".format(
+			sum(count for count, size in usage.values()), len(usage),
+			sum(in_memory) / 1024. / 1024, len(in_memory), len(usage) - len(in_memory),
+		))
 
 	@CommandHandler("firstseen", 1)
 	def firstseen(self, msg, *args):
@@ -128,7 +763,7 @@ class NickSeen(ClientPlugin):
 
 		If asked via PM, you must specify the channel: firstseen CHANNEL NICK
 		"""
-		self._seen(msg, args, self.first_index, 'firstseen')
+		self._seen(msg, args, 0, 'firstseen')
 
 	@CommandHandler("lastseen", 1)
 	def lastseen(self, msg, *args):
@@ -136,9 +771,10 @@ class NickSeen(ClientPlugin):
 
 		If asked via PM, you must specify the channel: lastseen CHANNEL NICK
 		"""
-		self._seen(msg, args, self.last_index, 'lastseen')
+		self._seen(msg, args, 1, 'lastseen')
 
-	def _seen(self, msg, args, index, commandname):
+	def _seen(self, msg, args, which, commandname):
+		"""which is 0 for first seen, 1 for last seen"""
 		if self.client.matches_nick(msg.target):
 			# PM, require channel
 			channel, args = args[0], args[1:]
@@ -160,17 +796,127 @@ class NickSeen(ClientPlugin):
 		if self.indexer:
 			self.reply(msg, "I'm still indexing existing logs, the following answer may be incorrect:")
 
-		if channel not in index:
+		if channel not in self.seen:
 			self.reply(msg, "I don't know of any channel called {!r}".format(channel))
 			return
-		index = index[channel]
 
-		if nick.lower() not in index:
+		entry = self.seen.get(channel, nick.lower())
+		if entry is None:
 			self.reply(msg, "I've never heard of this {!r} person. Are you sure they're real?".format(nick))
 			return
-		timestamp, text = index[nick.lower()]
+		timestamp, text = entry[which]
 
 		self.reply(msg, "[{timestr}] <{nick}> {text}".format(
-			nick=nick, text=text,
-			timestr=time.strftime('%Y-%m-%d %H:%M:%SZ', time.gmtime(timestamp))
+			nick=nick, text=text, timestr=format_time(timestamp),
 		))
+
+	@CommandHandler("seen", 1)
+	def seen_command(self, msg, *args):
+		"""Search for nicks across channels
+
+		Give a nick to find where they were last seen, and a summary of their activity.
+		The nick may contain * and ? wildcards, or you can limit the search to one channel
+		with "seen NICK CHANNEL".
+		"""
+		if len(args) > 2:
+			self.reply(msg, "Too many args. Format is 'seen NICK [CHANNEL]'")
+			return
+		pattern = args[0].lower()
+		if len(args) > 1:
+			channels = [self.client.normalize_channel(args[1])]
+			if channels[0] not in self.seen:
+				self.reply(msg, "I don't know of any channel called {!r}".format(channels[0]))
+				return
+		else:
+			channels = list(self.seen)
+
+		if self.indexer:
+			self.reply(msg, "I'm still indexing existing logs, the following answer may be incorrect:")
+
+		# {nick: [(channel, entry)]}
+		results = {}
+		for channel, nick, entry in self.seen.find(pattern, channels):
+			results.setdefault(nick, []).append((channel, entry))
+
+		if not results:
+			self.reply(msg, "I've never seen anyone matching {!r}".format(args[0]))
+		elif len(results) == 1:
+			(nick, entries), = results.items()
+			self.reply(msg, summarize_nick(nick, entries))
+		else:
+			# sort by most recently seen
+			matches = sorted(
+				(max((entry[1][0], channel) for channel, entry in entries), nick)
+				for nick, entries in results.items()
+			)[::-1]
+			shown = matches[:self.config.max_seen_results]
+			self.reply(msg, "{} nicks match: {}{}".format(
+				len(matches),
+				", ".join(
+					"{} ({}, {})".format(nick, channel, format_time(timestamp, '%Y-%m-%d'))
+					for (timestamp, channel), nick in shown
+				),
+				" and {} more".format(len(matches) - len(shown)) if len(matches) > len(shown) else "",
+			))
+
+
+if __name__ == '__main__':
+	# Benchmark indexing speed over a synthetic record file in the same format RecordPlugin writes,
+	# with traffic from several networks and a realistic mix of commands.
+	# Args are: number of lines (default 100000), path for the record file (default a temp file)
+	import random
+	import sys
+	import tempfile
+
+	from monotonic import monotonic
+
+	line_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	if len(sys.argv) > 2:
+		filepath = sys.argv[2]
+	else:
+		_, filepath = tempfile.mkstemp(suffix='.records')
+
+	hostnames = ['irc.example.com', 'irc.chat.twitch.tv', 'chat.freenode.net']
+	commands = ['PRIVMSG'] * 10 + ['NOTICE', 'JOIN', 'PART', 'QUIT', 'MODE', 'NICK'] + ['PING'] * 2
+	nicks = ['user{}'.format(i) for i in range(500)]
+	channels = ['#channel{}'.format(i) for i in range(10)]
+	with open(filepath, 'w') as f:
+		for i in xrange(line_count):
+			nick = random.choice(nicks)
+			command = random.choice(commands)
+			target = random.choice(channels)
+			payload = ' '.join(random.choice(['hello', 'world', 'foo', 'bar', 'PRIVMSG', '\xe2\x98\x83']) for _ in range(8))
+			f.write(json.dumps({
+				'command': command, 'params': [target, payload], 'sender': nick,
+				'user': nick, 'host': '{}.example.net'.format(nick), 'tags': {},
+				'target': target, 'payload': payload, 'received_at': 1500000000 + i * 0.1,
+				'hostname': random.choice(hostnames), 'port': 6697, 'ssl': True,
+				'bot_hostname': 'bothost', 'bot_pid': 1234, 'bot_nick': 'ekimbot',
+			}) + '\n')
+
+	hostname = hostnames[0]
+	quoted_hostname = json.dumps(hostname)
+
+	def old_parse(line):
+		msg = recursive_to_str(json.loads(line), 'utf-8')
+		if msg['command'] not in ('PRIVMSG', 'NOTICE') or msg['hostname'] != hostname:
+			return None
+		return msg
+
+	def new_parse(line):
+		return parse_record(line, hostname, quoted_hostname)
+
+	results = {}
+	for name, parse in (('full decode', old_parse), ('prefilter', new_parse)):
+		start = monotonic()
+		with open(filepath) as f:
+			kept = sum(1 for line in f if parse(line) is not None)
+		elapsed = monotonic() - start
+		results[name] = elapsed
+		print "{}: {} lines in {:.2f}s ({:.0f} lines/sec), kept {}".format(
+			name, line_count, elapsed, line_count / elapsed, kept,
+		)
+	print "speedup: {:.1f}x".format(results['full decode'] / results['prefilter'])
+
+	if len(sys.argv) <= 2:
+		os.remove(filepath)
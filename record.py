@@ -1,32 +1,469 @@
-
+import errno
 import json
 import os
 import socket
-import weakref
+import time
+
+import gevent
+import gevent.pool
+import gevent.queue
 
 from girc import message
 
 from ekimbot.botplugin import ClientPlugin
-from ekimbot.commands import EkimbotHandler
+from ekimbot.commands import CommandHandler, EkimbotHandler
+
+import recordfile
+
+
+# Public attributes of messages that we don't record
+EXCLUDED_ATTRS = ('client', 'extra', 'since_received')
+
+# {message class: tuple of attribute names}, see attribute_plan()
+_attribute_plans = {}
+
+_utf8_encoder = json.JSONEncoder(default=str)
+_latin1_encoder = json.JSONEncoder(default=str, encoding='latin-1')
+
+
+def is_recorded(attr):
+	return not attr.startswith('_') and attr not in EXCLUDED_ATTRS
+
+
+def attribute_plan(cls):
+	"""Returns the attributes of message class cls that we might record: everything public
+	that isn't a method. Computed once per class, since dir() is expensive."""
+	plan = _attribute_plans.get(cls)
+	if plan is None:
+		plan = _attribute_plans[cls] = tuple(
+			attr for attr in dir(cls)
+			if is_recorded(attr) and not callable(getattr(cls, attr, None))
+		)
+	return plan
+
+
+def message_values(msg):
+	"""Returns {attr: value} for all of msg's public, non-callable attributes, except EXCLUDED_ATTRS.
+	This gives the same result as going through dir(msg), but only looks at the class once."""
+	values = {}
+	for attr in attribute_plan(type(msg)):
+		value = getattr(msg, attr)
+		if not callable(value):
+			values[attr] = value
+	# attributes set on the instance don't show up on the class
+	for attr, value in getattr(msg, '__dict__', {}).items():
+		if attr not in values and is_recorded(attr) and not callable(value):
+			values[attr] = value
+	return values
+
+
+def encode_record(values):
+	"""Encode values as a JSON object.
+
+	JSON forces us to pick an encoding for byte strings. utf-8 is almost certainly the more correct encoding
+	for being able to read the data sensically, but some fields may have bytes that aren't valid utf-8.
+	Those fields we encode with latin-1, which can (probably incorrectly) encode all possible byte strings,
+	and list them in the "_latin1" field so readers can get the original bytes back.
+	"""
+	# Almost every record is fine as utf-8, so try encoding it in one go first
+	try:
+		return _utf8_encoder.encode(values)
+	except UnicodeDecodeError:
+		pass
+	fields = []
+	latin1 = []
+	for key, value in values.items():
+		try:
+			encoded = _utf8_encoder.encode(value)
+		except UnicodeDecodeError:
+			encoded = _latin1_encoder.encode(value)
+			latin1.append(key)
+		fields.append('{}: {}'.format(_utf8_encoder.encode(key), encoded))
+	if latin1:
+		fields.append('"_latin1": {}'.format(_utf8_encoder.encode(sorted(latin1))))
+	return '{{{}}}'.format(', '.join(fields))
+
+
+class JSONRecordEncoder(object):
+	"""Encodes records as newline-seperated JSON objects. See recordfile.BinaryRecordEncoder for the alternative."""
+	def start(self):
+		return ''
+
+	def encode(self, values, context={}):
+		values = values.copy()
+		values.update(context)
+		return '{}\n'.format(encode_record(values))
+
+
+# {format name: encoder class}
+FORMATS = {
+	'json': JSONRecordEncoder,
+	'binary': recordfile.BinaryRecordEncoder,
+}
+
+
+class RecordWriter(object):
+	"""Writes records to a file from a queue, so that recording a message never waits on the disk.
+
+	A writer greenlet takes everything waiting in the queue and writes it as one batch.
+	The actual write, flush and fsync happen in the hub's threadpool, so a slow disk doesn't block the event loop.
+	We flush after flush_messages records have been written since the last flush, or once the oldest
+	unflushed record is flush_interval seconds old, whichever comes first. If fsync is set,
+	each flush is followed by an fsync. flush_messages=1 means every record is flushed as soon as it's written.
+
+	If rotate_size or rotate_interval are set, once the file is at least that many bytes or has been written to
+	for that many seconds, we rotate it into a segment (see recordfile) before writing the next batch,
+	and compress the segment with the named compression in the background if compress is set.
+	Since we track offsets for the segment's index ourselves, rotation assumes we're the only process
+	writing to the file.
+
+	Records are written in the given format, one of FORMATS. The encoding happens in the writer greenlet,
+	since the binary format needs to encode records in the order they're written.
+
+	If writing fails (eg. the disk is full), we log it, wait and reopen the file, then write everything since
+	the last successful flush again, backing off up to MAX_RETRY_INTERVAL between attempts. Meanwhile records
+	keep queuing, up to queue_limit (None for no limit), after which new ones are dropped and counted.
+	A JSON file we don't rotate may be shared with other writers, so we can't cut off what was partially written
+	before the failure. Instead we end it with a newline, and the records we write again may be duplicated.
+	"""
+	MAX_RETRY_INTERVAL = 60
+
+	def __init__(self, filepath, flush_messages, flush_interval, fsync,
+	             rotate_size=None, rotate_interval=None, compress=None, index_interval=60, format='json',
+	             queue_limit=None, retry_interval=1, logger=None):
+		if format not in FORMATS:
+			raise ValueError("Unknown format {!r}, must be one of: {}".format(format, ', '.join(FORMATS)))
+		existing_format = recordfile.file_format(filepath)
+		if existing_format not in (None, format):
+			raise ValueError("{} is already in {} format, not {}. Move it aside to start a new file.".format(
+				filepath, existing_format, format,
+			))
+		self.encoder = FORMATS[format]()
+		self.filepath = filepath
+		self.flush_messages = flush_messages
+		self.flush_interval = flush_interval
+		self.fsync = fsync
+		self.rotate_size = rotate_size
+		self.rotate_interval = rotate_interval
+		if compress is not None and compress not in recordfile.COMPRESSORS:
+			raise ValueError("Unknown compression {!r}, must be one of: {}".format(compress, ', '.join(recordfile.COMPRESSORS)))
+		self.compress = compress
+		self.index_interval = index_interval
+		# Binary files and rotated files can only have one writer, us. So after a failed write we can
+		# cut off anything partially written. Otherwise someone else may have written after it.
+		self.exclusive = format == 'binary' or rotate_size is not None or rotate_interval is not None
+		self.retry_interval = retry_interval
+		self.logger = logger
+		self.open()
+		self.queue = gevent.queue.Queue(queue_limit)
+		# number of plugins using this writer, see RecordPlugin.fileobjs
+		self.users = 0
+		# records written since the last flush, as they were queued, in case we need to write them again
+		self.unflushed = []
+		# time the oldest unflushed record was queued
+		self.oldest = None
+		self.closing = False
+		# stats
+		self.written = 0
+		self.batches = 0
+		self.flushes = 0
+		self.max_queue = 0
+		self.total_latency = 0 # summed over all records, from being queued to being written (and flushed, if flushed)
+		self.max_latency = 0
+		self.rotations = 0
+		self.dropped = 0
+		self.failures = 0
+		self.last_error = None
+		self.failing_since = None # while writes are failing, when they started failing
+		self.compressions = gevent.pool.Group()
+		self.writer = gevent.spawn(self.run)
+
+	def open(self):
+		self.file = open(self.filepath, 'a')
+		self.offset = os.fstat(self.file.fileno()).st_size
+		self.opened_at = time.time()
+		self.index = recordfile.SegmentIndex(self.index_interval, partial=self.offset > 0)
+		self.start()
+
+	def start(self):
+		"""Carry on writing from the end of the file. Whatever's there is taken to be safely on disk."""
+		self.flushed_offset = self.offset
+		# The binary format has a header that resets it, so an existing file can be continued after one.
+		# This is small, so we don't mind writing it here.
+		header = self.encoder.start()
+		self.file.write(header)
+		self.offset += len(header)
+
+	def write(self, values, received_at=None, context={}):
+		"""Queue a record of values (plus context, which has priority) to be written.
+		received_at is the time of the record, for the segment index."""
+		queued = time.time()
+		try:
+			self.queue.put_nowait((queued, values, context, queued if received_at is None else received_at))
+		except gevent.queue.Full:
+			if not self.dropped and self.logger:
+				self.logger.warning("Record queue for {} is full, dropping records".format(self.filepath))
+			self.dropped += 1
+			return
+		self.max_queue = max(self.max_queue, self.queue.qsize())
+
+	def should_rotate(self):
+		if not self.offset:
+			return False # never rotate out an empty file
+		return (
+			(self.rotate_size is not None and self.offset >= self.rotate_size)
+			or (self.rotate_interval is not None and time.time() >= self.opened_at + self.rotate_interval)
+		)
+
+	def rotate(self):
+		"""Close the current file (flushing it) and move it to a new segment, then start a new file"""
+		segment_path = recordfile.new_segment_path(
+			self.filepath, self.opened_at if self.index.first is None else self.index.first,
+		)
+		gevent.get_hub().threadpool.apply(self._rotate, (segment_path,))
+		self.rotations += 1
+		# rotating flushed everything written so far. If opening the new file fails, recover() starts it.
+		if self.unflushed:
+			self.flushes += 1
+		self.unflushed = []
+		self.oldest = None
+		self.offset = self.flushed_offset = 0
+		self.index = recordfile.SegmentIndex(self.index_interval)
+		self.open()
+		if self.compress:
+			self.compressions.spawn(gevent.get_hub().threadpool.apply, recordfile.compress_segment, (segment_path, self.compress))
+
+	def _rotate(self, segment_path):
+		"""Runs in a thread"""
+		self.file.flush()
+		if self.fsync:
+			os.fsync(self.file.fileno())
+		self.file.close()
+		# We write the index first, so that anyone who finds the segment can find its index.
+		# Anyone looking for segments by their indexes will ignore it until the segment exists.
+		self.index.save(segment_path)
+		os.rename(self.filepath, segment_path)
+
+	def run(self):
+		stopping = False
+		while not stopping:
+			timeout = None if self.oldest is None else max(0, self.oldest + self.flush_interval - time.time())
+			try:
+				batch = [self.queue.get(timeout=timeout)]
+			except gevent.queue.Empty:
+				batch = []
+			while True:
+				try:
+					batch.append(self.queue.get_nowait())
+				except gevent.queue.Empty:
+					break
+			if None in batch:
+				# we've been closed. we write everything that came before it, then stop.
+				batch = batch[:batch.index(None)]
+				stopping = True
+			retry_interval = self.retry_interval
+			while True:
+				try:
+					self.write_batch(batch, stopping)
+					if retry_interval != self.retry_interval and self.logger:
+						self.logger.info("Writing records to {} again".format(self.filepath))
+					break
+				except Exception as e:
+					self.failures += 1
+					self.last_error = '{}: {}'.format(type(e).__name__, e)
+					if self.failing_since is None:
+						self.failing_since = time.time()
+					if self.logger:
+						self.logger.exception("Failed to write records to {}".format(self.filepath))
+				if self.closing:
+					# we can't hold up shutdown indefinitely
+					self.dropped += len(self.unflushed) + len(batch)
+					if self.logger:
+						self.logger.error("Giving up on writing {} records to {}".format(len(self.unflushed) + len(batch), self.filepath))
+					try:
+						self.recover() # where we can, cut off anything partially written
+					except Exception:
+						pass
+					self.unflushed = []
+					self.oldest = None
+					break
+				gevent.sleep(retry_interval)
+				retry_interval = min(retry_interval * 2, self.MAX_RETRY_INTERVAL)
+				try:
+					batch = self.recover() + batch
+				except Exception:
+					if self.logger:
+						self.logger.exception("Failed to reopen {}".format(self.filepath))
+		try:
+			self.file.close()
+		except EnvironmentError:
+			pass # already failed, and logged
+		# let any compressions finish, so we don't leave half-compressed segments behind
+		self.compressions.join()
+
+	def write_batch(self, batch, stopping):
+		"""Write batch, flushing if it's time. If this fails, nothing is counted as written
+		and recover() must be called before trying again."""
+		if batch and self.should_rotate():
+			self.rotate()
+		oldest = self.oldest
+		if batch and oldest is None:
+			oldest = batch[0][0]
+		unflushed = len(self.unflushed) + len(batch)
+		flush = unflushed and (
+			stopping
+			or unflushed >= self.flush_messages
+			or time.time() >= oldest + self.flush_interval
+		)
+		data = []
+		offsets = []
+		offset = self.offset
+		for queued, values, context, received_at in batch:
+			record = self.encoder.encode(values, context)
+			offsets.append((received_at, offset))
+			offset += len(record)
+			data.append(record)
+		if batch or flush:
+			gevent.get_hub().threadpool.apply(self._write, (''.join(data), flush))
+		# It's written, now we can account for it
+		for received_at, record_offset in offsets:
+			self.index.add(received_at, record_offset)
+		self.offset = offset
+		self.failing_since = None
+		now = time.time()
+		for queued, values, context, received_at in batch:
+			latency = now - queued
+			self.total_latency += latency
+			self.max_latency = max(self.max_latency, latency)
+		if batch:
+			self.written += len(batch)
+			self.batches += 1
+		if flush:
+			self.flushes += 1
+			self.flushed_offset = self.offset
+			self.unflushed = []
+			self.oldest = None
+		else:
+			self.unflushed += batch
+			self.oldest = oldest
+
+	def _write(self, data, flush):
+		"""Runs in a thread"""
+		if data:
+			self.file.write(data)
+		if flush:
+			self.file.flush()
+			if self.fsync:
+				os.fsync(self.file.fileno())
+
+	def recover(self):
+		"""After a failed write, reopen the file to carry on from the last successful flush.
+		Returns the records written since then, which may or may not have made it to disk, to write again."""
+		gevent.get_hub().threadpool.apply(self._reopen)
+		self.index.truncate(self.flushed_offset, len(self.unflushed))
+		self.offset = os.fstat(self.file.fileno()).st_size
+		self.start()
+		replay = self.unflushed
+		self.written -= len(replay)
+		self.unflushed = []
+		self.oldest = None
+		return replay
+
+	def _reopen(self):
+		"""Runs in a thread"""
+		try:
+			self.file.close()
+		except EnvironmentError:
+			pass # closing flushes, which fails the same way the write did
+		if self.exclusive:
+			# cut off anything after the last flush, so no partial records are left behind
+			try:
+				with open(self.filepath, 'r+b') as f:
+					f.seek(0, os.SEEK_END)
+					if f.tell() > self.flushed_offset:
+						f.truncate(self.flushed_offset)
+			except EnvironmentError as e:
+				if e.errno != errno.ENOENT:
+					raise
+		self.file = open(self.filepath, 'a+b')
+		if not self.exclusive:
+			# We can't cut off a partial record, since others may have written after it.
+			# Instead make sure it ends, so readers just drop it as one bad line.
+			size = os.fstat(self.file.fileno()).st_size
+			if size:
+				self.file.seek(size - 1)
+				if self.file.read(1) != '\n':
+					self.file.write('\n')
+
+	def close(self):
+		"""Write and flush everything queued, then close the file.
+		If writes are failing, stop retrying and drop whatever hasn't been written."""
+		self.closing = True
+		self.queue.put(None)
+		self.writer.join()
+
+	def stats(self):
+		return {
+			'queued': self.queue.qsize(),
+			'max_queued': self.max_queue,
+			'written': self.written,
+			'batches': self.batches,
+			'flushes': self.flushes,
+			'avg_latency': self.total_latency / self.written if self.written else 0,
+			'max_latency': self.max_latency,
+			'rotations': self.rotations,
+			'compressing': len(self.compressions),
+			'dropped': self.dropped,
+			'failures': self.failures,
+			'last_error': self.last_error,
+			'failing_since': self.failing_since,
+		}
 
 
 class RecordPlugin(ClientPlugin):
-	"""Records messages to a file as newline-seperated JSON objects"""
+	"""Records messages to a file as newline-seperated JSON objects (or in a binary format),
+	optionally rotating it into segments (see recordfile)"""
 	name = 'record'
 
-	# This is a global cache of open files we're writing records to.
+	defaults = {
+		# Flush the file after this many records, or when the oldest unflushed record is this many seconds old.
+		# Set flush_messages to 1 to flush every record as it's written.
+		'flush_messages': 100,
+		'flush_interval': 1,
+		'fsync': False, # fsync the file on every flush
+		# If either is set, rotate the file once it's at least this many bytes, or has been written to for
+		# this many seconds. Old records are kept in segments next to the file, see recordfile.
+		# Only rotate a file if this is the only process writing to it.
+		'rotate_size': None,
+		'rotate_interval': None,
+		'compress': None, # compress closed segments with this, one of recordfile.COMPRESSORS (eg. 'gzip')
+		'index_interval': 60, # how many seconds apart to note offsets in a segment's index
+		# One of FORMATS. 'binary' is about half the size and quicker to read (see recordfile.BinaryRecordEncoder),
+		# but only one process may write to a binary file, and only readers that use recordfile.iter_records()
+		# or RecordReader understand it. nickseen and search read either, but nickseen's index_workers only helps 'json'.
+		'format': 'json',
+		# If writing fails, keep up to this many records queued while we retry, then drop any more.
+		# None to never drop any.
+		'queue_limit': 100000,
+		'retry_interval': 1, # how long to wait before first retrying a failed write. Doubles each time it fails again.
+	}
+
+	# This is a global cache of open files we're writing records to, as {filepath: RecordWriter}.
 	# The purpose is so that two instances of this plugin can write to the same file
-	# without stepping on each others toes.
-	# The weakref means it will properly GC and be closed when the last plugin finishes.
-	fileobjs = weakref.WeakValueDictionary()
+	# without stepping on each others toes. Each writer counts the plugins using it,
+	# and is closed when the last one finishes. The first plugin to open a file picks its flush policy, rotation and format.
+	fileobjs = {}
 
 	def init(self):
 		filepath = self.config.filename
-		if filepath in self.fileobjs:
-			self.file = self.fileobjs[filepath]
-		else:
-			self.file = open(filepath, 'a')
-			self.fileobjs[filepath] = self.file
+		if filepath not in self.fileobjs:
+			self.fileobjs[filepath] = RecordWriter(
+				filepath, self.config.flush_messages, self.config.flush_interval, self.config.fsync,
+				self.config.rotate_size, self.config.rotate_interval, self.config.compress, self.config.index_interval,
+				self.config.format, self.config.queue_limit, self.config.retry_interval, self.logger,
+			)
+		self.writer = self.fileobjs[filepath]
+		self.writer.users += 1
 		self.common_info = {
 			'hostname': self.client.hostname,
 			'port': self.client.port,
@@ -36,9 +473,10 @@ class RecordPlugin(ClientPlugin):
 		}
 
 	def cleanup(self):
-		# We can't guarentee the fileobj will be closed correctly later, so we explicitly
-		# flush just to be safe.
-		self.file.flush()
+		self.writer.users -= 1
+		if not self.writer.users:
+			del self.fileobjs[self.writer.filepath]
+			self.writer.close()
 
 	@EkimbotHandler(no_ignore=True, master=None)
 	def record(self, client, msg):
@@ -52,27 +490,101 @@ class RecordPlugin(ClientPlugin):
 
 		# We use a blacklist of attrs not to include here, not a whitelist.
 		# This allows us to capture any helper properties from specialised subclasses.
+		values = message_values(msg)
+		# For additional context, include some common info about the connection, this bot.
+		# The common info is the same for every record, which the binary format can take advantage of.
+		values.update(bot_nick=self.client.nick)
+
+		self.writer.write(values, msg.received_at, self.common_info)
+
+	@CommandHandler('recordstats', 0)
+	def recordstats(self, msg):
+		"""Show stats about writing message records to disk"""
+		stats = self.writer.stats()
+		self.reply(msg, (
+			"{filepath}: {queued} records queued (max {max_queued}), {written} written in {batches} batches "
+			"with {flushes} flushes. Latency from queue to disk: avg {avg_latency_ms:.1f}ms, max {max_latency_ms:.1f}ms. "
+			"Rotated {rotations} times, {compressing} segments compressing. "
+			"{failures} failed writes, {dropped} records dropped. {status}"
+		).format(
+			filepath=self.writer.filepath,
+			avg_latency_ms=stats['avg_latency'] * 1000,
+			max_latency_ms=stats['max_latency'] * 1000,
+			status=(
+				"Writes failing since {} UTC: {}".format(
+					time.strftime('%F %T', time.gmtime(stats['failing_since'])), stats['last_error'],
+				) if stats['failing_since'] is not None
+				else "Last error: {}".format(stats['last_error']) if stats['last_error'] is not None
+				else "No errors."
+			),
+			**stats
+		))
+
+
+if __name__ == '__main__':
+	# Benchmark building and encoding records for a representative mix of girc messages,
+	# the old way (dir() sweep, then json.dumps with a whole-record latin-1 retry) against the new.
+	# Args are: number of messages (default 100000)
+	import random
+	import sys
+
+	from monotonic import monotonic
+
+	class BenchClient(object):
+		"""Just enough of a girc client for messages to be created and inspected"""
+		nick = 'ekimbot'
+		hostname = 'irc.example.com'
+		port = 6697
+		ssl = True
+		def matches_nick(self, nick):
+			return nick.lower() == self.nick
+		def normalize_channel(self, channel):
+			return channel.lower()
+
+	client = BenchClient()
+	payloads = ['hello world', 'a somewhat longer message, as people tend to send', '\xe2\x98\x83 snowman', 'bad bytes \xff\xfe']
+	messages = [
+		random.choice([message.Privmsg] * 4 + [message.Notice])(
+			client, random.choice(['#channel', '#other', 'ekimbot']), random.choice(payloads),
+		)
+		for _ in range(1000)
+	]
+	common_info = {
+		'hostname': client.hostname, 'port': client.port, 'ssl': client.ssl,
+		'bot_hostname': socket.gethostname(), 'bot_pid': os.getpid(),
+	}
+
+	def old_record(msg):
 		values = {
 			attr: getattr(msg, attr)
 			for attr in dir(msg)
 			if not any((
 				attr.startswith('_'),
-				attr in ('client', 'extra', 'since_received'),
+				attr in EXCLUDED_ATTRS,
 				callable(getattr(msg, attr)),
 			))
 		}
-		# For additional context, include some common info about the connection, this bot.
-		values.update(self.common_info)
-		values.update(bot_nick=self.client.nick)
-
+		values.update(common_info)
+		values.update(bot_nick=client.nick)
 		try:
-			msg_record = json.dumps(values, default=str)
+			return json.dumps(values, default=str)
 		except UnicodeDecodeError:
-			# Somewhere in all that data, there's bytes that can't be encoded to utf-8.
-			# utf-8 is almost certainly the more correct encoding for being able to read
-			# the data sensically, but JSON forces us to pick an encoding, so in this case
-			# we have to fall back to an encoding that can (probably incorrectly) encode
-			# all possible byte strings.
 			values.update(_encoding='latin-1')
-			msg_record = json.dumps(values, default=str, encoding='latin-1')
-		self.file.write('{}\n'.format(msg_record))
+			return json.dumps(values, default=str, encoding='latin-1')
+
+	def new_record(msg):
+		values = message_values(msg)
+		values.update(common_info)
+		values.update(bot_nick=client.nick)
+		return encode_record(values)
+
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	results = {}
+	for name, fn in (('dir sweep', old_record), ('attribute plans', new_record)):
+		start = monotonic()
+		for i in xrange(count):
+			fn(messages[i % len(messages)])
+		elapsed = monotonic() - start
+		results[name] = elapsed
+		print "{}: {:.0f} messages/sec".format(name, count / elapsed)
+	print "speedup: {:.1f}x".format(results['dir sweep'] / results['attribute plans'])
@@ -0,0 +1,943 @@
+"""Reading and writing the files message records are stored in, shared by the record plugin
+and anything that reads what it records.
+
+A record file is newline-seperated JSON objects, one per message. If the record plugin is set to rotate it,
+then from time to time the file is renamed to a segment FILENAME.TIMESTAMP and a new FILENAME is started,
+so FILENAME always has the newest records and anything following it just sees a normal log rotation.
+Closed segments may be compressed, in which case the segment gets a suffix for its compression (eg. .gz).
+Every closed segment has a sidecar index SEGMENT.idx (always named for the uncompressed segment),
+a JSON object with:
+	first, last: The earliest and latest received_at of the records in the segment.
+		first is null if we don't know, as the file already had records in it when we started writing.
+	records: How many records we wrote to the segment.
+	offsets: A list of [received_at, offset] pairs, roughly every index_interval seconds,
+		giving the (uncompressed) byte offset of the record received at that time.
+This lets a reader that wants a time range skip whole segments, and seek to near the start of the range
+within a segment, without decoding every record.
+
+Record files may instead be in a binary format, which is smaller and quicker to read, see BinaryRecordEncoder.
+The line-based readers here (read_segment(), read_records()) only understand JSON files,
+use iter_records() or a RecordReader to read either.
+
+Plugins that index the messages in a record file (nickseen, search) read it with a RecordReader, which goes through
+the segments and then follows the file as it's written and rotated, picking out the messages they care about
+(see parse_record()). They save checkpoints of how far they've got with save_checkpoint(), to resume from on restart.
+"""
+
+import bz2
+from bisect import bisect_right
+import cPickle
+import ctypes
+import ctypes.util
+import errno
+import gzip
+import json
+import marshal
+import os
+import re
+import shutil
+import struct
+import time
+
+import gevent
+import gevent.socket
+
+
+# {compression name: (file suffix, function to open a compressed file like open())}
+COMPRESSORS = {
+	'gzip': ('.gz', gzip.open),
+	'bz2': ('.bz2', bz2.BZ2File),
+}
+
+INDEX_SUFFIX = '.idx'
+
+# What new_segment_path() puts after FILENAME., the time the segment was started and a sequence number
+# if more than one started in the same second
+SEGMENT_NAME_RE = re.compile(r'^(\d{8}T\d{6})(?:-(\d+))?$')
+
+
+class SegmentIndex(object):
+	"""Builds the sidecar index for a segment as records are written to it. See module docstring.
+	Timestamps are only as ordered as the records are, which isn't strictly (eg. two clients
+	writing to the same file), so treat offsets as a hint of where to start looking, not an exact answer."""
+	def __init__(self, interval, partial=False):
+		self.interval = interval
+		# if partial, the file had records in it before we started, so we don't know when it starts
+		self.partial = partial
+		self.first = None
+		self.last = None
+		self.records = 0
+		self.offsets = []
+
+	def add(self, timestamp, offset):
+		"""Note the record received at timestamp was written at offset"""
+		if self.first is None or timestamp < self.first:
+			self.first = timestamp
+		if self.last is None or timestamp > self.last:
+			self.last = timestamp
+		if not self.offsets or timestamp >= self.offsets[-1][0] + self.interval:
+			self.offsets.append([timestamp, offset])
+		self.records += 1
+
+	def truncate(self, offset, records):
+		"""Forget the last records records, which were written from offset on"""
+		self.offsets = [[timestamp, entry] for timestamp, entry in self.offsets if entry < offset]
+		self.records -= records
+
+	def save(self, segment_path):
+		"""Write the index for the (uncompressed) segment at segment_path"""
+		path = segment_path + INDEX_SUFFIX
+		tmp_path = '{}.tmp'.format(path)
+		with open(tmp_path, 'w') as f:
+			json.dump({
+				'first': None if self.partial else self.first,
+				'last': self.last,
+				'records': self.records,
+				'offsets': self.offsets,
+			}, f)
+		os.rename(tmp_path, path)
+
+
+def new_segment_path(filepath, timestamp):
+	"""Pick a name for a segment of filepath started at timestamp, that isn't already taken
+	by another segment, compressed or not."""
+	base = '{}.{}'.format(filepath, time.strftime('%Y%m%dT%H%M%S', time.gmtime(timestamp)))
+	path = base
+	n = 0
+	while any(os.path.exists(path + suffix) for suffix in [INDEX_SUFFIX, ''] + [s for s, _ in COMPRESSORS.values()]):
+		n += 1
+		path = '{}-{}'.format(base, n)
+	return path
+
+
+def compress_segment(path, compression):
+	"""Compress the segment at path, replacing it with the compressed file.
+	This is slow and blocking, so callers should run it in a thread."""
+	suffix, opener = COMPRESSORS[compression]
+	tmp_path = '{}{}.tmp'.format(path, suffix)
+	with open(path, 'rb') as src:
+		dest = opener(tmp_path, 'wb')
+		try:
+			shutil.copyfileobj(src, dest, 1024 * 1024)
+		finally:
+			dest.close()
+	os.rename(tmp_path, path + suffix)
+	os.remove(path)
+
+
+def open_segment(path):
+	"""Open a segment or record file for reading, decompressing it if needed"""
+	for suffix, opener in COMPRESSORS.values():
+		if path.endswith(suffix):
+			return opener(path, 'rb')
+	return open(path, 'rb')
+
+
+def segments(filepath):
+	"""Returns [(path, index)] for all the closed segments of record file filepath, oldest first.
+	index is the parsed sidecar index, see module docstring."""
+	found = []
+	dirname, prefix = os.path.split(filepath)
+	prefix += '.'
+	for name in os.listdir(dirname or '.'):
+		if not (name.startswith(prefix) and name.endswith(INDEX_SUFFIX)):
+			continue
+		match = SEGMENT_NAME_RE.match(name[len(prefix):-len(INDEX_SUFFIX)])
+		if not match:
+			continue # not one of ours, eg. the segments of FILENAME.something
+		started, sequence = match.groups()
+		index_path = os.path.join(dirname, name)
+		base = index_path[:-len(INDEX_SUFFIX)]
+		# the uncompressed file takes priority, in case we're part way through compressing it
+		for path in [base] + [base + suffix for suffix, _ in COMPRESSORS.values()]:
+			if os.path.exists(path):
+				break
+		else:
+			continue # index without data, it must have been deleted
+		try:
+			with open(index_path) as f:
+				index = json.load(f)
+		except (EnvironmentError, ValueError):
+			continue # being deleted or not fully written yet
+		found.append(((started, int(sequence or 0)), path, index))
+	# The name says when we started writing the segment, which is always the order they were written in.
+	# first may be missing (see module docstring), and is only a tie-breaker anyway, so segments without it go last.
+	found.sort(key=lambda (name_key, path, index): (name_key, index['first'] is None, index['first'], path))
+	return [(path, index) for name_key, path, index in found]
+
+
+def read_segment(path, index=None, start=None):
+	"""Yields lines from the segment at path. If index and start are given, skips ahead
+	to (roughly) the first record received at start. Records before start may still be yielded,
+	callers that care should check received_at themselves."""
+	with open_segment(path) as f:
+		if index is not None and start is not None and index['offsets']:
+			# we back off by one entry as timestamps aren't strictly ordered
+			i = bisect_right([ts for ts, offset in index['offsets']], start) - 2
+			if i >= 0:
+				# offsets are the starts of records, but if someone else wrote to the file they may not be.
+				# Either way, discarding up to the next newline is safe as we backed off.
+				f.seek(index['offsets'][i][1])
+				f.readline()
+		for line in f:
+			yield line
+
+
+def read_records(filepath, start=None, end=None):
+	"""Yields lines from all segments of record file filepath, then filepath itself,
+	skipping segments that are entirely outside the time range start to end (either may be None).
+	As with read_segment, this doesn't filter exactly - callers must check received_at themselves."""
+	for path, index in segments(filepath):
+		if start is not None and index['last'] is not None and index['last'] < start:
+			continue
+		if end is not None and index['first'] is not None and index['first'] > end:
+			continue
+		for line in read_segment(path, index, start):
+			yield line
+	try:
+		f = open(filepath, 'rb')
+	except EnvironmentError:
+		return # between rotating and starting the next file, or not started yet
+	with f:
+		for line in f:
+			yield line
+
+
+# The keys the record plugin adds to every record to describe the connection and bot, rather than the message
+COMMON_KEYS = ('hostname', 'port', 'ssl', 'bot_hostname', 'bot_pid')
+
+# Binary record files are a sequence of frames: a one-byte kind, a little-endian 4-byte payload length, then the payload.
+FRAME_HEADER = struct.Struct('<cI')
+# A header frame starts every file, and any number of times after that. It resets all the tables below.
+HEADER_FRAME = 'H'
+BINARY_MAGIC = 'EKRB\x01' # the header frame's payload, the last byte is the format version
+# A schema frame's payload is a marshalled tuple of keys. Schemas are numbered from 0 in the order they appear.
+SCHEMA_FRAME = 'S'
+# A context frame's payload is a marshalled dict of values common to many records, eg. COMMON_KEYS.
+# Contexts are numbered from 0 in the order they appear.
+CONTEXT_FRAME = 'C'
+# A record frame's payload is RECORD_IDS (schema number, context number),
+# then a marshalled tuple of values for the keys in that schema. The record is those plus the context's values.
+RECORD_FRAME = 'R'
+RECORD_IDS = struct.Struct('<HH')
+MAX_TABLE_SIZE = 2**16 # since ids are 2 bytes. We start a new header once a table is full.
+MARSHAL_VERSION = 2 # so every python 2.7 can read it
+
+BINARY_HEADER = FRAME_HEADER.pack(HEADER_FRAME, len(BINARY_MAGIC)) + BINARY_MAGIC
+
+# Types we can marshal as they are. Anything else is converted to a str,
+# or for containers, has its contents converted, the same as encoding it as JSON with default=str would.
+PLAIN_TYPES = (str, unicode, int, long, float, bool, type(None))
+
+
+def plain_value(value):
+	"""Convert value to something that marshals to the same thing that JSON would encode it as"""
+	if type(value) in PLAIN_TYPES:
+		return value
+	if isinstance(value, (list, tuple)):
+		return [plain_value(item) for item in value]
+	if isinstance(value, dict):
+		# JSON can only have string keys, and converts any others
+		return {
+			key if isinstance(key, basestring) else json.dumps(key): plain_value(item)
+			for key, item in value.items()
+		}
+	# subclasses of things JSON understands are encoded as their base type
+	for base in PLAIN_TYPES:
+		if isinstance(value, base):
+			return base(value)
+	return str(value)
+
+
+class BinaryRecordEncoder(object):
+	"""Encodes records in the binary format (see the *_FRAME constants).
+
+	Instead of repeating every key in every record like JSON does, each distinct set of keys is written
+	once as a schema, and each record is just a tuple of values for its schema's keys.
+	Similarly, values common to many records (like those for COMMON_KEYS) are written once as a context.
+	Payloads are marshalled, which being written in C is much faster to read back than anything we could parse by hand.
+	As with JSON, we decode fields as utf-8 when writing them so that reading them back doesn't have to,
+	and list any that aren't valid utf-8 (which we leave as str) in "_latin1".
+	Since what a record means depends on the tables before it, only one process may write to a binary file.
+	"""
+	def __init__(self):
+		self.start()
+
+	def start(self):
+		"""Reset our tables. Returns the data that has to start a new file."""
+		self.schemas = {}
+		self.contexts = {}
+		return BINARY_HEADER
+
+	def encode(self, values, context={}):
+		"""Returns the data for a record of values and context, where context has priority"""
+		data = []
+		if len(self.schemas) >= MAX_TABLE_SIZE or len(self.contexts) >= MAX_TABLE_SIZE:
+			data.append(self.start())
+		context_key = tuple(sorted(context.items()))
+		context_id = self.contexts.get(context_key)
+		if context_id is None:
+			context_id = self.contexts[context_key] = len(self.contexts)
+			data.append(self.frame(CONTEXT_FRAME, marshal.dumps(plain_value(context), MARSHAL_VERSION)))
+		record = {}
+		latin1 = []
+		for key, value in values.items():
+			if key in context:
+				continue
+			value = plain_value(value)
+			try:
+				# most values are plain strs, so we check for those before doing it properly
+				record[key] = value.decode('utf-8') if type(value) is str else _decode(value, 'utf-8')
+			except UnicodeDecodeError:
+				record[key] = value
+				latin1.append(key)
+		if latin1:
+			record['_latin1'] = sorted(_decode(key, 'utf-8') for key in latin1)
+		keys = tuple(sorted(record))
+		schema_id = self.schemas.get(keys)
+		if schema_id is None:
+			schema_id = self.schemas[keys] = len(self.schemas)
+			data.append(self.frame(SCHEMA_FRAME, marshal.dumps(keys, MARSHAL_VERSION)))
+		data.append(self.frame(RECORD_FRAME, RECORD_IDS.pack(schema_id, context_id) + marshal.dumps(
+			tuple(record[key] for key in keys), MARSHAL_VERSION,
+		)))
+		return ''.join(data)
+
+	def frame(self, kind, payload):
+		return FRAME_HEADER.pack(kind, len(payload)) + payload
+
+
+class BinaryDecoder(object):
+	"""Decodes records from the frames of a binary record file, a piece at a time.
+	By default records are exactly what reading the same records from a JSON file would give, but if raw is set
+	they have str keys and values as they were recorded (see json_to_raw()), which is what most readers end up wanting.
+	"""
+	def __init__(self, raw=False):
+		self.raw = raw
+		# schemas are lists of keys, contexts are records to merge into records as they'd be yielded.
+		self.schemas = []
+		self.contexts = []
+		# how far into the data passed to decode() we've got
+		self.pos = 0
+
+	def decode(self, buf):
+		"""Yields (end, record) for each record in buf, which must start at the start of a frame,
+		with end being the offset in buf of the end of the record's frame.
+		Stops at the first incomplete frame, leaving pos at its start, so the next call should be given buf[pos:]
+		plus whatever follows it. Meanwhile, pos is the end of the last frame we've decoded."""
+		self.pos = 0
+		while self.pos + FRAME_HEADER.size <= len(buf):
+			kind, length = FRAME_HEADER.unpack_from(buf, self.pos)
+			start = self.pos + FRAME_HEADER.size
+			end = start + length
+			if end > len(buf):
+				return # need more data
+			self.pos = end
+			if kind == RECORD_FRAME:
+				schema_id, context_id = RECORD_IDS.unpack_from(buf, start)
+				record = dict(zip(self.schemas[schema_id], marshal.loads(buf[start + RECORD_IDS.size:end])))
+				context = self.contexts[context_id]
+				if self.raw:
+					record = json_to_raw(record)
+				elif u'_latin1' in record:
+					for key in record[u'_latin1']:
+						record[key] = _decode(record[key], 'latin-1')
+					if u'_latin1' in context:
+						record[u'_latin1'] = sorted(record[u'_latin1'] + context[u'_latin1'])
+				elif u'_latin1' in context:
+					record[u'_latin1'] = context[u'_latin1']
+				record.update((key, value) for key, value in context.items() if key != u'_latin1')
+				yield end, record
+			elif kind == SCHEMA_FRAME:
+				keys = marshal.loads(buf[start:end])
+				self.schemas.append([_decode(key, 'utf-8') for key in keys])
+			elif kind == CONTEXT_FRAME:
+				context = marshal.loads(buf[start:end])
+				self.contexts.append(context if self.raw else raw_to_json(context))
+			elif kind == HEADER_FRAME:
+				if buf[start:end] != BINARY_MAGIC:
+					raise ValueError("Unsupported binary record file header: {!r}".format(buf[start:end]))
+				self.schemas = []
+				self.contexts = []
+			else:
+				raise ValueError("Unknown frame kind {!r}".format(kind))
+
+
+def iter_binary(f, raw=False, chunk_size=1024 * 1024):
+	"""Yields records from binary record file f as dicts. See BinaryDecoder for what raw means.
+	Stops at the first incomplete frame, eg. if the file is still being written."""
+	decoder = BinaryDecoder(raw)
+	buf = ''
+	while True:
+		chunk = f.read(chunk_size)
+		if not chunk:
+			return
+		buf += chunk
+		for end, record in decoder.decode(buf):
+			yield record
+		buf = buf[decoder.pos:]
+
+
+def _decode(value, encoding):
+	if isinstance(value, str):
+		return value.decode(encoding)
+	if isinstance(value, list):
+		return [_decode(item, encoding) for item in value]
+	if isinstance(value, dict):
+		return {_decode(key, encoding): _decode(item, encoding) for key, item in value.items()}
+	return value
+
+
+def _encode(value, encoding):
+	if isinstance(value, unicode):
+		return value.encode(encoding)
+	if isinstance(value, list):
+		return [_encode(item, encoding) for item in value]
+	if isinstance(value, dict):
+		return {_encode(key, encoding): _encode(item, encoding) for key, item in value.items()}
+	return value
+
+
+def raw_to_json(record):
+	"""Convert a record with str values to what encoding it as JSON (see record.encode_record) and decoding it gives:
+	unicode strings, with any fields that aren't valid utf-8 decoded as latin-1 and listed in "_latin1"."""
+	result = {}
+	latin1 = []
+	for key, value in record.items():
+		key = _decode(key, 'utf-8')
+		try:
+			result[key] = _decode(value, 'utf-8')
+		except UnicodeDecodeError:
+			result[key] = _decode(value, 'latin-1')
+			latin1.append(key)
+	if latin1:
+		result[u'_latin1'] = sorted(latin1)
+	return result
+
+
+def json_to_raw(record):
+	"""The reverse of raw_to_json(), giving back the str values that were recorded.
+	Also understands older records, which give one "_encoding" for the whole record."""
+	encoding = record.get('_encoding', 'utf-8')
+	latin1 = record.get('_latin1', ())
+	result = {}
+	for key, value in record.items():
+		if key in ('_encoding', '_latin1'):
+			continue
+		# most values are plain unicode, so we check for those before doing it properly
+		if key in latin1:
+			result[str(key)] = _encode(value, 'latin-1')
+		else:
+			result[str(key)] = value.encode(encoding) if type(value) is unicode else _encode(value, encoding)
+	return result
+
+
+def file_format(path):
+	"""Returns 'binary' or 'json' for the format of the (uncompressed) record file at path,
+	or None if it's empty or doesn't exist."""
+	try:
+		with open(path, 'rb') as f:
+			start = f.read(len(BINARY_HEADER))
+	except EnvironmentError:
+		return None
+	if not start:
+		return None
+	return 'binary' if start == BINARY_HEADER else 'json'
+
+
+def detect_format(f):
+	"""As file_format(), for open (uncompressed or decompressing) file f. Leaves f at an unspecified position.
+	Also gives None if all there is so far could be the start of a binary file's header."""
+	f.seek(0)
+	start = f.read(len(BINARY_HEADER))
+	if start == BINARY_HEADER:
+		return 'binary'
+	if BINARY_HEADER.startswith(start):
+		return None
+	return 'json'
+
+
+def iter_records(path, raw=False):
+	"""Yields records as dicts from the record file or segment at path, whatever its format,
+	decompressing it if needed. See BinaryDecoder for what raw means. Skips any partial line or frame at the end."""
+	with open_segment(path) as f:
+		if f.read(len(BINARY_HEADER)) == BINARY_HEADER:
+			f.seek(0)
+			for record in iter_binary(f, raw):
+				yield record
+			return
+		f.seek(0)
+		for line in f:
+			if not line.endswith('\n'):
+				return
+			record = json.loads(line)
+			yield json_to_raw(record) if raw else record
+
+
+# The keys we need from each record to index it
+RECORD_KEYS = ('target', 'sender', 'payload', 'received_at')
+
+
+def parse_record(line, hostname, quoted_hostname):
+	"""Parse a line from the message record file, returning a dict of the RECORD_KEYS it has,
+	or None if it isn't a PRIVMSG or NOTICE from hostname.
+	quoted_hostname is hostname as it appears in the file, ie. JSON-encoded.
+	Raises ValueError if the line can't be parsed.
+	"""
+	# Almost every line is for some other command or hostname, and checking for the strings we'd need
+	# to see is far cheaper than decoding the JSON, so do that first to throw most lines away.
+	# This may let through lines that just happen to contain those strings, but never drops a line we want.
+	if quoted_hostname not in line or ('"PRIVMSG"' not in line and '"NOTICE"' not in line):
+		return None
+	msg = json.loads(line)
+	# only re-encode the keys we actually look at.
+	# Older records give one encoding for the whole record, newer ones list the fields that are latin-1.
+	encoding = msg.get('_encoding', 'utf-8')
+	latin1 = msg.get('_latin1', ())
+	def field(key):
+		return _encode(msg.get(key), 'latin-1' if key in latin1 else encoding)
+	if field('command') not in ('PRIVMSG', 'NOTICE') or field('hostname') != hostname:
+		return None
+	return {key: field(key) for key in RECORD_KEYS if key in msg}
+
+
+def parse_raw_record(record, hostname):
+	"""As parse_record(), for a record from a binary record file as decoded by a raw BinaryDecoder"""
+	if record.get('command') not in ('PRIVMSG', 'NOTICE') or record.get('hostname') != hostname:
+		return None
+	return {key: record[key] for key in RECORD_KEYS if key in record}
+
+
+def file_identity(f):
+	"""Identifies the file behind an open file object, so we can tell if the file at a path has changed"""
+	stat = os.fstat(f.fileno())
+	return stat.st_dev, stat.st_ino
+
+
+def path_identity(path):
+	"""As file_identity(), but for whatever file is at path right now"""
+	stat = os.stat(path)
+	return stat.st_dev, stat.st_ino
+
+
+# inotify constants, from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x80000
+INOTIFY_EVENT = struct.Struct('iIII') # wd, mask, cookie, len. Followed by len bytes of name.
+
+_libc = None
+
+
+def inotify_watch(path, mask):
+	"""Returns a non-blocking inotify fd watching path for events in mask.
+	Raises EnvironmentError if inotify isn't available."""
+	global _libc
+	if _libc is None:
+		name = ctypes.util.find_library('c')
+		if name is None:
+			raise EnvironmentError("Could not find libc")
+		_libc = ctypes.CDLL(name, use_errno=True)
+	try:
+		init, add_watch = _libc.inotify_init1, _libc.inotify_add_watch
+	except AttributeError:
+		raise EnvironmentError("libc does not support inotify")
+	fd = init(IN_NONBLOCK | IN_CLOEXEC)
+	if fd < 0:
+		error = ctypes.get_errno()
+		raise OSError(error, os.strerror(error))
+	if add_watch(fd, path, mask) < 0:
+		error = ctypes.get_errno()
+		os.close(fd)
+		raise OSError(error, os.strerror(error))
+	return fd
+
+
+def read_inotify_events(fd):
+	"""Read all waiting events from a non-blocking inotify fd, returning a list of (mask, name)"""
+	events = []
+	while True:
+		try:
+			data = os.read(fd, 65536)
+		except OSError as e:
+			if e.errno == errno.EAGAIN:
+				return events
+			raise
+		pos = 0
+		while pos < len(data):
+			wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, pos)
+			pos += INOTIFY_EVENT.size
+			events.append((mask, data[pos:pos+length].rstrip('\0')))
+			pos += length
+
+
+class FileWatcher(object):
+	"""Waits for a file to be appended to or replaced.
+
+	We watch the file's directory rather than the file, so we also see a new file being
+	moved or created in its place. If inotify isn't available (or the file is on a filesystem where
+	it can't see writes from other hosts), we poll instead, backing off while nothing is changing.
+	Even with inotify we wake up every max_interval, just in case.
+	"""
+	def __init__(self, path, min_interval, max_interval):
+		self.dirname, self.basename = os.path.split(os.path.abspath(path))
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+		self.interval = min_interval
+		self.fd = inotify_watch(self.dirname, IN_MODIFY | IN_CREATE | IN_MOVED_TO)
+
+	@classmethod
+	def polling(cls, path, min_interval, max_interval):
+		"""Create a FileWatcher that always polls"""
+		watcher = cls.__new__(cls)
+		watcher.dirname, watcher.basename = os.path.split(os.path.abspath(path))
+		watcher.min_interval = min_interval
+		watcher.max_interval = max_interval
+		watcher.interval = min_interval
+		watcher.fd = None
+		return watcher
+
+	def wait(self, changed):
+		"""Wait until the file might have changed.
+		changed is whether it had changed since the previous wait, which resets polling backoff."""
+		if self.fd is None:
+			self.interval = self.min_interval if changed else min(self.max_interval, self.interval * 2)
+			gevent.sleep(self.interval)
+			return
+		while True:
+			try:
+				gevent.socket.wait_read(self.fd, self.max_interval)
+			except gevent.socket.timeout:
+				return
+			for mask, name in read_inotify_events(self.fd):
+				if name == self.basename or mask & IN_Q_OVERFLOW:
+					return
+
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+
+
+def save_checkpoint(path, checkpoint):
+	"""Replace the checkpoint at path with checkpoint, which can be anything picklable"""
+	tmp_path = '{}.tmp'.format(path)
+	with open(tmp_path, 'wb') as f:
+		cPickle.dump(checkpoint, f, cPickle.HIGHEST_PROTOCOL)
+		# Make sure it's on disk before it replaces the old one, or a crash could leave us with neither
+		f.flush()
+		os.fsync(f.fileno())
+	os.rename(tmp_path, path)
+
+
+def load_checkpoint(path, version, logger):
+	"""Returns the checkpoint dict at path if there is one and it has the given version, otherwise None"""
+	try:
+		with open(path, 'rb') as f:
+			checkpoint = cPickle.load(f)
+	except EnvironmentError as e:
+		if e.errno != errno.ENOENT:
+			logger.warning("Failed to read checkpoint, indexing from scratch", exc_info=True)
+		return None
+	except Exception:
+		logger.warning("Checkpoint is corrupt, indexing from scratch", exc_info=True)
+		return None
+	if not isinstance(checkpoint, dict) or checkpoint.get('version') != version:
+		logger.info("Checkpoint is from an incompatible version, indexing from scratch")
+		return None
+	return checkpoint
+
+
+class RecordReader(object):
+	"""Reads the messages in a record file and the segments rotated out of it, keeping track of exactly
+	how far into the file it's got. That way it can pick up from there as more is written, carry on into
+	the new file once it's rotated (having finished the old one, so nothing written to it is lost),
+	or resume from a checkpoint on restart (see position()).
+	Files may be in either format, which we tell apart by whether they start with BINARY_HEADER.
+
+	Messages are what parse_record() returns, so only PRIVMSGs and NOTICEs from hostname.
+	Every batch_size records, we let other greenlets run and call on_batch (if given).
+	While they run, what we've read is always exactly what we've handed out, so a checkpoint is safe to take.
+	"""
+	# How many bytes before our offset we save in a position, to check the file hasn't been replaced
+	POSITION_TAIL = 64
+	# How much of a binary file to read at once
+	CHUNK_SIZE = 1024 * 1024
+
+	def __init__(self, filepath, hostname, logger, batch_size=1000, on_batch=None):
+		self.filepath = filepath
+		self.hostname = hostname
+		self.quoted_hostname = json.dumps(hostname)
+		self.logger = logger
+		self.batch_size = batch_size
+		self.on_batch = on_batch
+		# The record file, kept open so that if it's rotated we can still finish reading it.
+		# How far into it we've read, and its identity (see file_identity())
+		self.file = None
+		self.file_id = None
+		self.offset = 0
+		# The record file's format, or None if it's too empty to tell yet.
+		# If it's binary, the decoder we're reading it with, as what it holds depends on what came before.
+		self.format = None
+		self.decoder = None
+		self.reading_segments = False
+		self.records = 0 # how many we've read, for batching
+
+	def open(self, position=None):
+		"""Open the record file, at position (see position()) if it's given and still valid, otherwise at the start.
+		Returns whether we resumed from position."""
+		self.close()
+		self.file = open(self.filepath, 'rb')
+		self.file_id = file_identity(self.file)
+		self.offset = 0
+		self.set_format(detect_format(self.file))
+		if position is None:
+			return False
+		offset, tail = position['offset'], position['tail']
+		# Check it's the same file, and it hasn't been truncated (at least not before our offset)
+		valid = self.file_id == tuple(position['file_id']) and self.format == position['format']
+		if valid:
+			self.file.seek(offset - len(tail))
+			valid = self.file.read(len(tail)) == tail
+		if not valid:
+			self.logger.info("Message record file {} was rotated or truncated since checkpoint, indexing from scratch".format(self.filepath))
+			return False
+		self.offset = offset
+		if self.decoder:
+			schemas, contexts = position['tables']
+			self.decoder.schemas = list(schemas)
+			self.decoder.contexts = list(contexts)
+		self.logger.info("Resuming from offset {} of {}".format(offset, self.filepath))
+		return True
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+	def set_format(self, format):
+		self.format = format
+		self.decoder = BinaryDecoder(raw=True) if format == 'binary' else None
+
+	def position(self):
+		"""Returns where we've read up to, to save in a checkpoint and resume from with open().
+		Returns None when there's nowhere we could resume from: before we've opened the file, while we're
+		reading segments (as we couldn't say how far into them we'd got), or once it's been replaced
+		and we're yet to finish the old one."""
+		if self.file is None or self.reading_segments:
+			return None
+		with open(self.filepath, 'rb') as f:
+			if file_identity(f) != self.file_id:
+				return None
+			tail_start = max(0, self.offset - self.POSITION_TAIL)
+			f.seek(tail_start)
+			tail = f.read(self.offset - tail_start)
+		return {
+			'file_id': self.file_id,
+			'offset': self.offset,
+			'tail': tail,
+			'format': self.format,
+			# a binary file can't be read from the middle without the tables from before it
+			'tables': (list(self.decoder.schemas), list(self.decoder.contexts)) if self.decoder else None,
+		}
+
+	def read_segments(self):
+		"""Yields the messages in all closed segments of the record file, oldest first.
+		When starting from scratch, this goes after open() and before read()."""
+		self.reading_segments = True
+		for path, index in segments(self.filepath):
+			if path_identity(path) == self.file_id:
+				continue # it was rotated since we opened it, we'll read it as the record file
+			self.logger.info("Indexing rotated segment {} of {}".format(path, self.filepath))
+			with open_segment(path) as f:
+				decoder = BinaryDecoder(raw=True) if detect_format(f) == 'binary' else None
+				f.seek(0)
+				for offset, msg in self.read_file(f, 0, path, decoder):
+					if msg is not None:
+						yield msg
+		self.reading_segments = False
+
+	def read(self):
+		"""Yields messages from wherever we've read up to, until the end of the record file.
+		If it's been replaced, we finish reading the old file first, then start on the new one."""
+		while True:
+			# Check for replacement before reading, so that once we see it we know we've
+			# read everything that was written to the old file before it was replaced.
+			try:
+				replaced = path_identity(self.filepath) != self.file_id
+			except EnvironmentError:
+				replaced = False # not there right now, probably mid-rotation
+			if os.fstat(self.file.fileno()).st_size < self.offset:
+				self.logger.info("Message record file {} was truncated, reading from the start".format(self.filepath))
+				self.offset = 0
+				self.set_format(None)
+			if self.format is None:
+				self.set_format(detect_format(self.file))
+			if self.format is not None:
+				self.file.seek(self.offset)
+				for offset, msg in self.read_file(self.file, self.offset, self.filepath, self.decoder):
+					self.offset = offset
+					if msg is not None:
+						yield msg
+			if not replaced:
+				return
+			self.logger.info("Message record file {} was rotated, reading new file from the start".format(self.filepath))
+			new_file = open(self.filepath, 'rb')
+			self.file.close()
+			self.file = new_file
+			self.file_id = file_identity(new_file)
+			self.offset = 0
+			self.set_format(detect_format(new_file))
+
+	def follow(self, min_interval, max_interval):
+		"""Yields messages as they're written to the record file, forever. Changes are waited for with a FileWatcher."""
+		try:
+			watcher = FileWatcher(self.filepath, min_interval, max_interval)
+		except EnvironmentError:
+			self.logger.info("Can't watch message record file {} with inotify, polling instead".format(self.filepath), exc_info=True)
+			watcher = FileWatcher.polling(self.filepath, min_interval, max_interval)
+		try:
+			while True:
+				start = self.file_id, self.offset
+				for msg in self.read():
+					yield msg
+				watcher.wait((self.file_id, self.offset) != start)
+		finally:
+			watcher.close()
+
+	def read_file(self, f, offset, path, decoder):
+		"""Yields (offset after the record, message or None) for each record of f, which should be open at offset,
+		until EOF. decoder is None if f is in the JSON format, or the BinaryDecoder to read it with.
+		Any partial record at EOF is left to be read next time."""
+		if decoder is None:
+			return self.read_lines(f, offset, path)
+		return self.read_binary(f, offset, path, decoder)
+
+	def read_lines(self, f, offset, path):
+		for line in f:
+			if not line.endswith('\n'):
+				return
+			start = offset
+			offset += len(line)
+			yield offset, self.parse_line(line, start, path)
+			self.handled()
+
+	def read_binary(self, f, offset, path, decoder):
+		# After each chunk we also yield how far we got with no message, as the frames after
+		# the last record (if any) are read as well.
+		buf = ''
+		while True:
+			chunk = f.read(self.CHUNK_SIZE)
+			if not chunk:
+				return
+			buf += chunk
+			for end, record in decoder.decode(buf):
+				yield offset + end, self.check_message(parse_raw_record(record, self.hostname), offset + end, path)
+				self.handled()
+			offset += decoder.pos
+			buf = buf[decoder.pos:]
+			yield offset, None
+
+	def handled(self):
+		"""Call once a record has been handled. Every so often, lets other things run, as reading is cpu-intensive.
+		We do this once the record has been handled, so that it's counted as read."""
+		self.records += 1
+		if self.records % self.batch_size == 0:
+			gevent.idle()
+			if self.on_batch:
+				self.on_batch()
+
+	def parse_line(self, line, offset, path):
+		try:
+			# filter for privmsgs from this hostname only
+			msg = parse_record(line, self.hostname, self.quoted_hostname)
+		except Exception:
+			self.logger.info('Failed to parse line at offset {} from message record file {}, dropping'.format(offset, path), exc_info=True)
+			return None
+		return self.check_message(msg, offset, path)
+
+	def check_message(self, msg, offset, path):
+		"""Returns msg if it has all the RECORD_KEYS, otherwise logs and returns None"""
+		if msg is None:
+			return None
+		for key in RECORD_KEYS:
+			if key not in msg:
+				self.logger.info("Missing required key {} in record at offset {} from message record file {}, dropping".format(key, offset, path))
+				return None
+		return msg
+
+
+if __name__ == '__main__':
+	# Convert record files between formats, or compare the two formats for size and read speed.
+	# Usage:
+	#	recordfile.py to-json FILE - writes the records in FILE to stdout as JSON
+	#	recordfile.py to-binary FILE OUTFILE - writes the records in FILE to OUTFILE in the binary format
+	#	recordfile.py bench [JSONFILE] - compare formats for the records in JSONFILE,
+	#		or by default, 100000 generated records that look like a busy channel's
+	import random
+	import sys
+	import tempfile
+
+	from monotonic import monotonic
+
+	def to_binary(records, outfile):
+		encoder = BinaryRecordEncoder()
+		outfile.write(encoder.start())
+		for record in records:
+			context = {key: record.pop(key) for key in COMMON_KEYS if key in record}
+			outfile.write(encoder.encode(record, context))
+
+	command, args = sys.argv[1], sys.argv[2:]
+	if command == 'to-json':
+		for record in iter_records(args[0]):
+			sys.stdout.write(json.dumps(record) + '\n')
+	elif command == 'to-binary':
+		with open(args[1], 'wb') as f:
+			to_binary(iter_records(args[0], raw=True), f)
+	elif command == 'bench':
+		if args:
+			json_path = args[0]
+		else:
+			fd, json_path = tempfile.mkstemp()
+			nicks = ['nick{}'.format(i) for i in range(200)]
+			words = 'the quick brown fox jumps over lazy dog lol ok yeah what \xe2\x98\x83 \xff\xfe'.split()
+			with os.fdopen(fd, 'w') as f:
+				for i in xrange(100000):
+					nick = random.choice(nicks)
+					text = ' '.join(random.choice(words) for _ in range(random.randint(1, 20)))
+					target = random.choice(['#channel', '#other', '#third'])
+					command = random.choice(['PRIVMSG'] * 20 + ['NOTICE', 'JOIN', 'PART', 'QUIT', 'MODE'])
+					record = {
+						'command': command, 'sender': nick, 'user': '~' + nick, 'host': 'host-{}.example.com'.format(nick),
+						'target': target, 'payload': text, 'params': [target, text], 'tags': {}, 'ctcp': None,
+						'received_at': 1500000000 + i * 0.5, 'hostname': 'irc.example.com', 'port': 6697, 'ssl': True,
+						'bot_hostname': 'bothost', 'bot_pid': 1234, 'bot_nick': 'ekimbot',
+					}
+					try:
+						f.write(json.dumps(record) + '\n')
+					except UnicodeDecodeError:
+						record.update(_latin1=['params', 'payload'])
+						f.write(json.dumps(record, encoding='latin-1') + '\n')
+		fd, binary_path = tempfile.mkstemp()
+		with os.fdopen(fd, 'wb') as f:
+			to_binary(iter_records(json_path, raw=True), f)
+		for name, path in (('json', json_path), ('binary', binary_path)):
+			size = os.stat(path).st_size
+			times = {}
+			for raw in (False, True):
+				start = monotonic()
+				count = sum(1 for record in iter_records(path, raw))
+				times[raw] = monotonic() - start
+			print "{}: {:.1f}MB for {} records, {:.0f} bytes each. Reads {:.0f} records/sec, {:.0f}/sec as raw str".format(
+				name, size / 1024. / 1024, count, size / float(count), count / times[False], count / times[True],
+			)
+		for raw in (False, True):
+			assert list(iter_records(json_path, raw)) == list(iter_records(binary_path, raw)), "formats disagree"
+		os.remove(binary_path)
+		if not args:
+			os.remove(json_path)
+	else:
+		sys.exit("Unknown command {!r}".format(command))
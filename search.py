@@ -0,0 +1,515 @@
+from array import array
+from bisect import bisect_left, bisect_right
+import calendar
+import marshal
+import os
+import re
+import struct
+import time
+
+import gevent
+
+from ekimbot.botplugin import ClientPlugin
+from ekimbot.commands import CommandHandler
+
+import recordfile
+
+
+# Words are runs of letters and digits. We work on the raw bytes, so count any non-ascii byte as a letter,
+# which keeps utf-8 encoded words in one piece.
+TOKEN_RE = re.compile(r'[a-z0-9\x80-\xff]+')
+
+# Splits a query into "quoted phrases" and other words
+QUERY_RE = re.compile(r'"([^"]*)"|(\S+)')
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 60*60, 'd': 24*60*60, 'w': 7*24*60*60}
+DURATION_RE = re.compile(r'^(\d+)([{}])$'.format(''.join(DURATION_UNITS)))
+DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S')
+
+
+def tokenize(text, min_length):
+	"""Returns the set of words in text we'd index it under"""
+	return {token for token in TOKEN_RE.findall(text.lower()) if len(token) >= min_length}
+
+
+def parse_time(value, now):
+	"""Parse a time given in a search, either how long ago (eg. 3h, 2d) or a UTC date (eg. 2017-01-31, 2017-01-31T12:00).
+	Raises ValueError if it's neither."""
+	match = DURATION_RE.match(value)
+	if match:
+		count, unit = match.groups()
+		return now - int(count) * DURATION_UNITS[unit]
+	for format in DATE_FORMATS:
+		try:
+			return calendar.timegm(time.strptime(value, format))
+		except ValueError:
+			pass
+	raise ValueError("Can't understand time {!r}, give a duration like 3h or 2d, or a date like 2017-01-31".format(value))
+
+
+def format_time(timestamp, format='%Y-%m-%d %H:%M:%SZ'):
+	return time.strftime(format, time.gmtime(timestamp))
+
+
+class MessageStore(object):
+	"""An append-only file of (channel, timestamp, nick, text) for every message we've indexed,
+	so that we don't have to keep their text in memory. Each is referred to by its offset in the file.
+
+	The record file can't serve for this, as its segments may be compressed or in the binary format,
+	neither of which we can seek around in. Entries are a 4 byte length followed by the marshalled tuple.
+	"""
+	LENGTH = struct.Struct('<I')
+
+	def __init__(self, path):
+		self.path = path
+		# Appends are buffered, so we flush before reading or checkpointing
+		self.append_file = open(path, 'ab')
+		self.read_file = open(path, 'rb')
+		self.size = os.fstat(self.append_file.fileno()).st_size
+		self.dirty = False
+
+	def append(self, channel, timestamp, nick, text):
+		"""Add a message, returning its offset"""
+		data = marshal.dumps((channel, timestamp, nick, text))
+		offset = self.size
+		self.append_file.write(self.LENGTH.pack(len(data)) + data)
+		self.size += self.LENGTH.size + len(data)
+		self.dirty = True
+		return offset
+
+	def get(self, offset):
+		"""Returns the (channel, timestamp, nick, text) at offset"""
+		self.flush()
+		self.read_file.seek(offset)
+		length, = self.LENGTH.unpack(self.read_file.read(self.LENGTH.size))
+		return marshal.loads(self.read_file.read(length))
+
+	def replay(self):
+		"""Yields (offset, (channel, timestamp, nick, text)) for every message, in the order they were added"""
+		self.flush()
+		with open(self.path, 'rb') as f:
+			offset = 0
+			while offset < self.size:
+				length, = self.LENGTH.unpack(f.read(self.LENGTH.size))
+				yield offset, marshal.loads(f.read(length))
+				offset += self.LENGTH.size + length
+
+	def truncate(self, size):
+		"""Discard every message from offset size onwards"""
+		self.flush()
+		self.append_file.truncate(size)
+		self.size = size
+
+	def flush(self):
+		if self.dirty:
+			self.append_file.flush()
+			self.dirty = False
+
+	def close(self):
+		self.append_file.close()
+		self.read_file.close()
+
+
+class ChannelLog(object):
+	"""Every message we've indexed for a channel, and an inverted index over them.
+	The messages themselves are in a MessageStore, we only keep their offsets into it.
+
+	Messages are numbered in the order we read them. For each token we keep an array of the numbers
+	of the messages containing it (and likewise for each nick), which are therefore sorted,
+	so we can intersect them by walking them backwards from the newest message.
+	Records are very nearly in time order, but not quite (eg. several processes recording to the same file),
+	so we also keep the latest time seen up to each message, which does only go up.
+	"""
+	# We assume no record is written more than this many seconds after one received after it
+	ORDER_SLACK = 60
+
+	def __init__(self, store):
+		self.store = store
+		self.times = array('d')
+		self.max_times = array('d')
+		self.senders = array('I') # index into nicks
+		self.refs = array('L') # offset of each message in store
+		self.nicks = [] # nicks as first seen
+		self.nick_ids = {} # {lowercase nick: index into nicks}
+		self.nick_postings = {} # {index into nicks: array of message numbers}
+		self.postings = {} # {token: array of message numbers}
+
+	def __len__(self):
+		return len(self.times)
+
+	def text(self, number):
+		channel, timestamp, nick, text = self.store.get(self.refs[number])
+		return text
+
+	def add(self, timestamp, nick, text, ref, min_token_length):
+		"""Index a message, which is at offset ref in our store"""
+		number = len(self.times)
+		self.times.append(timestamp)
+		self.max_times.append(max(timestamp, self.max_times[-1]) if self.max_times else timestamp)
+		nick_id = self.nick_ids.get(nick.lower())
+		if nick_id is None:
+			nick_id = self.nick_ids[nick.lower()] = len(self.nicks)
+			self.nicks.append(nick)
+			self.nick_postings[nick_id] = array('I')
+		self.senders.append(nick_id)
+		self.nick_postings[nick_id].append(number)
+		self.refs.append(ref)
+		for token in tokenize(text, min_token_length):
+			postings = self.postings.get(token)
+			if postings is None:
+				postings = self.postings[token] = array('I')
+			postings.append(number)
+
+	def search(self, tokens, phrases, nick, start, end, limit, deadline):
+		"""Find the newest messages (up to limit) with all the given tokens, containing all the given
+		phrases (lowercase), from nick (if not None), and received between start and end (either may be None).
+		Gives up at time deadline.
+		Returns (hits, complete), where hits is a list of (timestamp, nick, text), newest first,
+		and complete is False if we ran out of time before finding limit hits or checking every candidate.
+		"""
+		lists = []
+		for token in tokens:
+			if token not in self.postings:
+				return [], True
+			lists.append(self.postings[token])
+		if nick is not None:
+			if nick.lower() not in self.nick_ids:
+				return [], True
+			lists.append(self.nick_postings[self.nick_ids[nick.lower()]])
+		if not lists:
+			# nothing to narrow it down, so every message is a candidate
+			lists.append(xrange(len(self.times)))
+		# walk the shortest list, checking the rest for each candidate
+		lists.sort(key=len)
+		driver, others = lists[0], lists[1:]
+		# others[i][:bounds[i]] is all that could contain anything at or before our current candidate
+		bounds = [len(other) for other in others]
+		first = len(driver)
+		if end is not None:
+			# skip everything written after anything from before end could have been
+			first = bisect_left(driver, bisect_right(self.max_times, end + self.ORDER_SLACK))
+		hits = []
+		for i in xrange(first - 1, -1, -1):
+			if i % 256 == 0 and time.time() > deadline:
+				return hits, False
+			number = driver[i]
+			if start is not None and self.max_times[number] < start:
+				break # everything before here is older still
+			timestamp = self.times[number]
+			if (start is not None and timestamp < start) or (end is not None and timestamp > end):
+				continue
+			found = True
+			for j, other in enumerate(others):
+				bounds[j] = bisect_right(other, number, 0, bounds[j])
+				if not bounds[j] or other[bounds[j] - 1] != number:
+					found = False
+					break
+			if not found:
+				continue
+			text = self.text(number)
+			if phrases:
+				lowered = text.lower()
+				if not all(phrase in lowered for phrase in phrases):
+					continue
+			hits.append((timestamp, self.nicks[self.senders[number]], text))
+			if len(hits) >= limit:
+				break
+		return hits, True
+
+
+class SearchPlugin(ClientPlugin):
+	"""Search the messages recorded by the record plugin.
+
+	We read the record file (in either format) into an inverted index per channel,
+	and keep following it as it's written. The messages themselves are kept on disk in a MessageStore.
+	Like nickseen, we save a checkpoint of how far into the file we've got every so often,
+	but as the store already has everything we've indexed, that's all it needs to say.
+	On restart we rebuild the index from the store, then resume reading the file from the checkpoint.
+	"""
+	name = 'search'
+
+	# indexer is either a greenlet if we're still indexing, or None if we've finished indexing.
+	indexer = None
+	checkpointer = None
+	follower = None
+
+	# Reads the record file and the segments rotated out of it, and tracks how far we've got. See recordfile.RecordReader.
+	reader = None
+	store = None
+
+	CHECKPOINT_VERSION = 2
+
+	defaults = {
+		'batch_size': 1000, # how many lines to index before yielding
+		# How often to check the file for new records when we can't be notified of changes.
+		# We start at the min interval and back off to the max while nothing's happening.
+		'follow_min_interval': 0.1,
+		'follow_max_interval': 10,
+		'checkpoint_file': None, # None means FILENAME.search.HOSTNAME
+		'checkpoint_interval': 300, # how often to save a checkpoint, in seconds
+		'store_file': None, # where to keep the text of messages, None means CHECKPOINT_FILE.texts
+		'min_token_length': 2, # shorter words aren't indexed, and are matched as phrases instead
+		'max_results': 3, # how many messages to show for a search
+		# Give up on a search after this many seconds and show what we've found.
+		# The search doesn't yield, so this is how long it can hold up everything else.
+		'time_budget': 0.05,
+	}
+
+	@property
+	def checkpoint_path(self):
+		if self.config.checkpoint_file is not None:
+			return self.config.checkpoint_file
+		return '{}.search.{}'.format(self.config.filename, self.client.hostname)
+
+	def init(self):
+		self.channels = {}
+		self.store = MessageStore(
+			self.config.store_file if self.config.store_file is not None
+			else '{}.texts'.format(self.checkpoint_path)
+		)
+		self.reader = recordfile.RecordReader(
+			self.config.filename, self.client.hostname, self.logger, batch_size=self.config.batch_size,
+		)
+		self.indexer = gevent.spawn(self.index, self.config.filename)
+		self.checkpointer = gevent.spawn(self.checkpoint_loop)
+
+	def cleanup(self):
+		if self.checkpointer:
+			self.checkpointer.kill()
+		if self.indexer:
+			self.indexer.kill()
+		if self.follower:
+			self.follower.kill()
+		try:
+			self.save_checkpoint()
+		except Exception:
+			self.logger.warning("Failed to save checkpoint", exc_info=True)
+		self.reader.close()
+		self.store.close()
+
+	def index(self, filepath):
+		"""Read everything already recorded, starting from our checkpoint if we have one, then follow the file.
+		Unlike nickseen, reading a message twice would index it twice, so we must never read from anywhere
+		but exactly where our store leaves off."""
+		checkpoint = recordfile.load_checkpoint(self.checkpoint_path, self.CHECKPOINT_VERSION, self.logger)
+		if checkpoint is not None and checkpoint['min_token_length'] != self.config.min_token_length:
+			self.logger.info("Checkpoint was indexed with a different min_token_length, indexing from scratch")
+			checkpoint = None
+		if checkpoint is not None and checkpoint['store_size'] > self.store.size:
+			self.logger.info("Message store {} is missing messages in checkpoint, indexing from scratch".format(self.store.path))
+			checkpoint = None
+		if self.reader.open(checkpoint and checkpoint['position']):
+			# Anything after the checkpoint's end of the store is read from the file again, so drop it
+			self.store.truncate(checkpoint['store_size'])
+			self.replay_store()
+		else:
+			self.store.truncate(0)
+			# Older records may have been rotated out of the file, so start with them
+			for msg in self.reader.read_segments():
+				self.index_message(msg)
+		for msg in self.reader.read():
+			self.index_message(msg)
+		self.logger.info("Indexer finished, indexed {} messages in {} channels".format(
+			sum(len(log) for log in self.channels.values()), len(self.channels),
+		))
+		self.indexer = None
+		self.follower = gevent.spawn(self.follow)
+
+	def replay_store(self):
+		"""Rebuild our index from the messages in our store"""
+		self.logger.info("Rebuilding index from {} bytes of messages in {}".format(self.store.size, self.store.path))
+		for i, (ref, (channel, timestamp, nick, text)) in enumerate(self.store.replay()):
+			# Every so often, let other things run, as this is cpu-intensive.
+			if i % self.config.batch_size == 0:
+				gevent.idle()
+			self.add_message(channel, timestamp, nick, text, ref)
+
+	def index_message(self, msg):
+		channel = self.client.normalize_channel(msg['target'])
+		ref = self.store.append(channel, msg['received_at'], msg['sender'], msg['payload'])
+		self.add_message(channel, msg['received_at'], msg['sender'], msg['payload'], ref)
+
+	def add_message(self, channel, timestamp, nick, text, ref):
+		if channel not in self.channels:
+			self.channels[channel] = ChannelLog(self.store)
+		self.channels[channel].add(timestamp, nick, text, ref, self.config.min_token_length)
+
+	def follow(self):
+		"""Index new lines from the record file as they're written, following it if it's rotated"""
+		try:
+			for msg in self.reader.follow(self.config.follow_min_interval, self.config.follow_max_interval):
+				self.index_message(msg)
+		except Exception:
+			self.logger.exception("Failed to follow message record file {}, new messages won't be searchable".format(self.config.filename))
+
+	def checkpoint_loop(self):
+		while True:
+			gevent.sleep(self.config.checkpoint_interval)
+			try:
+				self.save_checkpoint()
+			except Exception:
+				self.logger.warning("Failed to save checkpoint", exc_info=True)
+
+	def save_checkpoint(self):
+		"""Save exactly how far into the file our store covers, so we can resume from there on restart.
+		Everything we've indexed is already in the store, so this only has to flush it."""
+		position = self.reader.position()
+		if position is None:
+			return # nowhere to resume from yet, see RecordReader.position()
+		self.store.flush()
+		recordfile.save_checkpoint(self.checkpoint_path, {
+			'version': self.CHECKPOINT_VERSION,
+			'position': position,
+			'min_token_length': self.config.min_token_length,
+			'store_size': self.store.size,
+		})
+		self.logger.debug("Saved checkpoint at offset {} of {}".format(position['offset'], self.config.filename))
+
+	def _search(self, msg, args, commandname):
+		if self.client.matches_nick(msg.target):
+			# PM, require channel
+			channel, args = args[0], args[1:]
+		elif args[0].startswith('#'):
+			channel, args = args[0], args[1:]
+		else:
+			channel = msg.target
+		channel = self.client.normalize_channel(channel)
+
+		tokens = set()
+		phrases = []
+		nick = start = end = None
+		now = time.time()
+		for phrase, word in QUERY_RE.findall(' '.join(args)):
+			if word:
+				key, sep, value = word.partition(':')
+				try:
+					if sep and key == 'nick':
+						nick = value
+						continue
+					if sep and key == 'since':
+						start = parse_time(value, now)
+						continue
+					if sep and key == 'until':
+						end = parse_time(value, now)
+						continue
+				except ValueError as e:
+					self.reply(msg, str(e))
+					return
+				phrase = word
+			phrase = phrase.lower()
+			phrase_tokens = tokenize(phrase, self.config.min_token_length)
+			tokens |= phrase_tokens
+			# a lone word we've indexed needs no further checking, anything else does
+			if phrase.strip() and phrase_tokens != {phrase}:
+				phrases.append(phrase)
+		if not tokens and not phrases and nick is None:
+			self.reply(msg, "What do you want to search for? Format is '{} [CHANNEL] [nick:NICK] [since:TIME] [until:TIME] WORDS \"OR PHRASES\"'".format(commandname))
+			return
+
+		if self.indexer:
+			self.reply(msg, "I'm still indexing existing logs, I may be missing older messages:")
+
+		if channel not in self.channels:
+			self.reply(msg, "I don't know of any channel called {!r}".format(channel))
+			return
+
+		limit = self.config.max_results
+		hits, complete = self.channels[channel].search(
+			tokens, phrases, nick, start, end, limit + 1, time.time() + self.config.time_budget,
+		)
+		if not hits:
+			self.reply(msg, "No matches" if complete else "No matches found before I ran out of time, try narrowing it down")
+			return
+		for timestamp, sender, text in hits[:limit]:
+			self.reply(msg, "[{}] <{}> {}".format(format_time(timestamp), sender, text))
+		if len(hits) > limit:
+			self.reply(msg, "Showing the newest {} matches, there are more".format(limit))
+		elif not complete:
+			self.reply(msg, "I ran out of time searching, there may be older matches")
+
+	@CommandHandler("search", 1)
+	def search(self, msg, *args):
+		"""Search the logs of this channel, newest first
+
+		Format is: search [CHANNEL] [nick:NICK] [since:TIME] [until:TIME] WORDS "OR PHRASES"
+		Matches messages with all the given words and phrases, ignoring case.
+		TIME is how long ago (eg. 3h, 2d) or a UTC date (eg. 2017-01-31).
+		If asked via PM, you must specify the channel.
+		"""
+		self._search(msg, args, 'search')
+
+	@CommandHandler("grep", 1)
+	def grep(self, msg, *args):
+		"""Search the logs of this channel, newest first
+
+		The same as the search command.
+		"""
+		self._search(msg, args, 'grep')
+
+	@CommandHandler("searchstats", 0)
+	def searchstats(self, msg, *args):
+		"""Show how much of the logs are searchable"""
+		self.reply(msg, "{}{} messages in {} channels, with {} distinct words".format(
+			"Still indexing. " if self.indexer else "",
+			sum(len(log) for log in self.channels.values()), len(self.channels),
+			sum(len(log.postings) for log in self.channels.values()),
+		))
+
+
+if __name__ == '__main__':
+	# Benchmark indexing and searching a channel of generated messages.
+	# Args are: number of messages (default 500000)
+	import random
+	import sys
+	import tempfile
+
+	from monotonic import monotonic
+
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+	words = [''.join(random.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(random.randint(2, 8))) for _ in range(5000)]
+	# roughly zipfian, so some words are very common and most are rare
+	weights = [1. / (i + 1) for i in range(len(words))]
+	cumulative = []
+	total = 0
+	for weight in weights:
+		total += weight
+		cumulative.append(total)
+	def word():
+		return words[bisect_right(cumulative, random.random() * total)]
+	nicks = ['nick{}'.format(i) for i in range(300)]
+
+	_, store_path = tempfile.mkstemp(suffix='.texts')
+	store = MessageStore(store_path)
+	log = ChannelLog(store)
+	start = monotonic()
+	for i in xrange(count):
+		nick = random.choice(nicks)
+		text = ' '.join(word() for _ in range(random.randint(1, 15)))
+		log.add(1500000000 + i, nick, text, store.append('#channel', 1500000000 + i, nick, text), 2)
+	elapsed = monotonic() - start
+	print "indexed {} messages in {:.1f}s, {:.0f}/sec, {} distinct tokens".format(count, elapsed, count / elapsed, len(log.postings))
+
+	queries = [
+		('common word', [words[0]], [], None, None),
+		('two common words', [words[0], words[1]], [], None, None),
+		('rare word', [words[-1]], [], None, None),
+		('common word + nick', [words[0]], [], 'nick7', None),
+		('rare word + nick', [words[-1]], [], 'nick7', None),
+		('phrase', [words[3], words[4]], ['{} {}'.format(words[3], words[4])], None, None),
+		('two rare words', [words[-1], words[-2]], [], None, None),
+		('common word, last 10%', [words[0]], [], None, 1500000000 + count * 0.9),
+		('rare word, first 10%', [words[-1]], [], None, (None, 1500000000 + count * 0.1)),
+		('common word, first 10%', [words[0]], [], None, (None, 1500000000 + count * 0.1)),
+		('nothing indexed', [], ['x'], None, None),
+	]
+	for name, tokens, phrases, nick, times in queries:
+		since, until = times if isinstance(times, tuple) else (times, None)
+		start = monotonic()
+		runs = 20
+		for _ in range(runs):
+			hits, complete = log.search(set(tokens), phrases, nick, since, until, 4, time.time() + 0.05)
+		elapsed = (monotonic() - start) / runs
+		print "{}: {:.2f}ms, {} hits{}".format(name, elapsed * 1000, len(hits), "" if complete else " (ran out of time)")
+
+	store.close()
+	os.remove(store_path)
@@ -1,8 +1,18 @@
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+import errno
+import heapq
+import json
+import os
 import time
 import re
+import sre_parse
+from sre_constants import (
+	ASSERT, ASSERT_NOT, BRANCH, GROUPREF, GROUPREF_EXISTS, LITERAL, MAX_REPEAT, MIN_REPEAT, SUBPATTERN,
+)
 
+import gevent
 import signaltimeout
+from gevent.event import Event
 
 from girc import Handler
 from girc.message import Notice, Privmsg
@@ -33,41 +43,537 @@ class Tell(namedtuple('Tell', ['sender', 'send_time', 'target', 'after', 'text']
 		)
 
 
+# How many variable-length repeats (eg. *, +, {1,5}) a pattern can have and still be safe.
+# With k of them, matching a string of length n can take around n^(k+1) steps.
+MAX_VARIABLE_REPEATS = 3
+
+
+def is_safe_pattern(pattern):
+	"""Returns whether regex pattern is in a subset we know can't backtrack catastrophically on a short string,
+	so it's safe to run without a timeout. That means no backreferences or lookarounds, no repeats containing
+	other variable-length repeats or alternations, and only a few variable-length repeats in total."""
+	try:
+		parsed = sre_parse.parse(pattern)
+	except Exception:
+		return False
+	repeats = [0]
+
+	def check(subpattern, in_repeat):
+		for op, av in subpattern:
+			if op in (GROUPREF, GROUPREF_EXISTS, ASSERT, ASSERT_NOT):
+				return False
+			if op in (MAX_REPEAT, MIN_REPEAT):
+				min, max, item = av
+				if min != max:
+					if in_repeat:
+						return False
+					repeats[0] += 1
+				if not check(item, in_repeat or max > 1):
+					return False
+			elif op == BRANCH:
+				if in_repeat:
+					return False
+				_, branches = av
+				if not all(check(branch, in_repeat) for branch in branches):
+					return False
+			elif op == SUBPATTERN:
+				_, item = av
+				if not check(item, in_repeat):
+					return False
+		return True
+
+	return check(parsed, False) and repeats[0] <= MAX_VARIABLE_REPEATS
+
+
+# Characters with special meaning in a regex. Targets without any of these are literal strings.
+REGEX_METACHARACTERS = set('.^$*+?{}[]\\|()')
+
+
+def is_literal(target):
+	return not any(c in REGEX_METACHARACTERS for c in target)
+
+
+class TargetMatcher(object):
+	"""Holds pending tells indexed by target, and finds which targets (regexes) match a name.
+
+	Most targets are just a nick, with no regex metacharacters. These are kept in a set, and we find
+	the ones that match a name by looking up each of its substrings (of the lengths we have targets for),
+	as a regex search would match the literal anywhere in the name.
+
+	Other targets are compiled once, when first added. Targets that are safe (see is_safe_pattern) are run
+	without a timeout, and are also combined into a few large alternations. Most names match no targets at all,
+	so this lets us rule them out with a few searches instead of one per target. Only names that match
+	a combined pattern are checked against its targets individually.
+	Unsafe targets are always checked individually, under an AlarmTimeout.
+	"""
+	# Even safe patterns could be slow on a long enough name, so past this length we treat every pattern as unsafe
+	MAX_SAFE_NAME_LENGTH = 64
+	# python 2's re supports at most 100 groups in a pattern, so combined patterns must be split up before then
+	MAX_GROUPS = 99
+
+	def __init__(self, timeout):
+		self.timeout = timeout
+		self.targets = {} # {target: [pending tells with that target]}
+		self.literals = set()
+		self.literal_lengths = {} # {length: number of literal targets of that length}
+		self.compiled = {} # {target: compiled pattern}, for non-literal targets
+		self.unsafe = set()
+		# list of (combined pattern, [targets in it]), or None if it needs rebuilding
+		self._combined = None
+
+	def add(self, tell):
+		target = tell.target
+		if target not in self.targets:
+			self.targets[target] = []
+			if is_literal(target):
+				self.literals.add(target)
+				self.literal_lengths[len(target)] = self.literal_lengths.get(len(target), 0) + 1
+			else:
+				self.compiled[target] = re.compile(target)
+				if not is_safe_pattern(target):
+					self.unsafe.add(target)
+				self._combined = None
+		self.targets[target].append(tell)
+
+	def remove(self, tell):
+		target = tell.target
+		tells = self.targets[target]
+		tells.remove(tell)
+		if tells:
+			return
+		del self.targets[target]
+		if target in self.literals:
+			self.literals.remove(target)
+			self.literal_lengths[len(target)] -= 1
+			if not self.literal_lengths[len(target)]:
+				del self.literal_lengths[len(target)]
+		else:
+			del self.compiled[target]
+			self.unsafe.discard(target)
+			self._combined = None
+
+	def combined(self):
+		if self._combined is not None:
+			return self._combined
+		self._combined = []
+		chunk = []
+		group_names = set()
+		group_count = 0
+		def flush():
+			try:
+				pattern = re.compile('|'.join('(?:{})'.format(target) for target in chunk))
+			except Exception:
+				# shouldn't happen, but fall back to each target on its own
+				self._combined += [(self.compiled[target], [target]) for target in chunk]
+			else:
+				self._combined.append((pattern, chunk))
+		for target in sorted(set(self.compiled) - self.unsafe):
+			pattern = self.compiled[target]
+			if pattern.flags:
+				# inline flags like (?x) apply to the whole pattern, so it can't share
+				self._combined.append((pattern, [target]))
+				continue
+			if chunk and (group_count + pattern.groups > self.MAX_GROUPS or group_names & set(pattern.groupindex)):
+				flush()
+				chunk = []
+				group_names = set()
+				group_count = 0
+			chunk.append(target)
+			group_names.update(pattern.groupindex)
+			group_count += pattern.groups
+		if chunk:
+			flush()
+		return self._combined
+
+	def match(self, target, name):
+		"""Returns whether target matches name. target needn't have been added."""
+		if is_literal(target):
+			return target in name
+		pattern = self.compiled.get(target)
+		if pattern is None:
+			pattern = re.compile(target)
+		if len(name) <= self.MAX_SAFE_NAME_LENGTH and target in self.compiled and target not in self.unsafe:
+			return pattern.search(name) is not None
+		# to prevent pathological regex performance, we need to interrupt the regex engine
+		# the only way to do this is by raising from a signal
+		try:
+			with signaltimeout.AlarmTimeout(self.timeout):
+				return pattern.search(name) is not None
+		except signaltimeout.Timeout:
+			return False
+
+	def matching(self, name):
+		"""Returns the set of targets that match name"""
+		matching = set()
+		for length in self.literal_lengths:
+			for start in range(len(name) - length + 1):
+				if name[start:start+length] in self.literals:
+					matching.add(name[start:start+length])
+		if len(name) > self.MAX_SAFE_NAME_LENGTH:
+			matching.update(target for target in self.compiled if self.match(target, name))
+			return matching
+		for pattern, targets in self.combined():
+			if pattern.search(name):
+				matching.update(target for target in targets if self.compiled[target].search(name))
+		matching.update(target for target in self.unsafe if self.match(target, name))
+		return matching
+
+
+def required_literal(pattern):
+	"""Returns the longest literal string that anything pattern matches must contain,
+	as far as we can easily tell, or None if we can't tell. If pattern ignores case, the literal is lowercased."""
+	try:
+		parsed = sre_parse.parse(pattern)
+	except Exception:
+		return None
+	best = ''
+	run = ''
+	for op, av in parsed:
+		if op == LITERAL and av < 256:
+			run += chr(av)
+			continue
+		best = max(best, run, key=len)
+		run = ''
+	best = max(best, run, key=len)
+	if parsed.pattern.flags & re.IGNORECASE:
+		best = best.lower()
+	return best
+
+
+def trigrams(s):
+	return set(s[i:i+3] for i in range(len(s) - 2))
+
+
+class NameCache(object):
+	"""Caches names that currently have no tells due, so we don't need to check them again.
+	Names must be invalidated when a tell that matches them is added, or becomes due.
+
+	We keep at most size names, evicting the least recently used, and forget names after ttl seconds.
+	Cached names are indexed by trigram, so that when a tell is added we only need to check
+	the names that could contain the target's required literal (see required_literal()),
+	rather than every name.
+	"""
+	def __init__(self, size, ttl):
+		self.size = size
+		self.ttl = ttl
+		# {name: time cached}, in least to most recently used order
+		self.entries = OrderedDict()
+		# {trigram: set of names containing it}
+		self.index = {}
+		self.hits = 0
+		self.misses = 0
+		self.invalidations = 0
+		self.evictions = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	def _remove(self, name):
+		del self.entries[name]
+		for trigram in trigrams(name):
+			names = self.index[trigram]
+			names.discard(name)
+			if not names:
+				del self.index[trigram]
+
+	def check(self, name, now):
+		"""Returns True if name is cached as having no tells due as of now"""
+		cached_at = self.entries.get(name)
+		if cached_at is None:
+			self.misses += 1
+			return False
+		if now - cached_at > self.ttl:
+			self._remove(name)
+			self.evictions += 1
+			self.misses += 1
+			return False
+		# mark as most recently used
+		del self.entries[name]
+		self.entries[name] = cached_at
+		self.hits += 1
+		return True
+
+	def set(self, name, now):
+		if name in self.entries:
+			del self.entries[name]
+		else:
+			for trigram in trigrams(name):
+				self.index.setdefault(trigram, set()).add(name)
+		self.entries[name] = now
+		while len(self.entries) > self.size:
+			oldest = next(iter(self.entries))
+			self._remove(oldest)
+			self.evictions += 1
+
+	def invalidate(self, name):
+		self._remove(name)
+		self.invalidations += 1
+
+	def candidates(self, target):
+		"""Returns the cached names that target might match"""
+		literal = required_literal(target)
+		if literal is None or len(literal) < 3:
+			return list(self.entries)
+		sets = sorted((self.index.get(trigram, set()) for trigram in trigrams(literal)), key=len)
+		return list(sets[0].intersection(*sets[1:]))
+
+
+class TellJournal(object):
+	"""Persists pending tells as an append-only log of tells being added and removed,
+	so each change costs one small write rather than re-saving every pending tell.
+
+	Each line is a JSON list [op, tell fields], where op is "add" or "remove".
+	When the log gets long compared to the number of pending tells, compact() rewrites it
+	with one "add" for each pending tell.
+	"""
+	# Compact once there are more than this many records, plus two per pending tell
+	COMPACT_MIN_RECORDS = 1000
+
+	def __init__(self, path, fsync=False, logger=None):
+		self.path = path
+		self.fsync = fsync
+		self.logger = logger
+		self.file = None
+		# number of records in the file
+		self.records = 0
+		# while compacting, a list of lines written since we started
+		self.compacting = None
+
+	def load(self):
+		"""Replay the journal, returning the pending tells as {sender: [tell]}, and open it for appending"""
+		tells = {}
+		valid_end = 0
+		try:
+			f = open(self.path, 'rb')
+		except IOError as e:
+			if e.errno != errno.ENOENT:
+				raise
+		else:
+			with f:
+				for line in f:
+					if not line.endswith('\n'):
+						# we crashed part way through writing this record, so it never happened
+						break
+					valid_end += len(line)
+					try:
+						op, fields = json.loads(line)
+						tell = Tell(*fields)
+					except Exception:
+						if self.logger:
+							self.logger.warning("Skipping unreadable record in tell journal: {!r}".format(line))
+						continue
+					self.apply(tells, op, tell)
+					self.records += 1
+				f.seek(0, os.SEEK_END)
+				size = f.tell()
+			if valid_end < size:
+				if self.logger:
+					self.logger.warning("Discarding {} bytes of incomplete record from end of tell journal".format(size - valid_end))
+				# so the next record starts on its own line
+				with open(self.path, 'r+b') as f:
+					f.truncate(valid_end)
+		self.file = open(self.path, 'ab')
+		return tells
+
+	@staticmethod
+	def apply(tells, op, tell):
+		key = tell.sender.lower()
+		if op == 'add':
+			tells.setdefault(key, []).append(tell)
+		elif op == 'remove':
+			pending = tells.get(key, [])
+			if tell in pending:
+				pending.remove(tell)
+			if not pending:
+				tells.pop(key, None)
+		else:
+			raise ValueError("Unknown tell journal op: {!r}".format(op))
+
+	def encode(self, op, tell):
+		return json.dumps([op, list(tell)]) + '\n'
+
+	def append(self, op, tell):
+		line = self.encode(op, tell)
+		self.file.write(line)
+		self.records += 1
+		if self.compacting is not None:
+			self.compacting.append(line)
+
+	def flush(self):
+		"""Call after appending. Makes sure everything's written, so a crash can only lose the record being written."""
+		self.file.flush()
+		if self.fsync:
+			os.fsync(self.file.fileno())
+
+	def needs_compaction(self, pending_count):
+		return self.compacting is None and self.records > self.COMPACT_MIN_RECORDS + 2 * pending_count
+
+	def compact(self, tells):
+		"""Rewrite the journal to only contain the given {sender: [tell]}, yielding while we do so.
+		Records appended in the meantime are carried over."""
+		# take a copy now, as tells may change while we yield
+		snapshot = [tell for pending in tells.values() for tell in pending]
+		self.compacting = []
+		try:
+			tmp_path = '{}.tmp'.format(self.path)
+			with open(tmp_path, 'wb') as f:
+				for i, tell in enumerate(snapshot):
+					if i % 1000 == 0:
+						gevent.idle()
+					f.write(self.encode('add', tell))
+				# from here on we don't yield, so nothing else can append until we're done
+				f.writelines(self.compacting)
+				f.flush()
+				os.fsync(f.fileno())
+			os.rename(tmp_path, self.path)
+			self.file.close()
+			self.file = open(self.path, 'ab')
+			self.records = len(snapshot) + len(self.compacting)
+		finally:
+			self.compacting = None
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+
 class TellPlugin(ClientPlugin):
 	name = 'tell'
 
 	defaults = {
 		'max_matches': 3,
 		'regex_timeout': 0.1,
+		'name_cache_size': 10000, # max number of names to cache as having no pending tells
+		'name_cache_ttl': 24 * 60 * 60, # how long to cache a name for, in seconds
+		# When a tellafter becomes due, by default it's delivered the next time the target speaks.
+		# Set this to 'privmsg' or 'notice' to instead deliver it immediately, if the target is
+		# in a channel we're in, by sending a message of that type to the channel.
+		'proactive_delivery': None,
+		# If set, keep pending tells in a journal at this path (see TellJournal) instead of the store.
+		# Any tells already in the store are moved to the journal.
+		'journal_file': None,
+		'journal_fsync': False, # fsync the journal after each change, not just flush it
 	}
 
+	journal = None
+	compactor = None
+
 	def init(self):
-		# name cache contains names that currently have no pending tells.
-		# The value is None, or a time at which their next tell is scheduled.
-		# Note that due to rtell not evicting things, there's no guarentee there is actually
-		# a tell waiting at the next scheduled time.
-		# TODO evict old nicks that haven't been seen in ages
-		self.name_cache = {}
+		self.name_cache = NameCache(self.config.name_cache_size, self.config.name_cache_ttl)
 		# We can't save namedtuples into JSON, so we do a conversion pass on init
-		self.tells = {sender: [Tell(*tell) for tell in tells] for sender, tells in self.tells.items()}
+		tells = {sender: [Tell(*tell) for tell in tells] for sender, tells in self.store.get('tells', {}).items()}
+		if self.config.journal_file:
+			self.journal = TellJournal(self.config.journal_file, self.config.journal_fsync, self.logger)
+			migrate = tells and not os.path.exists(self.config.journal_file)
+			self._tells = self.journal.load()
+			if tells and not migrate:
+				self.logger.warning("Ignoring {} pending tells in store, as journal already exists".format(sum(map(len, tells.values()))))
+			if migrate:
+				self.logger.info("Moving {} pending tells from store to journal".format(sum(map(len, tells.values()))))
+				self.journal.compact(tells)
+				self._tells = tells
+				del self.store['tells']
+				self.save_store()
+		else:
+			self.tells = tells
+		# matcher holds the targets of all pending tells
+		self.matcher = TargetMatcher(self.config.regex_timeout)
+		for tells in self.tells.values():
+			for tell in tells:
+				self.matcher.add(tell)
+		# heap of (after, tell) for tells with an after time. We don't remove tells from here when they're
+		# delivered or removed, instead they're ignored when they come up if they're no longer pending.
+		self.schedule = [(tell.after, tell) for tells in self.tells.values() for tell in tells if tell.after is not None]
+		heapq.heapify(self.schedule)
+		self.schedule_changed = Event()
+		self.scheduler = gevent.spawn(self.run_schedule)
+
+	def cleanup(self):
+		self.scheduler.kill()
+		if self.compactor:
+			self.compactor.kill()
+		if self.journal:
+			self.journal.close()
 
 	@property
 	def tells(self):
+		if self.journal:
+			return self._tells
 		return self.store.setdefault('tells', {})
 	@tells.setter
 	def tells(self, value):
 		self.store['tells'] = value
 
+	def save_tells(self, added=(), removed=()):
+		"""Persist the given changes to pending tells"""
+		if not self.journal:
+			self.save_store()
+			return
+		for tell in added:
+			self.journal.append('add', tell)
+		for tell in removed:
+			self.journal.append('remove', tell)
+		self.journal.flush()
+		# The journal only knows it's compacting once the compactor starts running,
+		# so we also check there isn't one spawned but yet to start
+		if (self.compactor is None or self.compactor.ready()) and self.journal.needs_compaction(
+			sum(len(tells) for tells in self.tells.values())
+		):
+			self.compactor = gevent.spawn(self.journal.compact, self.tells)
+
 	def add_tell(self, sender, target, after, text):
-		self.tells.setdefault(sender.lower(), []).append(Tell(sender, time.time(), target, after, text))
-		# invalidate matching nicks from cache
-		for name in self.name_cache.keys():
-			if self.match(target, name):
-				# either invalidate completely, or update next scheduled time
-				if after is None:
-					del self.name_cache[name]
-				elif self.name_cache[name] is None or self.name_cache[name] > after:
-					self.name_cache[name] = after
+		tell = Tell(sender, time.time(), target, after, text)
+		self.tells.setdefault(sender.lower(), []).append(tell)
+		self.matcher.add(tell)
+		if after is None:
+			self.invalidate_cache(target)
+		else:
+			# it isn't due yet, so the cache remains correct until it is
+			heapq.heappush(self.schedule, (after, tell))
+			self.schedule_changed.set()
+		return tell
+
+	def invalidate_cache(self, target):
+		"""Invalidate cached names that target matches"""
+		for name in self.name_cache.candidates(target):
+			if self.matcher.match(target, name):
+				self.name_cache.invalidate(name)
+
+	def run_schedule(self):
+		"""Waits for each tellafter to become due, then invalidates the cache for it and
+		delivers it if we're doing proactive delivery"""
+		while True:
+			now = time.time()
+			due = []
+			while self.schedule and self.schedule[0][0] <= now:
+				_, tell = heapq.heappop(self.schedule)
+				if tell in self.tells.get(tell.sender.lower(), []):
+					due.append(tell)
+			for tell in due:
+				self.invalidate_cache(tell.target)
+			if due and self.config.proactive_delivery:
+				try:
+					self.deliver_due(due, now)
+				except Exception:
+					self.logger.exception("Failed to proactively deliver tells")
+			self.schedule_changed.clear()
+			self.schedule_changed.wait(self.schedule[0][0] - now if self.schedule else None)
+
+	def deliver_due(self, due, now):
+		"""Deliver any pending tells to nicks in our channels that match the targets of the due tells"""
+		if not self.client.is_master():
+			return
+		message_type = {'privmsg': Privmsg, 'notice': Notice}[self.config.proactive_delivery]
+		delivered = set()
+		for channel in self.client.joined_channels:
+			for nick in channel.users.users:
+				name = nick.lower()
+				if name in delivered or not any(self.matcher.match(tell.target, name) for tell in due):
+					continue
+				delivered.add(name)
+				for tell in self.take_due_tells(name, now):
+					message_type(self.client, channel.name, self.format_tell(nick, tell)).send()
 
 	@CommandHandler('tell', 2)
 	def tell(self, msg, target, *text):
@@ -78,12 +584,11 @@ class TellPlugin(ClientPlugin):
 		targets = target.split('&')
 		if not self.validate_targets(msg, targets):
 			return
-		for target in set(targets):
-			self.add_tell(msg.sender, target, None, ' '.join(text))
+		added = [self.add_tell(msg.sender, target, None, ' '.join(text)) for target in set(targets)]
 		self.reply(msg, "Ok, I'll tell {} next time I see them speak".format(
 			human_list(targets)
 		))
-		self.save_store()
+		self.save_tells(added=added)
 
 	@CommandHandler('tellafter', 3)
 	def tellafter(self, msg, target, after, *text):
@@ -101,12 +606,11 @@ class TellPlugin(ClientPlugin):
 			self.reply(msg, "Sorry, for now I only take epoch time. Yell at ekimekim to fix this.")
 			return
 
-		for target in set(targets):
-			self.add_tell(msg.sender, target, after, ' '.join(text))
+		added = [self.add_tell(msg.sender, target, after, ' '.join(text)) for target in set(targets)]
 		self.reply(msg, "Ok, I'll tell {} next time I see them speak after {}".format(
 			human_list(targets), time.strftime(TIME_FORMAT, time.gmtime(after))
 		))
-		self.save_store()
+		self.save_tells(added=added)
 
 	def validate_targets(self, msg, targets):
 		for target in targets:
@@ -153,11 +657,16 @@ class TellPlugin(ClientPlugin):
 			notice("Did not find any pending tells matching {!r}".format(text))
 			return
 
-		self.tells[msg.sender.lower()] = pending
+		if pending:
+			self.tells[msg.sender.lower()] = pending
+		else:
+			del self.tells[msg.sender.lower()]
+		for tell in removed:
+			self.matcher.remove(tell)
 		notice("Removed the following tells:")
 		for tell in removed:
 			notice(str(tell))
-		self.save_store()
+		self.save_tells(removed=removed)
 
 	@Handler(command=Privmsg)
 	def check_message(self, client, msg):
@@ -165,48 +674,188 @@ class TellPlugin(ClientPlugin):
 		now = time.time()
 
 		# short circuit if name cache says no match
-		if name in self.name_cache:
-			until = self.name_cache[name]
-			if until is None or until > now:
-				return
-			del self.name_cache[name]
-
-		unmatched = {}
-		matched = []
-		until = None
-		for tell_sender, tells in self.tells.items():
-			for tell in tells:
-				if len(matched) < self.config.max_matches and self.match(tell.target, name):
-					if tell.after is None or now >= tell.after:
-						matched.append(tell)
-						continue
-					elif tell.after is not None and (until is None or tell.after < until):
-						# we track the next scheduled match for storage in cache later
-						until = tell.after
-				unmatched.setdefault(tell_sender, []).append(tell)
+		if self.name_cache.check(name, now):
+			return
+
+		for tell in self.take_due_tells(name, now):
+			self.reply(msg, self.format_tell(msg.sender, tell))
 
-		assert len(matched) + sum(len(tells) for tells in unmatched.values()) == sum(len(tells) for tells in self.tells.values()), "{}, {}, {}".format(matched, unmatched, self.tells)
-		assert len(matched) <= self.config.max_matches, "{}, {}".format(self.config.max_matches, matched)
+	def format_tell(self, nick, tell):
+		return "{nick}: {tell.text} (from {tell.sender} at {send_time})".format(
+			nick=nick, tell=tell, send_time=time.strftime(TIME_FORMAT, time.gmtime(tell.send_time)),
+		)
 
+	def take_due_tells(self, name, now):
+		"""Remove and return up to max_matches tells that are due to be delivered to name"""
+		# only look at the tells whose targets match, oldest first
+		due = sorted(
+			(
+				tell
+				for target in self.matcher.matching(name)
+				for tell in self.matcher.targets[target]
+				if tell.after is None or now >= tell.after
+			),
+			key=lambda tell: tell.send_time,
+		)
+		matched = due[:self.config.max_matches]
+
+		# update pending tells, removing only what matched rather than rebuilding everything
+		for tell in matched:
+			pending = self.tells[tell.sender.lower()]
+			pending.remove(tell)
+			if not pending:
+				del self.tells[tell.sender.lower()]
+			self.matcher.remove(tell)
 		if matched:
-			# update pending tells and reply with the matched tells
-			self.tells = unmatched
-			for tell in matched:
-				self.reply(msg, "{msg.sender}: {tell.text} (from {tell.sender} at {send_time})".format(
-					msg=msg, tell=tell, send_time=time.strftime(TIME_FORMAT, time.gmtime(tell.send_time)),
-				))
-			self.save_store()
+			self.save_tells(removed=matched)
 
 		# we may have hit limit and not done all pending tells, if so we DON'T log this in cache
-		if len(matched) <= self.config.max_matches:
+		if len(due) <= self.config.max_matches:
 			# No matches, or no matches left. Save it in cache.
-			self.name_cache[name] = until
+			self.name_cache.set(name, now)
+
+		return matched
+
+	@CommandHandler('tellstats', 0)
+	def tellstats(self, msg):
+		"""Show statistics about pending tells and the name cache"""
+		cache = self.name_cache
+		lookups = cache.hits + cache.misses
+		self.reply(msg, (
+			"{tells} pending tells for {targets} distinct targets ({literals} literal, {unsafe} needing a timeout). "
+			"Name cache: {size}/{max_size} names, {hits} hits, {misses} misses ({rate:.0%} hit rate), "
+			"{invalidations} invalidations, {evictions} evictions"
+		).format(
+			tells=sum(len(tells) for tells in self.tells.values()),
+			targets=len(self.matcher.targets), literals=len(self.matcher.literals), unsafe=len(self.matcher.unsafe),
+			size=len(cache), max_size=cache.size, hits=cache.hits, misses=cache.misses,
+			rate=float(cache.hits) / lookups if lookups else 0,
+			invalidations=cache.invalidations, evictions=cache.evictions,
+		))
 
-	def match(self, target, name):
-		# to prevent pathological regex performance, we need to interrupt the regex engine
-		# the only way to do this is by raising from a signal
-		try:
-			with signaltimeout.AlarmTimeout(self.config.regex_timeout):
-				return re.search(target, name)
-		except signaltimeout.Timeout:
-			return False
+
+if __name__ == '__main__':
+	# Benchmark finding the tells matching each message's sender, the old way (every target in turn,
+	# each under an AlarmTimeout) against TargetMatcher.
+	# Then benchmark saving changes with TellJournal against re-saving the whole store,
+	# and check the journal survives being cut off at any point.
+	# Args are: number of pending tells (default 5000), number of messages (default 200)
+	import random
+	import shutil
+	import string
+	import sys
+	import tempfile
+
+	from monotonic import monotonic
+
+	tell_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+	message_count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+	timeout = TellPlugin.defaults['regex_timeout']
+
+	def random_nick():
+		return ''.join(random.choice(string.ascii_lowercase + string.digits + '_') for _ in range(random.randint(3, 12)))
+
+	# mostly literal nicks, with some simple regexes and a few that aren't safe
+	targets = []
+	for i in range(tell_count):
+		kind = random.random()
+		if kind < 0.8:
+			targets.append(random_nick())
+		elif kind < 0.95:
+			targets.append(random.choice(['^{}', '{}.*', '{}|{}_', '{}\\d+$']).replace('{}', random_nick()))
+		else:
+			targets.append('({}+)+$'.format(random_nick()))
+	# mostly nicks with no tells, with some hits
+	names = [random.choice(targets) if random.random() < 0.05 else random_nick() for _ in range(message_count)]
+
+	def old_matching(name):
+		matching = set()
+		for target in targets:
+			try:
+				with signaltimeout.AlarmTimeout(timeout):
+					if re.search(target, name):
+						matching.add(target)
+			except signaltimeout.Timeout:
+				pass
+		return matching
+
+	matcher = TargetMatcher(timeout)
+	for target in targets:
+		matcher.add(Tell('sender', time.time(), target, None, 'text'))
+	print "{} targets, {} literal, {} unsafe, {} combined patterns".format(
+		len(matcher.targets), len(matcher.literals), len(matcher.unsafe), len(matcher.combined()),
+	)
+
+	results = {}
+	for name, matching in (('per target', old_matching), ('matcher', matcher.matching)):
+		found = 0
+		start = monotonic()
+		for nick in names:
+			found += len(matching(nick))
+		elapsed = monotonic() - start
+		results[name] = elapsed
+		print "{}: {:.3f}ms per message, {} matches".format(name, elapsed * 1000 / message_count, found)
+	print "speedup: {:.1f}x".format(results['per target'] / results['matcher'])
+
+	# Journal vs saving the whole store, with 10k tells pending
+	tempdir = tempfile.mkdtemp()
+	try:
+		pending = {}
+		for i in range(10000):
+			tell = Tell(random_nick(), time.time(), random_nick(), None, 'some message text ' * 3)
+			pending.setdefault(tell.sender.lower(), []).append(tell)
+		store_path = os.path.join(tempdir, 'store.json')
+		def save_store():
+			with open(store_path, 'w') as f:
+				json.dump({'tells': pending}, f)
+		journal = TellJournal(os.path.join(tempdir, 'journal'))
+		journal.load()
+		journal.compact(pending)
+		def save_journal():
+			journal.append('add', tell)
+			journal.flush()
+		op_count = 200
+		results = {}
+		for name, save in (('full store', save_store), ('journal', save_journal)):
+			start = monotonic()
+			for _ in range(op_count):
+				save()
+			elapsed = monotonic() - start
+			results[name] = elapsed
+			print "{}: {:.3f}ms per change".format(name, elapsed * 1000 / op_count)
+		print "speedup: {:.1f}x".format(results['full store'] / results['journal'])
+		journal.close()
+
+		# Crash consistency: make random changes, noting the journal's size and the expected state after each.
+		# Then cut the journal off at random points (as a crash mid-write would), and check that loading it
+		# gives the state as of the last change that was completely written.
+		path = os.path.join(tempdir, 'crash')
+		journal = TellJournal(path)
+		journal.load()
+		state = {}
+		history = [(0, {})]
+		for i in range(500):
+			all_tells = [tell for tells in state.values() for tell in tells]
+			if all_tells and random.random() < 0.4:
+				op, tell = 'remove', random.choice(all_tells)
+			else:
+				op, tell = 'add', Tell(random.choice(['alice', 'bob', 'carol']), time.time(), random_nick(), None, random_nick())
+			TellJournal.apply(state, op, tell)
+			journal.append(op, tell)
+			journal.flush()
+			history.append((os.path.getsize(path), {sender: list(tells) for sender, tells in state.items()}))
+		journal.close()
+		cut_path = os.path.join(tempdir, 'cut')
+		for _ in range(200):
+			cut = random.randint(0, history[-1][0])
+			with open(path, 'rb') as src, open(cut_path, 'wb') as dest:
+				dest.write(src.read(cut))
+			expected = [expected for size, expected in history if size <= cut][-1]
+			cut_journal = TellJournal(cut_path)
+			loaded = cut_journal.load()
+			cut_journal.close()
+			assert loaded == expected, "Journal cut at {} did not load as expected".format(cut)
+			os.remove(cut_path)
+		print "crash consistency: ok"
+	finally:
+		shutil.rmtree(tempdir)
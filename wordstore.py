@@ -0,0 +1,506 @@
+"""A dictionary word list shared by any plugins that want one.
+
+The words are loaded once per process (see load()), and once loaded are served from an index
+file which is mmapped, so its memory is shared between every bot process on the host.
+Words can be looked up by their sorted letters (for anagrams), by prefix or by length.
+"""
+
+from array import array
+import bisect
+import errno
+import heapq
+import itertools
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+
+import gevent
+from gevent.event import Event
+
+
+DICT_PATH = '/usr/share/dict'
+# This must be somewhere only we can write to, or anyone could make us say whatever words they like
+INDEX_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'ekimbot', 'words.index')
+
+# The DictLoader shared by everything in this process, or None if not started.
+loader = None
+
+# How many items write_index() sorts, packs or writes at once between calls to pause()
+CHUNK_SIZE = 4096
+
+
+class IndexFormatError(Exception):
+	pass
+
+
+class OutOfTime(Exception):
+	pass
+
+
+def load(path=DICT_PATH, index_path=INDEX_PATH, max_stall=0.01, logger=None):
+	"""Returns the shared DictLoader, starting it in the background if it isn't already.
+	Only the first caller's arguments have any effect."""
+	global loader
+	if not loader:
+		loader = DictLoader(path, index_path, max_stall, logger)
+		gevent.spawn(loader.run)
+	return loader
+
+
+def sort_key(word):
+	"""The key words are indexed under for anagram lookups"""
+	return "".join(sorted(word.lower()))
+
+
+def prefix_range(items, prefix, lo=0, hi=None):
+	"""Given a sorted sequence of strings, returns (lo, hi) such that items[lo:hi]
+	are all the items that start with prefix. Optionally only searches within items[lo:hi]."""
+	if hi is None:
+		hi = len(items)
+	lo = bisect.bisect_left(items, prefix, lo, hi)
+	# the first string that sorts after everything starting with prefix
+	end = prefix.rstrip('\xff')
+	if end:
+		hi = bisect.bisect_left(items, end[:-1] + chr(ord(end[-1]) + 1), lo, hi)
+	return lo, hi
+
+
+class Pauser(object):
+	"""Call regularly from cpu-intensive code. Yields to other greenlets whenever
+	we've run for more than interval seconds since we last yielded.
+	If limit is given, raises OutOfTime once we've run for more than limit seconds in total,
+	not counting time spent letting other greenlets run."""
+	def __init__(self, interval, limit=None):
+		self.interval = interval
+		self.limit = limit
+		self.used = 0
+		self.last = time.time()
+
+	def __call__(self):
+		now = time.time()
+		if now - self.last < self.interval:
+			return
+		self.used += now - self.last
+		if self.limit is not None and self.used >= self.limit:
+			raise OutOfTime
+		gevent.idle()
+		self.last = time.time()
+
+
+class MemoryStore(dict):
+	"""An in-memory {sorted letters: (words,)} store, as built while loading.
+	Words are interned so the lookup structures built from them don't keep their own copies.
+
+	Provides the same lookups as WordStore, but the structures backing sorted_keys, prefix and
+	length lookups are only built on demand. Building them means sorting everything, so while we're
+	loading they're only rebuilt once per dictionary file (see file_done()), not every time a word is added.
+	Keys and words are only ever added, never removed, so until then they're just missing the newest ones.
+	"""
+	def __init__(self):
+		super(MemoryStore, self).__init__()
+		self.word_count = 0
+		self.files_done = 0
+		# each of these is built for the files_done it was built at
+		self._sorted_keys = None
+		self._sorted_keys_files = None
+		self._sorted_words = None
+		self._sorted_words_files = None
+		self._by_length = None
+		self._by_length_files = None
+
+	def add(self, word):
+		word = intern(word)
+		key = sort_key(word)
+		matches = self.get(key, ())
+		if word in matches:
+			return
+		self[key] = matches + (word,)
+		self.word_count += 1
+
+	def file_done(self):
+		"""Call once every word in a dictionary file has been added, so lookups include them"""
+		self.files_done += 1
+
+	@property
+	def sorted_keys(self):
+		if self._sorted_keys_files != self.files_done:
+			self._sorted_keys = sorted(self)
+			self._sorted_keys_files = self.files_done
+		return self._sorted_keys
+
+	@property
+	def sorted_words(self):
+		if self._sorted_words_files != self.files_done:
+			self._sorted_words = sorted(word for words in self.itervalues() for word in words)
+			self._sorted_words_files = self.files_done
+		return self._sorted_words
+
+	def words_with_prefix(self, prefix):
+		lo, hi = prefix_range(self.sorted_words, prefix)
+		return iter(self.sorted_words[lo:hi])
+
+	def words_of_length(self, length):
+		if self._by_length_files != self.files_done:
+			self._by_length = {}
+			for word in self.sorted_words:
+				self._by_length.setdefault(len(word), []).append(word)
+			self._by_length_files = self.files_done
+		return iter(self._by_length.get(length, ()))
+
+
+class WordStore(object):
+	"""A read-only view of an index file written by write_index().
+	The file is mmapped and looked up by binary search, so opening it is near-instant,
+	lookups only page in what they touch, and the memory is shared between every bot
+	process on the host using the same index.
+
+	File layout (all integers are little-endian uint32):
+		magic, info length, info (JSON of {"signature": see dict_signature()}),
+		key count, word count,
+		word table of (offset, length) per word, sorted by word. A word's id is its position here.
+		length table of word ids, sorted by (length, word).
+		key table of (offset, length, id list position, id count) per key, sorted by key.
+		id list, the ids of each key's words in the order they were found.
+		blob of all the words and keys, pointed into by the word and key tables.
+	"""
+	MAGIC = 'WORDIDX3'
+	HEADER = struct.Struct('<8sI')
+	COUNTS = struct.Struct('<II')
+	WORD = struct.Struct('<II')
+	ID = struct.Struct('<I')
+	KEY = struct.Struct('<IIII')
+
+	def __init__(self, path):
+		with open(path, 'rb') as f:
+			self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, info_len = self.HEADER.unpack_from(self.map, 0)
+		if magic != self.MAGIC:
+			raise IndexFormatError("Bad magic {!r} in index file {}".format(magic, path))
+		offset = self.HEADER.size
+		info = json.loads(self.map[offset:offset + info_len])
+		self.signature = info['signature']
+		offset += info_len
+		self.key_count, self.word_count = self.COUNTS.unpack_from(self.map, offset)
+		offset += self.COUNTS.size
+		self.word_table = offset
+		self.length_table = self.word_table + self.word_count * self.WORD.size
+		self.key_table = self.length_table + self.word_count * self.ID.size
+		self.id_list = self.key_table + self.key_count * self.KEY.size
+		if self.id_list > len(self.map):
+			raise IndexFormatError("Index file {} is truncated".format(path))
+		self.sorted_keys = _Table(self.key_count, self.key_at)
+		self.sorted_words = _Table(self.word_count, self.word_at)
+		self.lengths = _Table(self.word_count, lambda i: len(self.word_at(self.length_id_at(i))))
+
+	def __len__(self):
+		return self.key_count
+
+	def word_at(self, word_id):
+		offset, length = self.WORD.unpack_from(self.map, self.word_table + word_id * self.WORD.size)
+		return self.map[offset:offset + length]
+
+	def length_id_at(self, i):
+		return self.ID.unpack_from(self.map, self.length_table + i * self.ID.size)[0]
+
+	def key_at(self, i):
+		offset, length, _, _ = self.KEY.unpack_from(self.map, self.key_table + i * self.KEY.size)
+		return self.map[offset:offset + length]
+
+	def get(self, key, default=None):
+		i = bisect.bisect_left(self.sorted_keys, key)
+		if i == self.key_count or self.key_at(i) != key:
+			return default
+		_, _, start, count = self.KEY.unpack_from(self.map, self.key_table + i * self.KEY.size)
+		ids = struct.unpack_from('<{}I'.format(count), self.map, self.id_list + start * self.ID.size)
+		return tuple(self.word_at(word_id) for word_id in ids)
+
+	def words_with_prefix(self, prefix):
+		lo, hi = prefix_range(self.sorted_words, prefix)
+		for word_id in xrange(lo, hi):
+			yield self.word_at(word_id)
+
+	def words_of_length(self, length):
+		lo = bisect.bisect_left(self.lengths, length)
+		hi = bisect.bisect_left(self.lengths, length + 1, lo)
+		for i in xrange(lo, hi):
+			yield self.word_at(self.length_id_at(i))
+
+
+class _Table(object):
+	"""Read-only sequence of size items, where item i is get(i). Suitable for bisect."""
+	def __init__(self, size, get):
+		self.size = size
+		self.get = get
+
+	def __len__(self):
+		return self.size
+
+	def __getitem__(self, i):
+		if not 0 <= i < self.size:
+			raise IndexError(i)
+		return self.get(i)
+
+
+def _uint32s(values):
+	values = array('I', values)
+	assert values.itemsize == 4
+	if sys.byteorder != 'little':
+		values.byteswap()
+	return values.tostring()
+
+
+def sorted_in_chunks(items, pause):
+	"""Returns sorted(items), but sorts CHUNK_SIZE items at a time then merges them,
+	calling pause in between so that no one step takes long"""
+	items = iter(items)
+	chunks = []
+	while True:
+		chunk = sorted(itertools.islice(items, CHUNK_SIZE))
+		if not chunk:
+			break
+		chunks.append(chunk)
+		pause()
+	result = []
+	for item in heapq.merge(*chunks):
+		result.append(item)
+		pause()
+	return result
+
+
+def write_index(path, store, signature, pause=lambda: None):
+	"""Write an index file for the given MemoryStore.
+	The file is written to a temporary path then renamed into place, so other processes
+	never see a partial index even if they are building it at the same time.
+	pause is called regularly to let other greenlets run. Even sorting and writing out everything
+	is done a chunk at a time between calls, so nothing holds up the rest of the bot for long."""
+	words = sorted_in_chunks((word for words in store.itervalues() for word in words), pause)
+	keys = sorted_in_chunks(store, pause)
+	info = json.dumps({'signature': signature})
+
+	offset = (
+		WordStore.HEADER.size + len(info) + WordStore.COUNTS.size
+		+ len(words) * (WordStore.WORD.size + WordStore.ID.size)
+		+ len(keys) * WordStore.KEY.size
+		+ store.word_count * WordStore.ID.size
+	)
+	blob = []
+	word_table = []
+	lengths = {} # {length: ids of words of that length}, which we add in order so they're sorted by word
+	for word_id, word in enumerate(words):
+		lengths.setdefault(len(word), []).append(word_id)
+		word_table += offset, len(word)
+		blob.append(word)
+		offset += len(word)
+		pause()
+	by_length = []
+	for length in sorted(lengths):
+		by_length += lengths[length]
+		pause()
+	key_table = []
+	id_list = []
+	for key in keys:
+		key_words = store[key]
+		key_table += offset, len(key), len(id_list), len(key_words)
+		# words is sorted, so a word's id is where it is in it. This is quick enough,
+		# and unlike building a dict of them, never has to stop to resize one.
+		id_list += [bisect.bisect_left(words, word) for word in key_words]
+		blob.append(key)
+		offset += len(key)
+		pause()
+
+	dirname = os.path.dirname(path) or '.'
+	try:
+		os.makedirs(dirname, 0o700)
+	except OSError as e:
+		if e.errno != errno.EEXIST:
+			raise
+	# mkstemp picks a name no-one else can have created first
+	fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=dirname)
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			f.write(WordStore.HEADER.pack(WordStore.MAGIC, len(info)))
+			f.write(info)
+			f.write(WordStore.COUNTS.pack(len(keys), len(words)))
+			for table in (word_table, by_length, key_table, id_list):
+				for i in xrange(0, len(table), CHUNK_SIZE):
+					f.write(_uint32s(table[i:i + CHUNK_SIZE]))
+					pause()
+			for i in xrange(0, len(blob), CHUNK_SIZE):
+				f.write(''.join(blob[i:i + CHUNK_SIZE]))
+				pause()
+		os.rename(tmp_path, path)
+	except BaseException:
+		os.remove(tmp_path)
+		raise
+
+
+def dict_signature(path=DICT_PATH):
+	"""Identifies the current contents of the dictionary files, so we know when an index is stale"""
+	signature = []
+	for name in sorted(os.listdir(path)):
+		stat = os.stat(os.path.join(path, name))
+		signature.append([name, stat.st_mtime, stat.st_size])
+	return signature
+
+
+class DictLoader(object):
+	"""Loads the dictionary in the background.
+
+	If there's an up to date index file, we just open it. Otherwise we read the dictionary files
+	one at a time into a MemoryStore, which is published as self.store as we go so that
+	queries can be answered (incompletely) before we're done. Once we've read everything,
+	we write out a new index file and switch to it.
+	"""
+
+	def __init__(self, path=DICT_PATH, index_path=INDEX_PATH, max_stall=0.01, logger=None):
+		self.path = path
+		self.index_path = index_path
+		self.max_stall = max_stall
+		self.logger = logger
+		# The best store we have so far. Only complete once self.ready is set.
+		self.store = MemoryStore()
+		self.ready = Event()
+		self.error = None
+		# progress info
+		self.files_done = 0
+		self.files_total = None
+		self.started = None
+		self.finished = None
+
+	@property
+	def elapsed(self):
+		if self.started is None:
+			return 0
+		return (self.finished or time.time()) - self.started
+
+	def run(self):
+		self.started = time.time()
+		try:
+			signature = dict_signature(self.path)
+			self.files_total = len(signature)
+			store = self.open_existing(signature)
+			if store is None:
+				pause = Pauser(self.max_stall)
+				self.read(signature, pause)
+				write_index(self.index_path, self.store, signature, pause)
+				store = WordStore(self.index_path)
+			self.store = store
+			self.files_done = self.files_total
+		except Exception as e:
+			self.error = e
+			if self.logger is None:
+				raise
+			self.logger.exception("Failed to load dictionary")
+			return
+		finally:
+			self.finished = time.time()
+		self.ready.set()
+		if self.logger:
+			self.logger.info("Loaded {} words from {} dictionary files in {:.2f}s".format(
+				self.store.word_count, self.files_total, self.elapsed,
+			))
+
+	def open_existing(self, signature):
+		"""Returns the existing index file if it is present and up to date, otherwise None"""
+		try:
+			store = WordStore(self.index_path)
+		except (EnvironmentError, ValueError, struct.error, IndexFormatError):
+			# missing, empty (can't be mmapped), truncated or otherwise bad
+			return None
+		if store.signature != signature:
+			return None
+		return store
+
+	def read(self, signature, pause):
+		"""Read every dictionary file into a MemoryStore in self.store"""
+		store = self.store = MemoryStore()
+		for name, _, _ in signature:
+			with open(os.path.join(self.path, name)) as f:
+				for line in f:
+					line = line.rstrip('\n')
+					if line:
+						store.add(line)
+					pause()
+			store.file_done()
+			self.files_done += 1
+		return store
+
+	def status(self):
+		if self.error is not None:
+			state = "Failed to load dictionary ({})".format(self.error)
+		elif self.ready.is_set():
+			state = "Dictionary loaded"
+		else:
+			state = "Still loading dictionary"
+		return "{}: {}/{} files, {} words indexed, {:.2f}s elapsed".format(
+			state, self.files_done, self.files_total or '?', self.store.word_count, self.elapsed,
+		)
+
+
+if __name__ == '__main__':
+	# Memory benchmark: compares the plain dict of tuples of strings the anagrams plugin used to
+	# hold in every process against the shared index, with every word paged in.
+
+	from monotonic import monotonic
+
+	PAGE_KB = os.sysconf('SC_PAGE_SIZE') / 1024
+	def get_mem():
+		"""Returns (rss, shared) in KB"""
+		with open('/proc/self/statm') as f:
+			_, rss, shared = map(int, f.read().split()[:3])
+		return rss * PAGE_KB, shared * PAGE_KB
+
+	def in_child(fn):
+		# Each benchmark runs in a fresh fork so that memory used by one doesn't count against another
+		pid = os.fork()
+		if pid:
+			os.waitpid(pid, 0)
+			return
+		try:
+			fn()
+		finally:
+			os._exit(0)
+
+	def tuple_dict():
+		_words = {}
+		for name in os.listdir(DICT_PATH):
+			with open(os.path.join(DICT_PATH, name)) as f:
+				for line in f.read().strip().split('\n'):
+					key = sort_key(line)
+					matches = _words.get(key, ())
+					if line not in matches:
+						_words[key] = matches + (line,)
+		return _words
+
+	def index_store():
+		store = WordStore(INDEX_PATH)
+		# page in everything, as if it was in heavy use
+		for key in store.sorted_keys:
+			store.get(key)
+		for word in store.words_with_prefix(''):
+			pass
+		for length in range(64):
+			for word in store.words_of_length(length):
+				pass
+		return store
+
+	def benchmark(name, load):
+		start_t = monotonic()
+		start_rss, start_shared = get_mem()
+		result = load()
+		end_t = monotonic()
+		end_rss, end_shared = get_mem()
+		print "{}: {:.2f}s, {:+.2f}MB rss of which {:+.2f}MB shared".format(
+			name, end_t - start_t, (end_rss - start_rss) / 1024.0, (end_shared - start_shared) / 1024.0,
+		)
+		sys.stdout.flush()
+		return result
+
+	# Make sure the index is built first
+	in_child(lambda: DictLoader().run())
+	in_child(lambda: benchmark("dict of tuples", tuple_dict))
+	in_child(lambda: benchmark("index", index_store))